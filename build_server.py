@@ -0,0 +1,160 @@
+"""Build server which keeps parsed targets and watchdogs warm between builds."""
+
+import contextlib
+import io
+import json
+import os
+import socket
+import typing
+
+from impulse import impulse_paths
+from impulse import recursive_loader
+from impulse.core import capacity
+from impulse.core import debug
+from impulse.core import exceptions
+from impulse.core import threading
+from impulse.core import timings
+from impulse.core import trace
+from impulse.pkg import action_cache
+from impulse.pkg import hashing
+
+
+SOCKET_NAME = 'impulse.sock'
+
+
+def SocketPath() -> str:
+  return os.path.join(impulse_paths.output_directory(), SOCKET_NAME)
+
+
+class ClientStream(io.TextIOBase):
+  """Forwards everything printed during a build to the connected client."""
+  def __init__(self, connection:typing.TextIO):
+    self._connection = connection
+
+  def write(self, text:str) -> int:
+    self._connection.write(json.dumps({'output': text}) + '\n')
+    return len(text)
+
+  def flush(self):
+    self._connection.flush()
+
+
+class BuildServer(object):
+  def __init__(self, threads:int, history:timings.TimingDatabase,
+               enable_debug:bool=False,
+               executor:str=threading.Executor.PROCESSES):
+    self._debug = enable_debug
+    self._history = history
+    self._watchdogs = threading.MakeWatchdogs(executor, threads, enable_debug)
+    self._parsers:dict[str, recursive_loader.RecursiveFileParser] = {}
+
+  def Serve(self):
+    path = SocketPath()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+      os.unlink(path)
+    self._watchdogs.Start()
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+        print(f'Serving builds on {path}')
+        while True:
+          connection, _ = server.accept()
+          with connection:
+            self._HandleConnection(connection)
+    finally:
+      self._watchdogs.Stop()
+      if os.path.exists(path):
+        os.unlink(path)
+
+  def _HandleConnection(self, connection:socket.socket):
+    stream = connection.makefile('rw')
+    try:
+      request = json.loads(stream.readline())
+    except json.JSONDecodeError:
+      return
+    error = None
+    with contextlib.redirect_stdout(ClientStream(stream)):
+      try:
+        self._Build(request)
+      except exceptions.ImpulseBaseException as e:
+        error = str(e)
+      except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    try:
+      stream.write(json.dumps({'done': True, 'error': error}) + '\n')
+      stream.flush()
+    except BrokenPipeError:
+      pass
+
+  def _GetParser(self, platform:str|None
+                 ) -> recursive_loader.RecursiveFileParser:
+    if platform not in self._parsers:
+      self._parsers[platform] = recursive_loader.RecursiveFileParser(
+        impulse_paths.BuildTarget(platform))
+    return self._parsers[platform]
+
+  def _Build(self, request:dict):
+    target = impulse_paths.convert_to_build_target(
+      request['target'], '//', True)
+    parser = self._GetParser(request.get('platform', None))
+    graph = parser.GenerateGraph(target)
+    # Builds run with --noserver write to the same database.
+    self._history.Reload()
+    observers = [self._history]
+    if request.get('trace', None):
+      observers.append(trace.ChromeTrace(request['trace']))
+    pool = threading.DependentPool(
+      self._watchdogs.pool_count, debug=self._debug,
+      schedule=request.get('schedule', threading.Schedule.FIFO),
+      estimator=self._history.Estimate, watchdogs=self._watchdogs,
+      observers=observers, capacity=capacity.FromFlag(
+        request.get('jobs', None), self._watchdogs.pool_count,
+        self._history.MemoryHint, limit=self._watchdogs.pool_count),
+      failure_mode=request.get(
+        'failure_mode', threading.FailureMode.FAIL_FAST),
+      file_digester=hashing.Digester())
+    pool.Start(graph, threaded=False)
+    action_cache.Trim()
+
+
+def RequestBuild(target:str, platform:str|None, schedule:str,
+                 trace_file:str|None=None, jobs:str|None=None,
+                 failure_mode:str|None=None) -> bool|None:
+  """Asks a running server to build |target|.
+
+  Returns None if there is no server to talk to, otherwise whether the build
+  request was handled without error.
+  """
+  path = SocketPath()
+  if not os.path.exists(path):
+    return None
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(path)
+  except (ConnectionRefusedError, FileNotFoundError):
+    client.close()
+    return None
+
+  with client:
+    stream = client.makefile('rw')
+    stream.write(json.dumps({
+      'target': target,
+      'platform': platform,
+      'schedule': schedule,
+      'trace': trace_file,
+      'jobs': jobs,
+      'failure_mode': failure_mode or threading.FailureMode.FAIL_FAST,
+    }) + '\n')
+    stream.flush()
+    for line in stream:
+      message = json.loads(line)
+      if 'output' in message:
+        print(message['output'], end='', flush=True)
+      if message.get('done', False):
+        if message['error']:
+          print(message['error'])
+        return not message['error']
+  debug.DebugMsg('Build server closed the connection unexpectedly')
+  return False
@@ -0,0 +1,137 @@
+"""Decides how much work a pool may have running at once.
+
+Every job takes some number of slots (most take one, heavy ones like linking
+take more). A fixed capacity is just a number of slots, while an adaptive one
+shrinks when the machine is busy with other work or running out of memory.
+"""
+
+import os
+import time
+import typing
+
+
+# What a job is assumed to need when there is no history for its rule type.
+DEFAULT_JOB_MEMORY = 256 * 1024 * 1024
+
+# /proc is only re-read this often, the kernel smooths load over a minute
+# anyway, so sampling it for every dispatch would just be wasted syscalls.
+SAMPLE_INTERVAL = 0.5
+
+
+class SystemLoad(object):
+  """Reads the load average and available memory from /proc."""
+  def __init__(self, proc:str='/proc'):
+    self._proc = proc
+    self._sampled = 0.0
+    self._load = 0.0
+    self._available = None
+
+  def _Sample(self):
+    now = time.monotonic()
+    if now - self._sampled < SAMPLE_INTERVAL:
+      return
+    self._sampled = now
+    try:
+      with open(os.path.join(self._proc, 'loadavg')) as f:
+        self._load = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+      self._load = 0.0
+    self._available = None
+    try:
+      with open(os.path.join(self._proc, 'meminfo')) as f:
+        for line in f:
+          if line.startswith('MemAvailable:'):
+            self._available = int(line.split()[1]) * 1024
+            break
+    except (OSError, ValueError, IndexError):
+      pass
+
+  def LoadAverage(self) -> float:
+    self._Sample()
+    return self._load
+
+  def AvailableMemory(self) -> int|None:
+    """Bytes of memory available, or None if it can't be determined."""
+    self._Sample()
+    return self._available
+
+
+class FixedCapacity(object):
+  """A constant number of slots."""
+  def __init__(self, slots:int):
+    self._slots = slots
+
+  def Limit(self) -> int:
+    """The most jobs which could ever run at once."""
+    return self._slots
+
+  def InitialWorkers(self) -> int:
+    return self._slots
+
+  def Admit(self, node, slots_in_flight:int) -> bool:
+    return slots_in_flight + node.slots() <= self._slots
+
+  def Started(self, node):
+    pass
+
+  def Finished(self, node):
+    pass
+
+
+class AdaptiveCapacity(FixedCapacity):
+  """Up to |slots| slots, fewer when the CPUs or memory are already in use.
+
+  The load average includes the jobs this pool is running, so only the load
+  beyond those counts against it. Memory is reserved for each running job from
+  |memory_hint| until it finishes, which overcounts once the job has actually
+  allocated it, but that errs on the side of not starting the one link step
+  too many.
+  """
+  def __init__(self, slots:int=None,
+               memory_hint:typing.Callable[[typing.Any], int|None]=None,
+               system:SystemLoad=None):
+    super().__init__(slots or os.cpu_count() or 1)
+    self._memory_hint = memory_hint or (lambda _: None)
+    self._system = system or SystemLoad()
+    self._reserved:typing.Dict[typing.Any, int] = {}
+
+  def InitialWorkers(self) -> int:
+    # Watchdogs are started as jobs are admitted.
+    return 0
+
+  def _Memory(self, node) -> int:
+    hint = self._memory_hint(node)
+    return DEFAULT_JOB_MEMORY if hint is None else hint
+
+  def CpuSlots(self, slots_in_flight:int) -> int:
+    external = max(0.0, self._system.LoadAverage() - slots_in_flight)
+    return max(1, min(self._slots, int(self._slots - external)))
+
+  def Admit(self, node, slots_in_flight:int) -> bool:
+    if slots_in_flight + node.slots() > self.CpuSlots(slots_in_flight):
+      return False
+    available = self._system.AvailableMemory()
+    if available is None:
+      return True
+    return self._Memory(node) + sum(self._reserved.values()) <= available
+
+  def Started(self, node):
+    self._reserved[node] = self._Memory(node)
+
+  def Finished(self, node):
+    self._reserved.pop(node, None)
+
+
+AUTO = 'auto'
+
+
+def FromFlag(jobs:str|None, default:int,
+             memory_hint:typing.Callable[[typing.Any], int|None]=None,
+             limit:int=None) -> FixedCapacity:
+  """Capacity for a --jobs flag, which is either a number or 'auto'."""
+  if jobs == AUTO:
+    return AdaptiveCapacity(limit, memory_hint)
+  slots = default if jobs is None else int(jobs)
+  if limit is not None:
+    slots = min(slots, limit)
+  return FixedCapacity(max(1, slots))
@@ -0,0 +1,114 @@
+import os
+import subprocess
+import tempfile
+import time
+
+from impulse.args import args
+from impulse.core import debug
+from impulse.core import threading
+from impulse.util import temp_dir
+
+
+command = args.ArgumentParser(complete=True)
+
+
+class CommandNode(threading.GraphNode):
+  """Does roughly what a small py_library does: copy a source, then zip it."""
+  def __init__(self, index, dependencies):
+    super().__init__(dependencies, False)
+    self._index = index
+
+  def run_job(self, debug, internal_access=None):
+    with temp_dir.ScopedTempDirectory(delete_non_empty=True):
+      with open(f'lib_{self._index}.py', 'w') as f:
+        f.write(f'VALUE = {self._index}\n')
+      with temp_dir.ReleasedWorkingDirectory() as cwd:
+        subprocess.run(
+          f'mkdir out && cp lib_{self._index}.py out/ && '
+          f'cd out && zip -q -r ../lib_{self._index}.zip .',
+          cwd=cwd, shell=True, check=True)
+
+  def __eq__(self, other):
+    return type(other) == CommandNode and other._index == self._index
+
+  def __hash__(self):
+    return self._index
+
+  def __str__(self):
+    return f'lib_{self._index}'
+
+  def get_name(self):
+    return str(self)
+
+  def data(self):
+    return None
+
+
+def MakeGraph(libraries):
+  """|libraries| independent targets, and one target which depends on all."""
+  graph = set(CommandNode(index, set()) for index in range(libraries))
+  return graph | {CommandNode(libraries, set(graph))}
+
+
+def TimeBuild(graph, executor, threads):
+  start = time.perf_counter()
+  pool = threading.DependentPool(threads, executor=executor)
+  pool.Start(graph)
+  pool.join()
+  return time.perf_counter() - start
+
+
+@command
+def synthetic(libraries:int=500,
+              threads:int=6,
+              repeat:int=3):
+  """Times a graph of small command-running jobs on each executor."""
+  for executor in threading.Executor.ALL:
+    best = min(TimeBuild(MakeGraph(libraries), executor, threads)
+               for _ in range(repeat))
+    print(f'{executor}: {best:.3f}s for {libraries + 1} jobs, '
+          f'{best / (libraries + 1) * 1e3:.2f}ms per job')
+
+
+def WriteWorkspace(root, libraries):
+  """A package with |libraries| py_library targets, and one depending on all."""
+  package = os.path.join(root, 'executor_benchmark')
+  os.makedirs(package, exist_ok=True)
+  with open(os.path.join(package, 'BUILD'), 'w') as build:
+    for index in range(libraries):
+      with open(os.path.join(package, f'lib_{index}.py'), 'w') as f:
+        f.write(f'VALUE = {index}\n')
+      build.write(f'py_library (\n  name = "lib_{index}",\n'
+                  f'  srcs = [ "lib_{index}.py" ],\n)\n\n')
+    deps = ''.join(f'    ":lib_{index}",\n' for index in range(libraries))
+    build.write(f'py_library (\n  name = "all",\n  srcs = [],\n'
+                f'  deps = [\n{deps}  ],\n)\n')
+  return '//executor_benchmark:all'
+
+
+@command
+def workspace(libraries:int=500,
+              threads:int=6,
+              impulse:str='impulse',
+              root:args.Directory=None):
+  """Times `impulse build` of generated py_library targets on each executor.
+
+  The workspace is written to |root| if given, otherwise to a temporary
+  directory, which also needs the rules from a checkout to be built.
+  """
+  directory = root.value() if root else tempfile.mkdtemp()
+  target = WriteWorkspace(directory, libraries)
+  for executor in threading.Executor.ALL:
+    start = time.perf_counter()
+    subprocess.run(
+      [impulse, 'build', target, '--force', '--noserver',
+       '--threads', str(threads), '--executor', executor,
+       '--fakeroot', directory],
+      check=True, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    print(f'{executor}: {elapsed:.3f}s for {libraries + 1} targets')
+
+
+def main():
+  debug.EnableDebug()
+  command.eval()
@@ -9,11 +9,15 @@ class JobPrinter(object):
     self._completed_jobs = 0
     self._total_jobs = jobcount
     self._pool_count = pool_count
+    self._remaining_estimate = None
     self._print()
 
   def add_job_count(self, new_count):
     self._total_jobs += new_count
 
+  def set_remaining_estimate(self, seconds):
+    self._remaining_estimate = seconds
+
   def write_task_msg(self, mid, msg):
     self._jobs[mid] = msg
     if not debug.IsDebug():
@@ -29,6 +33,8 @@ class JobPrinter(object):
 
   def _print(self):
     countline = '[{} / {}]'.format(self._completed_jobs, self._total_jobs)
+    if self._remaining_estimate is not None:
+      countline += ' ~{:.0f}s remaining'.format(self._remaining_estimate)
     if not debug.IsDebug():
       for _ in range(self._jobs_print_length):
         print('\033[G\033[2K\033[F', end='')
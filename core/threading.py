@@ -1,16 +1,56 @@
 import abc
+import concurrent.futures
+import copy
+import heapq
+import itertools
 import multiprocessing
 import queue
 import signal
+import threading as py_threading
+import time
 import traceback
-from typing import Set, Dict, TypeVar, Generic
+from typing import Callable, Set, Dict, List, Tuple, TypeVar, Generic
 
+from impulse.core import capacity as pool_capacity
 from impulse.core import job_printer
 
 
 class Messages(object):
   EMPTY_RESPONSE = 'Internal: Empty Response'
-  TIMEOUT = 'Job Waiter Timed Out'
+  STALLED = 'Internal: No jobs running, but still waiting on {}'
+
+
+class Schedule(object):
+  FIFO = 'fifo'
+  CRITICAL_PATH = 'critical-path'
+  ALL = (FIFO, CRITICAL_PATH)
+
+
+class Executor(object):
+  # Every worker is its own process, jobs are pickled to be sent to them.
+  PROCESSES = 'processes'
+  # Workers are threads of the pool's process. They share its one working
+  # directory, so only one job at a time runs python in its sandbox; the
+  # others can only be waiting on commands (see temp_dir).
+  THREADS = 'threads'
+  ALL = (PROCESSES, THREADS)
+
+
+class FailureMode(object):
+  # Start nothing more after the first failure. Jobs already running can't be
+  # interrupted safely, so they are waited for.
+  FAIL_FAST = 'fail-fast'
+  # Keep building everything which doesn't depend on a failed job.
+  KEEP_GOING = 'keep-going'
+  ALL = (FAIL_FAST, KEEP_GOING)
+
+
+# How many skipped targets are listed by name in the summary of a failed build.
+SUMMARY_SKIPPED_LIMIT = 20
+
+
+# The estimated duration (in seconds) of a job we know nothing about.
+DEFAULT_JOB_ESTIMATE = 1.0
 
 
 class UpdateGraphResponseData(object):
@@ -68,6 +108,53 @@ class GraphNode(Generic[T]):
   def data(self) -> T:
     pass
 
+  def slots(self) -> int:
+    """How many of the pool's slots this job occupies while it runs."""
+    return 1
+
+  def clone(self) -> 'GraphNode':
+    """A copy of this node which can be run without changing this one."""
+    return copy.copy(self)
+
+  def report(self):
+    """Anything about the last run worth sending back alongside its result.
+
+    This is sent instead of the node itself, so it should be small.
+    """
+    return None
+
+  def common_files(self) -> List[str]:
+    """Files which many jobs read, like the BUILD file this node is from.
+
+    A pool with a file digester hashes each of these at most once per build,
+    and sends the digests along with the job (see use_file_digests).
+    """
+    return []
+
+  def use_file_digests(self, digests:Dict[str, str]):
+    """Digests of this node's common_files, computed by the pool."""
+    pass
+
+  def remote_files(self) -> Tuple[Dict[str, str], List[str]]|None:
+    """What a remote worker needs to run this node, if it can run remotely.
+
+    That is the files it reads, root relative paths to where they are here,
+    and the root relative paths of the files it writes.
+    """
+    return None
+
+  def rebase(self, root:str):
+    """Moves this node from |root| to the root it is being run under."""
+    pass
+
+  def detached(self) -> 'GraphNode':
+    """A copy of this node to send to a remote worker.
+
+    Running a node shouldn't need the nodes its dependencies depend on, so
+    this copy can leave them out, rather than sending the rest of the graph.
+    """
+    return self
+
 
 class NullNode(GraphNode):
   def __init__(self):
@@ -84,6 +171,23 @@ class NullNode(GraphNode):
     raise NotImplementedError()
 
 
+class Job(object):
+  """A job sent to the watchdogs.
+
+  Jobs are identified by their index in the pool. |node| is left out when the
+  watchdogs already have their own copy of it, which they inherit when they're
+  started, so that the node and everything it depends on don't need to be
+  pickled every time a job is sent. |digests| are of the node's common_files.
+  """
+  __slots__ = ('index', 'node', 'digests')
+
+  def __init__(self, index:int, node:GraphNode|None=None,
+               digests:Dict[str, str]|None=None):
+    self.index = index
+    self.node = node
+    self.digests = digests
+
+
 class JobResponse(object):
   class LEVEL(object):
     FATAL = '__L_FATAL__'
@@ -93,14 +197,20 @@ class JobResponse(object):
 
   def __init__(self, level:str,
                      job_id:int,
-                     job:GraphNode,
+                     job_index:int|None,
                      message:str='',
-                     result=None):
+                     result=None,
+                     report=None):
     self._level = level
     self._msg = message
     self._result = result
-    self._job = job
+    self._report = report
+    self._index = job_index
+    self._job = None
     self._id = job_id
+    # Set on the watchdog when the response is sent, so the coordinator can
+    # place jobs on a timeline without asking the workers for anything else.
+    self._timestamp = time.time()
 
   def level(self) -> str:
     return self._level
@@ -112,28 +222,62 @@ class JobResponse(object):
     return self._result
 
   def job(self) -> GraphNode:
+    """The pool's own copy of the job, once the pool has resolved it."""
     return self._job
 
+  def resolve(self, job:GraphNode):
+    self._job = job
+
+  def index(self) -> int|None:
+    return self._index
+
+  def report(self):
+    return self._report
+
   def id(self) -> int:
     return self._id
 
+  def timestamp(self) -> float:
+    return self._timestamp
+
 
 def handle_pdb(sig, frame):
   import pdb
   pdb.Pdb().set_trace(frame)
 
 
+def RunJob(watchdog_id:int, index:int, node:GraphNode,
+           responses:queue.Queue, debug:bool=False) -> None:
+  """Runs |node| for a worker, and reports how it went to |responses|."""
+  responses.put(JobResponse(
+    JobResponse.LEVEL.YELLOW, watchdog_id, index, message=str(node)))
+  try:
+    job_result = node()
+  except Exception as e:
+    responses.put(JobResponse(
+      JobResponse.LEVEL.FATAL, watchdog_id, index, message=str(e)))
+    if debug:
+      traceback.print_exc()
+    return
+  responses.put(JobResponse(
+    JobResponse.LEVEL.GREEN, watchdog_id, index,
+    result=job_result, report=node.report()))
+
+
 class ThreadWatchdog(multiprocessing.Process):
   POISON = NullNode()
-  __slots__ = ['_id', '_debug', '_job_input_queue', '_job_response_queue']
+  __slots__ = ['_id', '_debug', '_job_input_queue', '_job_response_queue',
+               '_shared_jobs']
 
   def __init__(self,
                watchdog_id:int,
                debug_mode:bool,
                job_input_queue:multiprocessing.JoinableQueue,
-               job_response_queue:multiprocessing.Queue):
+               job_response_queue:multiprocessing.Queue,
+               shared_jobs:List[GraphNode]=None):
     multiprocessing.Process.__init__(self)
     self._id = watchdog_id
+    self._shared_jobs = shared_jobs or []
     self._debug = debug_mode
     self._job_input_queue = job_input_queue
     self._job_response_queue = job_response_queue
@@ -142,56 +286,202 @@ class ThreadWatchdog(multiprocessing.Process):
     if self._debug:
       signal.signal(signal.SIGUSR1, handle_pdb)
 
-  def _Fail(self, exc:Exception):
-    self._job_response_queue.put(JobResponse(
-        JobResponse.LEVEL.FATAL, self._id, NullNode(),
-        message=str(exc)))
-    if not self._debug:
-      return
-    traceback.print_exc()
-
   def run(self):
     while True:
-      job = ThreadWatchdog.POISON
-      try:
-        job = self._job_input_queue.get(timeout=5)
-      except:
-        self._job_response_queue.put(JobResponse(
-          JobResponse.LEVEL.WARNING, self._id, None,
-          message=Messages.TIMEOUT))
-        continue
-
+      job = self._job_input_queue.get()
       if job == ThreadWatchdog.POISON:
         self._job_input_queue.task_done()
         self._job_input_queue.join()
         return
 
-      self._job_response_queue.put(JobResponse(
-        JobResponse.LEVEL.YELLOW, self._id, job, message=str(job)))
+      node = job.node
+      if node is None:
+        # The inherited copy is never run itself, so that it stays exactly
+        # as the pool sent it.
+        node = self._shared_jobs[job.index].clone()
+      if job.digests:
+        node.use_file_digests(job.digests)
+      RunJob(self._id, job.index, node, self._job_response_queue, self._debug)
+      self._job_input_queue.task_done()
+
+class WatchdogSet(object):
+  """A group of watchdog processes along with the queues that feed them.
+
+  A set can outlive any single pool, which lets a long running process (like
+  the build server) keep its workers warm between builds.
+  """
+  def __init__(self, poolcount:int, debug:bool=False):
+    self.job_response_queue:queue.Queue[JobResponse] = multiprocessing.Queue()
+    self.job_input_queue:queue.Queue[GraphNode] = multiprocessing.JoinableQueue()
+    self.pool_count = poolcount
+    self._debug = debug
+    self._watchdogs = []
+    self._running = False
+    self._shared_jobs = []
+
+  def Start(self, count:int=None, shared_jobs:List[GraphNode]=None):
+    """Starts |count| watchdogs, or |pool_count| of them by default.
 
+    Every watchdog gets a copy of |shared_jobs|, so that those jobs can be
+    sent by index alone.
+    """
+    self._running = True
+    self._shared_jobs = shared_jobs or []
+    self.Grow(self.pool_count if count is None else count)
+
+  def SharedJobCount(self) -> int:
+    return len(self._shared_jobs)
+
+  def Grow(self, count:int):
+    """Makes sure at least |count| watchdogs are running, up to |pool_count|."""
+    if not self._running:
+      return
+    while len(self._watchdogs) < min(count, self.pool_count):
+      watchdog = ThreadWatchdog(
+        watchdog_id = len(self._watchdogs),
+        debug_mode = self._debug,
+        job_input_queue = self.job_input_queue,
+        job_response_queue = self.job_response_queue,
+        shared_jobs = self._shared_jobs)
+      watchdog.start()
+      self._watchdogs.append(watchdog)
+
+  def Stop(self):
+    for _ in range(len(self._watchdogs)):
+      self.job_input_queue.put(ThreadWatchdog.POISON)
+    self.job_input_queue.join()
+    for dog in self._watchdogs:
+      dog.kill()
+    self._watchdogs = []
+    self._running = False
+    self._shared_jobs = []
+
+  def Drain(self):
+    """Waits for in-flight jobs, then discards any responses left unread."""
+    self.job_input_queue.join()
+    while True:
       try:
-        job_result = job()
-      except Exception as e:
-        self._job_input_queue.task_done()
-        self._Fail(e)
-        continue
+        self.job_response_queue.get_nowait()
+      except queue.Empty:
+        return
+
+
+class ThreadExecutorSet(object):
+  """Runs jobs on a thread pool instead of watchdog processes.
+
+  This has the same interface as WatchdogSet, though nothing is pickled, and
+  the jobs are never sent anywhere else, so every node is shared. Nodes are
+  still cloned before they run, so that the pool's copies are left alone.
+  """
+  class _SubmitQueue(object):
+    def __init__(self, executor_set:'ThreadExecutorSet'):
+      self._executor_set = executor_set
+
+    def put(self, job:Job):
+      self._executor_set.Submit(job)
+
+  def __init__(self, poolcount:int, debug:bool=False):
+    self.job_response_queue:queue.Queue[JobResponse] = queue.Queue()
+    self.job_input_queue = ThreadExecutorSet._SubmitQueue(self)
+    self.pool_count = poolcount
+    self._debug = debug
+    self._executor = None
+    self._futures = set()
+    self._shared_jobs = []
+    self._worker = py_threading.local()
+    self._worker_ids = itertools.count()
+
+  def _InitializeWorker(self):
+    self._worker.id = next(self._worker_ids)
+
+  def Start(self, count:int=None, shared_jobs:List[GraphNode]=None):
+    # Threads are only started as jobs are submitted, up to |pool_count|.
+    self._shared_jobs = shared_jobs or []
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=self.pool_count, thread_name_prefix='Watchdog',
+      initializer=self._InitializeWorker)
+
+  def SharedJobCount(self) -> int:
+    return len(self._shared_jobs)
+
+  def Grow(self, count:int):
+    pass
+
+  def Submit(self, job:Job):
+    future = self._executor.submit(self._Run, job)
+    self._futures.add(future)
+    future.add_done_callback(self._futures.discard)
+
+  def _Run(self, job:Job):
+    node = job.node
+    if node is None:
+      node = self._shared_jobs[job.index]
+    node = node.clone()
+    if job.digests:
+      node.use_file_digests(job.digests)
+    RunJob(self._worker.id, job.index, node,
+           self.job_response_queue, self._debug)
+
+  def Stop(self):
+    # Threads can't be killed, so jobs already running are waited for, but
+    # nothing new is started.
+    if self._executor is not None:
+      self._executor.shutdown(wait=True, cancel_futures=True)
+    self._executor = None
+    self._shared_jobs = []
+
+  def Drain(self):
+    concurrent.futures.wait(list(self._futures))
+    while True:
+      try:
+        self.job_response_queue.get_nowait()
+      except queue.Empty:
+        return
+
+
+def MakeWatchdogs(executor:str|Callable, poolcount:int,
+                  debug:bool=False) -> WatchdogSet|ThreadExecutorSet:
+  """Workers for |executor|, which is also allowed to make them itself."""
+  if callable(executor):
+    return executor(poolcount, debug)
+  if executor == Executor.PROCESSES:
+    return WatchdogSet(poolcount, debug)
+  if executor == Executor.THREADS:
+    return ThreadExecutorSet(poolcount, debug)
+  raise ValueError(f'Unknown executor "{executor}", expected one of '
+                   f'{", ".join(Executor.ALL)}')
+
+
+class PoolObserver(object):
+  """Notified about job progress, on the process running the pool."""
+  def JobStarted(self, response:JobResponse):
+    pass
+
+  def JobCompleted(self, response:JobResponse):
+    pass
+
+  def JobFailed(self, response:JobResponse):
+    pass
+
+  def PoolFinished(self, err:str=None):
+    pass
 
-      self._job_response_queue.put(JobResponse(
-        JobResponse.LEVEL.GREEN, self._id, job,
-        result=job_result))
-      self._job_input_queue.task_done()
 
 class ThreadPool(multiprocessing.Process):
-  def __init__(self, poolcount:int, debug:bool = False):
+  def __init__(self, poolcount:int, debug:bool = False,
+               watchdogs:WatchdogSet = None,
+               executor:str|Callable = Executor.PROCESSES):
     super().__init__()
+    self._initial_watchdogs = None
     self._debug = debug
-    self._job_response_queue:queue.Queue[JobResponse] = multiprocessing.Queue()
-    self._job_input_queue:queue.Queue[GraphNode] = multiprocessing.JoinableQueue()
-    self._pool_count:int = poolcount
-    self._printer = job_printer.JobPrinter(0, poolcount)
+    self._owns_watchdogs = watchdogs is None
+    self._watchdogs = watchdogs or MakeWatchdogs(executor, poolcount, debug)
+    self._job_response_queue = self._watchdogs.job_response_queue
+    self._job_input_queue = self._watchdogs.job_input_queue
+    self._pool_count:int = self._watchdogs.pool_count
+    self._printer = job_printer.JobPrinter(0, self._pool_count)
     self._input = None
     self._error_message = None
-    self._watchdogs = []
 
   @abc.abstractmethod
   def OnStart(self):
@@ -209,120 +499,381 @@ class ThreadPool(multiprocessing.Process):
   def _message_pump(self):
     pass
 
+  def OnFinished(self, err:str=None):
+    pass
+
+  def _on_failure(self, response:JobResponse) -> bool:
+    """Returns whether the pool can carry on after |response| failed."""
+    return False
+
+  def _final_error(self) -> str|None:
+    """The error for a pool that finished every job it could."""
+    return None
+
   def Start(self, data, threaded=True):
     self._input = data
-    self._create_watchdogs()
     if threaded:
       self.start()
     else:
       self.run()
 
   def run(self):
+    # Workers are started from whichever process runs the pool, so that
+    # threads belong to it, and processes inherit the graph from it.
+    self._create_watchdogs()
     self.OnStart()
     self._run_loop()
 
+  def _shared_jobs(self) -> List[GraphNode]:
+    """Jobs to hand to the watchdogs when they start, instead of by queue."""
+    return []
+
   def _create_watchdogs(self):
-    for i in range(self._pool_count):
-      watchdog = ThreadWatchdog(
-        watchdog_id = i,
-        debug_mode = self._debug,
-        job_input_queue = self._job_input_queue,
-        job_response_queue = self._job_response_queue)
-      watchdog.start()
-      self._watchdogs.append(watchdog)
+    if self._owns_watchdogs:
+      self._watchdogs.Start(self._initial_watchdogs, self._shared_jobs())
 
   def _kill_watchdogs(self):
-    for _ in range(self._pool_count):
-      self._job_input_queue.put(ThreadWatchdog.POISON)
-    self._job_input_queue.join()
-    for dog in self._watchdogs:
-      dog.kill()
+    if self._owns_watchdogs:
+      self._watchdogs.Stop()
+    else:
+      self._watchdogs.Drain()
+
+  def _finish(self, err:str=None):
+    self._kill_watchdogs()
+    self._printer.finished(err=err)
+    self.OnFinished(err)
 
   def _run_loop(self):
     while True:
       if self.IsFinished():
-        self._kill_watchdogs()
-        self._printer.finished()
+        self._finish(self._final_error())
         return
 
       if not self._message_pump():
-        continue
+        self._finish(self._error_message)
+        return
 
       response = self._job_response_queue.get()
       if not response:
-        self._kill_watchdogs()
-        self._printer.finished(err=Messages.EMPTY_RESPONSE)
+        self._finish(Messages.EMPTY_RESPONSE)
         return
 
       if response.level() == JobResponse.LEVEL.FATAL:
-        self._kill_watchdogs()
-        self._printer.finished(err=response.message())
-        return
+        if not self._on_failure(response):
+          self._finish(response.message())
+          return
+        continue
 
       if not self._on_reply(response):
-        self._kill_watchdogs()
-        self._printer.finished(err=self._error_message)
+        self._finish(self._error_message)
         return
 
 
 class DependentPool(ThreadPool):
-  def __init__(self, poolcount:int, debug:bool=False):
-    super().__init__(poolcount, debug)
+  def __init__(self, poolcount:int, debug:bool=False,
+               schedule:str=Schedule.FIFO,
+               estimator:Callable[[GraphNode], float]=None,
+               watchdogs:WatchdogSet=None,
+               observers:List[PoolObserver]=None,
+               capacity:pool_capacity.FixedCapacity=None,
+               failure_mode:str=FailureMode.FAIL_FAST,
+               executor:str|Callable=Executor.PROCESSES,
+               file_digester:Callable[[str], str]=None):
+    super().__init__(poolcount, debug, watchdogs, executor)
+    if schedule not in Schedule.ALL:
+      raise ValueError(f'Unknown schedule "{schedule}", expected one of '
+                       f'{", ".join(Schedule.ALL)}')
+    if failure_mode not in FailureMode.ALL:
+      raise ValueError(f'Unknown failure mode "{failure_mode}", expected one '
+                       f'of {", ".join(FailureMode.ALL)}')
+    self._schedule = schedule
+    self._failure_mode = failure_mode
+    self._capacity = capacity or pool_capacity.FixedCapacity(self._pool_count)
+    self._initial_watchdogs = self._capacity.InitialWorkers()
+    self._slots_in_flight = 0
+    # Digests of the jobs' common_files, each computed once for the build.
+    self._file_digester = file_digester
+    self._file_digests:Dict[str, str] = {}
+    self._estimator = estimator or (lambda _: DEFAULT_JOB_ESTIMATE)
+    self._observers = observers or []
+    # Estimated seconds of work not yet completed, only shown by the printer
+    # once the estimator has produced at least one real estimate.
+    self._show_remaining = False
+    self._remaining_work = 0.0
     self._pending_add = set()
     self._in_flight = set()
     self._completed = set()
 
+    # Every job the pool has dispatched, by index. The first |_shared_count|
+    # of them were handed to the watchdogs when they started, and are sent by
+    # index alone unless they have changed since (|_modified|).
+    self._jobs:List[GraphNode] = []
+    self._job_indices:Dict[GraphNode, int] = {}
+    self._shared_count = 0
+    self._modified:Set[GraphNode] = set()
+
+    # Jobs which failed, with their error, and jobs which were never run
+    # because of a failure, with the failed job responsible when known. Jobs
+    # already running when the build failed fast still finish, after it.
+    self._failed:Dict[GraphNode, str] = {}
+    self._skipped:Dict[GraphNode, GraphNode|None] = {}
+    self._finished_after_failure:Set[GraphNode] = set()
+
+    # Reverse dependency index: maps each node to the set of waiting nodes
+    # which still depend on it. |_known| is every node ever handed to the pool.
+    self._consumers:Dict[GraphNode, Set[GraphNode]] = {}
+    self._known:Set[GraphNode] = set()
+
+    # Critical path scheduling state. |_priorities| maps each node to the
+    # estimated length of the longest path from the start of that node to the
+    # end of the build. |_ready| is a heap of runnable nodes ordered by it, or
+    # just by readiness when scheduling FIFO.
+    self._priorities:Dict[GraphNode, float] = {}
+    self._ready = []
+    self._sequence = itertools.count()
+    self._predicted_time = 0.0
+    self._start_time = 0.0
+
+  def _shared_jobs(self) -> List[GraphNode]:
+    for node in self._input:
+      self._job_index(node)
+    self._shared_count = len(self._jobs)
+    return list(self._jobs)
+
+  def _job_index(self, node:GraphNode) -> int:
+    index = self._job_indices.get(node, None)
+    if index is None:
+      index = self._job_indices[node] = len(self._jobs)
+      self._jobs.append(node)
+    return index
+
+  def _digests_for(self, node:GraphNode) -> Dict[str, str]|None:
+    if self._file_digester is None:
+      return None
+    digests = {}
+    for filename in node.common_files():
+      if filename not in self._file_digests:
+        try:
+          self._file_digests[filename] = self._file_digester(filename)
+        except OSError:
+          # The job can find out what's wrong with it for itself.
+          continue
+      digests[filename] = self._file_digests[filename]
+    return digests or None
+
+  def _dispatch(self, node:GraphNode):
+    index = self._job_index(node)
+    digests = self._digests_for(node)
+    if index < self._shared_count and node not in self._modified:
+      self._job_input_queue.put(Job(index, None, digests))
+    else:
+      self._job_input_queue.put(Job(index, node, digests))
+
   def OnStart(self):
+    self._start_time = time.time()
     self._printer.add_job_count(len(self._input))
-    self._cycle_graph()
+    self._add_remaining_work(self._input)
+    if self._schedule == Schedule.CRITICAL_PATH:
+      self._priorities = self._compute_priorities(self._input)
+      self._predicted_time = self._predict_wall_time(self._input)
+    waiting, self._input = self._input, set()
+    for node in waiting:
+      self._index_node(node)
     self._add_nodes()
 
+  def OnFinished(self, err:str=None):
+    for observer in self._observers:
+      observer.PoolFinished(err)
+    if self._schedule == Schedule.CRITICAL_PATH and not err:
+      actual = time.time() - self._start_time
+      print(f'Critical path: predicted {self._predicted_time:.1f}s, '
+            f'actual {actual:.1f}s')
+    if self._failed:
+      for line in self.Summary():
+        print(line)
+
+  def _final_error(self) -> str|None:
+    if not self._failed:
+      return None
+    return f'{len(self._failed)} target(s) failed'
+
+  def _on_failure(self, response:JobResponse) -> bool:
+    node = self._jobs[response.index()]
+    response.resolve(node)
+    self._failed[node] = response.message()
+    for observer in self._observers:
+      observer.JobFailed(response)
+    if self._failure_mode != FailureMode.KEEP_GOING:
+      # Everything which hasn't started is cancelled, while whatever is still
+      # running gets waited for as the watchdogs stop.
+      self._finished_after_failure = self._in_flight - {node}
+      for cancelled in self._input | self._pending_add:
+        self._skipped.setdefault(cancelled, None)
+      for _, _, cancelled in self._ready:
+        self._skipped.setdefault(cancelled, None)
+      return False
+
+    self._printer.remove_task_msg(response.id())
+    self._in_flight.remove(node)
+    self._capacity.Finished(node)
+    self._slots_in_flight -= node.slots()
+    self._add_remaining_work({node}, sign=-1)
+    self._skip_consumers(node)
+    return True
+
+  def _skip_consumers(self, failed:GraphNode):
+    """Drops everything waiting, directly or not, on |failed|."""
+    frontier = [failed]
+    while frontier:
+      for consumer in self._consumers.pop(frontier.pop(), ()):
+        if consumer not in self._input:
+          continue
+        self._input.remove(consumer)
+        self._skipped[consumer] = failed
+        self._add_remaining_work({consumer}, sign=-1)
+        frontier.append(consumer)
+
+  def Summary(self) -> List[str]:
+    """Describes which targets failed, were skipped, and were built."""
+    lines = [f'{len(self._completed)} succeeded, {len(self._failed)} failed, '
+             f'{len(self._skipped)} skipped']
+    if self._finished_after_failure:
+      lines[0] += (f', {len(self._finished_after_failure)} '
+                   'finished after the failure')
+    for node, message in sorted(self._failed.items(),
+                                key=lambda f: f[0].get_name()):
+      first_line = (message or '').strip().split('\n')[0]
+      lines.append(f'  FAILED  {node.get_name()}: {first_line}')
+    for node in sorted(self._finished_after_failure,
+                       key=lambda n: n.get_name()):
+      lines.append(f'  LATE    {node.get_name()} (finished after the failure)')
+    skipped = sorted(self._skipped.items(), key=lambda s: s[0].get_name())
+    for node, cause in skipped[:SUMMARY_SKIPPED_LIMIT]:
+      reason = f'depends on {cause.get_name()}' if cause else 'cancelled'
+      lines.append(f'  SKIPPED {node.get_name()} ({reason})')
+    if len(skipped) > SUMMARY_SKIPPED_LIMIT:
+      lines.append(f'  ... and {len(skipped) - SUMMARY_SKIPPED_LIMIT} more')
+    return lines
+
+  def _add_remaining_work(self, nodes:Set[GraphNode], sign:int=1):
+    self._remaining_work += sign * sum(self._estimate(n) for n in nodes)
+    self._remaining_work = max(0.0, self._remaining_work)
+    if self._show_remaining:
+      self._printer.set_remaining_estimate(
+        self._remaining_work / self._pool_count)
+
+  def _estimate(self, node:GraphNode) -> float:
+    estimate = self._estimator(node)
+    if estimate is None:
+      return DEFAULT_JOB_ESTIMATE
+    self._show_remaining = True
+    return estimate
+
+  def _compute_priorities(self,
+                          nodes:Set[GraphNode]) -> Dict[GraphNode, float]:
+    """Computes the longest downstream path for each node in |nodes|."""
+    consumers:Dict[GraphNode, Set[GraphNode]] = {n:set() for n in nodes}
+    for node in nodes:
+      for dependency in node.dependencies:
+        consumers.setdefault(dependency, set()).add(node)
+
+    # Walk the graph from the final targets back down to the leaves, so that
+    # every consumer of a node has been assigned a priority before it is.
+    unvisited = {n:len(c) for n,c in consumers.items()}
+    frontier = [n for n,count in unvisited.items() if not count]
+    priorities:Dict[GraphNode, float] = {}
+    while frontier:
+      node = frontier.pop()
+      downstream = max((priorities[c] for c in consumers[node]), default=0.0)
+      priorities[node] = self._estimate(node) + downstream
+      for dependency in node.dependencies:
+        unvisited[dependency] -= 1
+        if not unvisited[dependency]:
+          frontier.append(dependency)
+    return priorities
+
+  def _predict_wall_time(self, nodes:Set[GraphNode]) -> float:
+    total = sum(self._estimate(n) for n in nodes)
+    longest = max(self._priorities.values(), default=0.0)
+    return max(longest, total / self._pool_count)
+
+  def _priority(self, node:GraphNode) -> float:
+    if self._schedule == Schedule.CRITICAL_PATH:
+      return self._priorities.get(node, self._estimate(node))
+    return 0.0
+
   def _add_nodes(self):
     for node in self._pending_add:
-      self._job_input_queue.put(node)
-    self._in_flight |= self._pending_add
+      heapq.heappush(self._ready, (
+        -self._priority(node), next(self._sequence), node))
     self._pending_add = set()
 
-  def _cycle_graph(self, remove_node:GraphNode=None):
-    newgraph:Set[GraphNode] = set()
-    for node in self._input:
-      if remove_node:
-        node.remaining_dependencies.discard(remove_node)
-      if node.remaining_dependencies:
-        newgraph.add(node)
+    # Jobs are only handed out once the capacity has room for them, although
+    # something always has to run, even if it is bigger than the whole pool.
+    while self._ready:
+      node = self._ready[0][2]
+      if self._in_flight and not self._capacity.Admit(
+          node, self._slots_in_flight):
+        break
+      heapq.heappop(self._ready)
+      self._capacity.Started(node)
+      self._slots_in_flight += node.slots()
+      self._in_flight.add(node)
+      self._dispatch(node)
+    if self._owns_watchdogs:
+      self._watchdogs.Grow(len(self._in_flight))
+
+  def _index_node(self, node:GraphNode):
+    """Registers |node| as a consumer of each dependency it is waiting on."""
+    self._known.add(node)
+    for dependency in list(node.remaining_dependencies):
+      if dependency in self._completed:
+        node.remaining_dependencies.discard(dependency)
       else:
-        self._pending_add.add(node)
-    self._input = newgraph
-
-  def _force_cycle_graph(self):
-    for job in self._input:
-      if not len(job.remaining_dependencies):
-        return True
-      for depends in job.remaining_dependencies:
-        if depends in self._completed:
-          job.remaining_dependencies.discard(depends)
-          return True
-    return False
+        self._consumers.setdefault(dependency, set()).add(node)
+    if node.remaining_dependencies:
+      self._input.add(node)
+    else:
+      self._pending_add.add(node)
+
+  def _release_consumers(self, completed:GraphNode):
+    """Only the direct consumers of |completed| can have become runnable."""
+    for consumer in self._consumers.pop(completed, ()):
+      consumer.remaining_dependencies.discard(completed)
+      if not consumer.remaining_dependencies and consumer in self._input:
+        self._input.remove(consumer)
+        self._pending_add.add(consumer)
 
   def _handle_good_status(self, status:JobResponse):
     self._in_flight.remove(status.job())
+    self._capacity.Finished(status.job())
+    self._slots_in_flight -= status.job().slots()
     self._completed.add(status.job())
     response = status.result()
-    discard_node = True
+    needs_rerun = False
     if response:
       if isinstance(response, UpdateGraphResponseData):
-        discard_node = not self._update_graph(status.job(), response)
-    if discard_node:
-      self._cycle_graph(status.job())
-    else:
-      self._cycle_graph()
+        needs_rerun = self._update_graph(status.job(), response)
+    if not needs_rerun:
+      self._release_consumers(status.job())
+      self._add_remaining_work({status.job()}, sign=-1)
 
   def _update_graph(self,
                     node_from:GraphNode,
                     results:UpdateGraphResponseData) -> bool:
-    results.added_graph -= self._completed
-    self._input |= results.added_graph
+    results.added_graph -= self._known
     self._printer.add_job_count(len(results.added_graph))
+    self._add_remaining_work(results.added_graph)
+
+    # Injected nodes must finish before |node_from| can, so they inherit its
+    # position on the critical path.
+    if self._schedule == Schedule.CRITICAL_PATH:
+      downstream = self._priorities.get(node_from, 0.0)
+      for added in results.added_graph:
+        self._priorities[added] = self._estimate(added) + downstream
+
+    for added in results.added_graph:
+      self._index_node(added)
 
     if results.rerun_more_deps:
       needs_rerun = False
@@ -332,36 +883,44 @@ class DependentPool(ThreadPool):
           node_from.dependencies.add(new_addition)
           needs_rerun = True
       if needs_rerun:
+        self._modified.add(node_from)
         self._completed.remove(node_from)
         node_from.data().execution_count += 1
-        self._input.add(node_from)
+        self._index_node(node_from)
       return needs_rerun
     return False
 
   def IsFinished(self):
     return ((not self._input) and
             (not self._pending_add) and
+            (not self._ready) and
             (not self._in_flight))
 
   def _message_pump(self):
     self._add_nodes()
-    return True
+    if self._in_flight:
+      return True
+    # Every state change comes from a response to some running job, so if
+    # nothing is running the waiting nodes can never become runnable.
+    waiting = sorted(n.get_name() for n in self._input)
+    self._error_message = Messages.STALLED.format(', '.join(waiting))
+    return False
 
   def _on_reply(self, response):
     if response.level() == JobResponse.LEVEL.WARNING:
-      if response.message() == Messages.TIMEOUT:
-        if self._force_cycle_graph():
-          self._cycle_graph()
-          self._add_nodes()
-          return True
       self._printer.write_task_msg(response.id(), response.message())
       return True
 
+    response.resolve(self._jobs[response.index()])
     if response.level() == JobResponse.LEVEL.GREEN:
+      for observer in self._observers:
+        observer.JobCompleted(response)
       self._printer.remove_task_msg(response.id())
       self._handle_good_status(response)
 
     if response.level() == JobResponse.LEVEL.YELLOW:
+      for observer in self._observers:
+        observer.JobStarted(response)
       self._printer.write_task_msg(response.id(), response.message())
 
     return True
@@ -378,7 +937,7 @@ class StreamingPool(ThreadPool):
     for _ in range(self._pool_count):
       try:
         self._sent_jobs += 1
-        self._job_input_queue.put(next(self._input))
+        self._job_input_queue.put(Job(self._sent_jobs, next(self._input)))
       except StopIteration:
         self._sent_jobs -= 1
         self._finished = True
@@ -402,7 +961,7 @@ class StreamingPool(ThreadPool):
   def _message_pump(self):
     try:
       self._sent_jobs += 1
-      self._job_input_queue.put(next(self._input))
+      self._job_input_queue.put(Job(self._sent_jobs, next(self._input)))
       return True
     except StopIteration:
       self._finished = True
@@ -0,0 +1,139 @@
+import pickle
+import random
+import time
+
+from impulse.args import args
+from impulse.core import debug
+from impulse.core import threading
+
+
+command = args.ArgumentParser(complete=True)
+
+
+class NoopNode(threading.GraphNode):
+  __slots__ = ('_index', '_payload')
+
+  def __init__(self, index, dependencies, payload=0):
+    super().__init__(dependencies, False)
+    self._index = index
+    # Stands in for the package and rule code a real target carries.
+    self._payload = bytes(payload)
+
+  def run_job(self, debug, internal_access=None):
+    pass
+
+  def __eq__(self, other):
+    return type(other) == NoopNode and other._index == self._index
+
+  def __hash__(self):
+    return self._index
+
+  def get_name(self):
+    return str(self._index)
+
+  def data(self):
+    return None
+
+
+class RecordingQueue(object):
+  """Stands in for the watchdog queue; nothing is ever actually run."""
+  def __init__(self):
+    self.dispatched = []
+
+  def put(self, job):
+    self.dispatched.append(job)
+
+
+def MakeGraph(nodes, fanin, seed, payload=0):
+  """A random DAG where each node depends on up to |fanin| earlier nodes."""
+  rng = random.Random(seed)
+  graph = []
+  for index in range(nodes):
+    count = min(index, rng.randint(0, fanin))
+    deps = set(graph[i] for i in rng.sample(range(index), count))
+    graph.append(NoopNode(index, deps, payload))
+  return set(graph)
+
+
+def DriveCoordinator(graph, poolcount, schedule):
+  """Completes every job as soon as it is dispatched, timing only the pool."""
+  pool = threading.DependentPool(poolcount, schedule=schedule)
+  queue = RecordingQueue()
+  pool._job_input_queue = queue
+  pool._input = graph
+  completed = 0
+  start = time.perf_counter()
+  pool.OnStart()
+  while not pool.IsFinished():
+    pool._message_pump()
+    dispatched, queue.dispatched = queue.dispatched, []
+    for job in dispatched:
+      pool._on_reply(threading.JobResponse(
+        threading.JobResponse.LEVEL.GREEN, 0, job.index))
+      completed += 1
+  return completed, time.perf_counter() - start
+
+
+def MeasurePickledBytes(graph, poolcount, shared):
+  """Bytes pickled sending each job and its reply through the queues.
+
+  Without |shared|, jobs are sent and returned whole, which is how every job
+  used to be sent.
+  """
+  pool = threading.DependentPool(poolcount)
+  queue = RecordingQueue()
+  pool._job_input_queue = queue
+  pool._input = graph
+  if shared:
+    pool._shared_jobs()
+  sent, returned, completed = 0, 0, 0
+  pool.OnStart()
+  while not pool.IsFinished():
+    pool._message_pump()
+    dispatched, queue.dispatched = queue.dispatched, []
+    for job in dispatched:
+      sent += len(pickle.dumps(job))
+      response = threading.JobResponse(
+        threading.JobResponse.LEVEL.GREEN, 0, job.index)
+      if not shared:
+        response.resolve(job.node)
+      returned += len(pickle.dumps(response))
+      pool._on_reply(response)
+      completed += 1
+  return sent / completed, returned / completed
+
+
+@command
+def run(nodes:str='10000,50000',
+        fanin:int=3,
+        threads:int=6,
+        schedule:str=threading.Schedule.FIFO,
+        seed:int=0):
+  """Measures DependentPool overhead per completed job on synthetic graphs."""
+  debug.EnableDebug()
+  for count in (int(n) for n in nodes.split(',')):
+    graph = MakeGraph(count, fanin, seed)
+    completed, elapsed = DriveCoordinator(graph, threads, schedule)
+    print(f'{count} nodes: {elapsed:.3f}s total, '
+          f'{elapsed / completed * 1e6:.1f}us per completed job')
+
+
+@command
+def payload(nodes:str='1000,5000',
+            fanin:int=3,
+            threads:int=6,
+            size:int=2048,
+            seed:int=0):
+  """Compares bytes pickled per job, sending whole nodes or indices."""
+  debug.EnableDebug()
+  for count in (int(n) for n in nodes.split(',')):
+    for shared in (False, True):
+      graph = MakeGraph(count, fanin, seed, size)
+      sent, returned = MeasurePickledBytes(graph, threads, shared)
+      mode = 'index' if shared else 'whole'
+      print(f'{count} nodes, {mode}: {sent:.0f} bytes sent, '
+            f'{returned:.0f} bytes returned per job')
+
+
+def main():
+  command.eval()
@@ -0,0 +1,447 @@
+import time
+
+from impulse.core import capacity
+from impulse.core import debug
+from impulse.core import threading
+from impulse.testing import unittest
+
+
+class FakeData(object):
+  def __init__(self):
+    self.execution_count = 0
+
+
+class FakeNode(threading.GraphNode):
+  def __init__(self, name, *dependencies, estimate=1.0, slots=1, files=()):
+    super().__init__(set(dependencies), False)
+    self._name = name
+    self._data = FakeData()
+    self.estimate = estimate
+    self._slots = slots
+    self._files = list(files)
+
+  def run_job(self, debug, internal_access=None):
+    pass
+
+  def __eq__(self, other):
+    return type(other) == FakeNode and other._name == self._name
+
+  def __hash__(self):
+    return hash(self._name)
+
+  def __repr__(self):
+    return self._name
+
+  def get_name(self):
+    return self._name
+
+  def data(self):
+    return self._data
+
+  def slots(self):
+    return self._slots
+
+  def common_files(self):
+    return self._files
+
+
+class FakeQueue(object):
+  def __init__(self, pool):
+    self.pool = pool
+    self.jobs = []
+    self.digests = []
+    self.sent_by_index = 0
+
+  def put(self, job):
+    if job.node is None:
+      self.sent_by_index += 1
+    self.jobs.append(self.pool._jobs[job.index])
+    self.digests.append(job.digests)
+
+
+class SleepingNode(threading.GraphNode):
+  """Runs for real on a watchdog, and asks for |late| on its first run."""
+  def __init__(self, name, *dependencies, late=None):
+    super().__init__(set(dependencies), late is not None)
+    self._name = name
+    self._data = FakeData()
+    self._late = late
+
+  def run_job(self, debug, internal_access=None):
+    time.sleep(0.1)
+    if internal_access and not self._data.execution_count:
+      internal_access.RerunWithDependency({self._late})
+
+  def __eq__(self, other):
+    return type(other) == SleepingNode and other._name == self._name
+
+  def __hash__(self):
+    return hash(self._name)
+
+  def __str__(self):
+    return self._name
+
+  def get_name(self):
+    return self._name
+
+  def data(self):
+    return self._data
+
+
+class Timeline(threading.PoolObserver):
+  def __init__(self):
+    self.events = []
+
+  def JobStarted(self, response):
+    self.events.append(('start', str(response.job()), response.timestamp()))
+
+  def JobCompleted(self, response):
+    self.events.append(('end', str(response.job()), response.timestamp()))
+
+
+def MakePool(graph, poolcount, schedule, capacity=None):
+  pool = threading.DependentPool(
+    poolcount, schedule=schedule, estimator=lambda node: node.estimate,
+    capacity=capacity)
+  pool._job_input_queue = FakeQueue(pool)
+  pool._input = set(graph)
+  return pool
+
+
+def Complete(pool, node, result=None):
+  pool._on_reply(threading.JobResponse(
+    threading.JobResponse.LEVEL.GREEN, 0, pool._job_indices[node],
+    result=result))
+  pool._message_pump()
+
+
+class CriticalPathScheduleTest(unittest.TestCase):
+  def setup(self):
+    debug.EnableDebug()
+
+  def cleanup(self):
+    debug.DisableDebug()
+
+  def test_LongestChainDispatchedFirst(self):
+    # |link| sits at the bottom of a long chain, while the |leaf| nodes are
+    # cheap and have nothing depending on them.
+    link = FakeNode('link', estimate=2.0)
+    compile = FakeNode('compile', link, estimate=10.0)
+    binary = FakeNode('binary', compile, estimate=5.0)
+    leaves = [FakeNode(f'leaf{i}') for i in range(4)]
+    pool = MakePool([link, compile, binary] + leaves, 1,
+                    threading.Schedule.CRITICAL_PATH)
+    pool.OnStart()
+    self.assertEqual(pool._job_input_queue.jobs, [link])
+    self.assertEqual(pool._priorities[link], 17.0)
+    self.assertEqual(pool._priorities[binary], 5.0)
+
+    Complete(pool, link)
+    self.assertEqual(pool._job_input_queue.jobs, [link, compile])
+
+  def test_OnlyFillsIdleWorkers(self):
+    nodes = [FakeNode(f'n{i}', estimate=i) for i in range(6)]
+    pool = MakePool(nodes, 2, threading.Schedule.CRITICAL_PATH)
+    pool.OnStart()
+    self.assertEqual(pool._job_input_queue.jobs, [nodes[5], nodes[4]])
+    Complete(pool, nodes[4])
+    self.assertEqual(pool._job_input_queue.jobs[-1], nodes[3])
+    self.assertFalse(pool.IsFinished())
+
+  def test_PredictedWallTime(self):
+    a = FakeNode('a', estimate=4.0)
+    b = FakeNode('b', a, estimate=4.0)
+    c = FakeNode('c', estimate=2.0)
+    pool = MakePool([a, b, c], 2, threading.Schedule.CRITICAL_PATH)
+    pool.OnStart()
+    self.assertEqual(pool._predicted_time, 8.0)
+
+  def test_FifoSendsInReadyOrder(self):
+    first = [FakeNode(f'first{i}') for i in range(2)]
+    second = [FakeNode(f'second{i}', *first) for i in range(2)]
+    last = FakeNode('last')
+    pool = MakePool(first + second + [last], 3, threading.Schedule.FIFO)
+    pool.OnStart()
+    self.assertEqual(len(pool._job_input_queue.jobs), 3)
+    self.assertEqual(set(pool._job_input_queue.jobs), set(first + [last]))
+    Complete(pool, first[0])
+    Complete(pool, first[1])
+    self.assertEqual(set(pool._job_input_queue.jobs[3:]), set(second))
+
+  def test_UnknownScheduleRejected(self):
+    with unittest.ExpectException(self, ValueError):
+      threading.DependentPool(1, schedule='random')
+
+
+def Fail(pool, node, message='broken'):
+  return pool._on_failure(threading.JobResponse(
+    threading.JobResponse.LEVEL.FATAL, 0, pool._job_indices[node],
+    message=message))
+
+
+class FailureModeTest(unittest.TestCase):
+  def setup(self):
+    debug.EnableDebug()
+
+  def cleanup(self):
+    debug.DisableDebug()
+
+  def MakeGraph(self):
+    self.flaky = FakeNode('flaky')
+    self.sibling = FakeNode('sibling')
+    self.middle = FakeNode('middle', self.flaky)
+    self.top = FakeNode('top', self.middle, self.sibling)
+    self.other = FakeNode('other', self.sibling)
+    return [self.flaky, self.sibling, self.middle, self.top, self.other]
+
+  def test_KeepGoingBuildsEverythingUnaffected(self):
+    pool = threading.DependentPool(
+      4, estimator=lambda node: node.estimate,
+      failure_mode=threading.FailureMode.KEEP_GOING)
+    pool._job_input_queue = FakeQueue(pool)
+    pool._input = set(self.MakeGraph())
+    pool.OnStart()
+    self.assertTrue(Fail(pool, self.flaky, 'flaky\ntraceback'))
+    self.assertEqual(pool._skipped, {
+      self.middle: self.flaky, self.top: self.flaky})
+    Complete(pool, self.sibling)
+    self.assertEqual(pool._job_input_queue.jobs[-1], self.other)
+    Complete(pool, self.other)
+    self.assertTrue(pool.IsFinished())
+    self.assertEqual(pool._final_error(), '1 target(s) failed')
+    self.assertEqual(pool.Summary(), [
+      '2 succeeded, 1 failed, 2 skipped',
+      '  FAILED  flaky: flaky',
+      '  SKIPPED middle (depends on flaky)',
+      '  SKIPPED top (depends on flaky)',
+    ])
+
+  def test_FailFastCancelsWhatHasntStarted(self):
+    pool = MakePool(self.MakeGraph(), 4, threading.Schedule.FIFO)
+    pool.OnStart()
+    self.assertFalse(Fail(pool, self.flaky))
+    # Already running, so it is left to finish.
+    self.assertEqual(pool._finished_after_failure, {self.sibling})
+    self.assertEqual(set(pool._skipped), {self.middle, self.top, self.other})
+    self.assertEqual(pool.Summary(), [
+      '0 succeeded, 1 failed, 3 skipped, 1 finished after the failure',
+      '  FAILED  flaky: broken',
+      '  LATE    sibling (finished after the failure)',
+      '  SKIPPED middle (cancelled)',
+      '  SKIPPED other (cancelled)',
+      '  SKIPPED top (cancelled)',
+    ])
+
+  def test_UnknownFailureModeRejected(self):
+    with unittest.ExpectException(self, ValueError):
+      threading.DependentPool(1, failure_mode='sometimes')
+
+
+class FakeSystem(object):
+  def __init__(self, load, available):
+    self.load = load
+    self.available = available
+
+  def LoadAverage(self):
+    return self.load
+
+  def AvailableMemory(self):
+    return self.available
+
+
+class CapacityTest(unittest.TestCase):
+  def test_HeavyJobsTakeMultipleSlots(self):
+    link = FakeNode('link', estimate=10.0, slots=3)
+    compiles = [FakeNode(f'cc{i}') for i in range(3)]
+    pool = MakePool(compiles + [link], 4, threading.Schedule.CRITICAL_PATH)
+    pool.OnStart()
+    # |link| is first in line, leaving one slot for a single compile.
+    self.assertEqual(len(pool._job_input_queue.jobs), 2)
+    self.assertEqual(pool._slots_in_flight, 4)
+    Complete(pool, link)
+    self.assertEqual(len(pool._job_input_queue.jobs), 4)
+
+  def test_OversizedJobRunsAlone(self):
+    huge = FakeNode('huge', slots=8)
+    pool = MakePool([huge], 2, threading.Schedule.FIFO)
+    pool.OnStart()
+    self.assertEqual(pool._job_input_queue.jobs, [huge])
+
+  def test_AdaptiveBacksOffUnderLoad(self):
+    system = FakeSystem(load=6.0, available=64 << 30)
+    adaptive = capacity.AdaptiveCapacity(8, system=system)
+    # Two of the six runnable processes are ours, the rest is someone else.
+    self.assertEqual(adaptive.CpuSlots(2), 4)
+    self.assertTrue(adaptive.Admit(FakeNode('compile'), 2))
+    self.assertFalse(adaptive.Admit(FakeNode('link', slots=3), 2))
+    system.load = 0.0
+    self.assertEqual(adaptive.CpuSlots(0), 8)
+
+  def test_AdaptiveReservesMemoryHints(self):
+    system = FakeSystem(load=0.0, available=5 << 30)
+    adaptive = capacity.AdaptiveCapacity(
+      8, memory_hint=lambda node: node.estimate * (1 << 30), system=system)
+    links = [FakeNode(f'link{i}', estimate=2) for i in range(4)]
+    pool = MakePool(links, 8, threading.Schedule.FIFO, capacity=adaptive)
+    pool.OnStart()
+    # Only two 2GiB jobs fit in 5GiB.
+    self.assertEqual(len(pool._job_input_queue.jobs), 2)
+    Complete(pool, pool._job_input_queue.jobs[0])
+    self.assertEqual(len(pool._job_input_queue.jobs), 3)
+
+
+class ReadySetTest(unittest.TestCase):
+  def setup(self):
+    debug.EnableDebug()
+
+  def cleanup(self):
+    debug.DisableDebug()
+
+  def test_CompletionReleasesOnlyConsumers(self):
+    base = FakeNode('base')
+    other = FakeNode('other')
+    left = FakeNode('left', base)
+    right = FakeNode('right', base, other)
+    pool = MakePool([base, other, left, right], 4, threading.Schedule.FIFO)
+    pool.OnStart()
+    self.assertEqual(set(pool._job_input_queue.jobs), {base, other})
+    self.assertEqual(pool._consumers[base], {left, right})
+
+    Complete(pool, base)
+    self.assertEqual(pool._job_input_queue.jobs[-1], left)
+    self.assertEqual(pool._input, {right})
+    self.assertFalse(base in pool._consumers)
+
+    Complete(pool, other)
+    self.assertEqual(pool._job_input_queue.jobs[-1], right)
+    Complete(pool, left)
+    Complete(pool, right)
+    self.assertTrue(pool.IsFinished())
+
+  def test_RerunWithDependency(self):
+    late = FakeNode('late')
+    node = FakeNode('node')
+    consumer = FakeNode('consumer', node)
+    pool = MakePool([node, consumer], 2, threading.Schedule.FIFO)
+    pool.OnStart()
+
+    rerun = threading.UpdateGraphResponseData()
+    rerun.RerunWithDependency({late})
+    Complete(pool, node, rerun)
+    self.assertEqual(pool._job_input_queue.jobs, [node, late])
+    self.assertEqual(pool._input, {node, consumer})
+    self.assertEqual(node.data().execution_count, 1)
+
+    Complete(pool, late)
+    self.assertEqual(pool._job_input_queue.jobs[-1], node)
+    Complete(pool, node)
+    self.assertEqual(pool._job_input_queue.jobs[-1], consumer)
+    Complete(pool, consumer)
+    self.assertTrue(pool.IsFinished())
+
+  def test_InjectedNodeAlreadyRunningIsNotDuplicated(self):
+    first = FakeNode('first')
+    second = FakeNode('second')
+    pool = MakePool([first, second], 2, threading.Schedule.FIFO)
+    pool.OnStart()
+
+    injected = threading.UpdateGraphResponseData()
+    injected.InjectMoreGraph({second})
+    Complete(pool, first, injected)
+    self.assertEqual(len(pool._job_input_queue.jobs), 2)
+
+  def test_SharedJobsSentByIndex(self):
+    late = FakeNode('late')
+    node = FakeNode('node')
+    consumer = FakeNode('consumer', node)
+    pool = MakePool([node, consumer], 2, threading.Schedule.FIFO)
+    self.assertEqual(len(pool._shared_jobs()), 2)
+    pool.OnStart()
+
+    rerun = threading.UpdateGraphResponseData()
+    rerun.RerunWithDependency({late})
+    Complete(pool, node, rerun)
+    Complete(pool, late)
+    Complete(pool, node)
+    # |late| is new and |node| changed when it asked for it, so both of those
+    # had to be sent in full, only the first run of |node| and |consumer|
+    # could go by index.
+    self.assertEqual(pool._job_input_queue.jobs, [node, late, node, consumer])
+    self.assertEqual(pool._job_input_queue.sent_by_index, 2)
+
+  def test_CommonFilesDigestedOncePerBuild(self):
+    digested = []
+    def digester(filename):
+      digested.append(filename)
+      if filename == 'missing':
+        raise FileNotFoundError(filename)
+      return f'#{filename}'
+    one = FakeNode('one', files=['rules.py', 'a/BUILD'])
+    two = FakeNode('two', files=['rules.py', 'a/BUILD'])
+    three = FakeNode('three', one, two, files=['rules.py', 'missing'])
+    pool = MakePool([one, two, three], 2, threading.Schedule.FIFO)
+    pool._file_digester = digester
+    pool.OnStart()
+    Complete(pool, one)
+    Complete(pool, two)
+
+    self.assertEqual(sorted(digested), ['a/BUILD', 'missing', 'rules.py'])
+    self.assertEqual(pool._job_input_queue.digests[-1],
+                     {'rules.py': '#rules.py'})
+    self.assertEqual(pool._job_input_queue.digests[0],
+                     {'rules.py': '#rules.py', 'a/BUILD': '#a/BUILD'})
+
+  def test_StalledGraphFailsInsteadOfWaiting(self):
+    missing = FakeNode('missing')
+    stuck = FakeNode('stuck', missing)
+    pool = MakePool([stuck], 2, threading.Schedule.FIFO)
+    pool.OnStart()
+    self.assertFalse(pool._message_pump())
+    self.assertEqual(pool._error_message,
+                     threading.Messages.STALLED.format('stuck'))
+
+
+class EventDrivenTest(unittest.TestCase):
+  def setup(self):
+    debug.EnableDebug()
+
+  def cleanup(self):
+    debug.DisableDebug()
+
+  def test_RerunWithDependencyHasNoIdleGaps(self):
+    late = SleepingNode('late')
+    node = SleepingNode('node', late=late)
+    consumer = SleepingNode('consumer', node)
+    timeline = Timeline()
+    pool = threading.DependentPool(2, observers=[timeline])
+    pool.Start({node, consumer}, threaded=False)
+
+    self.assertEqual([(kind, name) for kind, name, _ in timeline.events], [
+      ('start', 'node'), ('end', 'node'),
+      ('start', 'late'), ('end', 'late'),
+      ('start', 'node'), ('end', 'node'),
+      ('start', 'consumer'), ('end', 'consumer'),
+    ])
+    # Each job only takes 100ms, so the whole chain should take well under a
+    # second, and every job should start as soon as the last one finished.
+    for (_, _, ended), (_, _, started) in zip(timeline.events[1::2],
+                                              timeline.events[2::2]):
+      self.assertTrue(started - ended < 0.05)
+    elapsed = timeline.events[-1][2] - timeline.events[0][2]
+    self.assertTrue(elapsed < 1.0)
+
+  def test_ThreadExecutorRunsTheSameGraph(self):
+    late = SleepingNode('late')
+    node = SleepingNode('node', late=late)
+    consumer = SleepingNode('consumer', node)
+    timeline = Timeline()
+    pool = threading.DependentPool(
+      2, observers=[timeline], executor=threading.Executor.THREADS)
+    pool.Start({node, consumer}, threaded=False)
+
+    self.assertEqual([(kind, name) for kind, name, _ in timeline.events], [
+      ('start', 'node'), ('end', 'node'),
+      ('start', 'late'), ('end', 'late'),
+      ('start', 'node'), ('end', 'node'),
+      ('start', 'consumer'), ('end', 'consumer'),
+    ])
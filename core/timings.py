@@ -0,0 +1,224 @@
+import collections
+import contextlib
+import hashlib
+import os
+import sqlite3
+import time
+import typing
+
+from impulse.core import threading
+
+
+class Phase(object):
+  NEEDS_BUILD = 'needs_build'
+  LOAD_DEPS = 'load_deps'
+  MOUNT = 'mount'
+  HASH_INPUTS = 'hash_inputs'
+  RULE = 'rule'
+  EXPORT = 'export'
+  ALL = (NEEDS_BUILD, LOAD_DEPS, MOUNT, HASH_INPUTS, RULE, EXPORT)
+
+
+# How many of the most recent builds of a target are used for its estimate.
+ESTIMATE_WINDOW = 20
+
+# Columns added to the runs table after it was first created, which older
+# databases get when they're opened.
+ADDED_COLUMNS = {
+  'peak_memory': 'INTEGER',
+}
+
+
+class PhaseTimer(object):
+  """Records wall clock spans for the phases of a single job.
+
+  Subprocesses run by the rule are kept separately in |commands|, since they
+  nest inside the rule phase and shouldn't count towards its duration twice.
+  """
+  __slots__ = ('spans', 'commands', 'peak_memory')
+
+  def __init__(self):
+    self.spans:typing.List[typing.Tuple[str, float, float]] = []
+    self.commands:typing.List[typing.Tuple[str, float, float]] = []
+    self.peak_memory:int|None = None
+
+  @contextlib.contextmanager
+  def Measure(self, phase:str):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.spans.append((phase, start, time.time()))
+
+  @contextlib.contextmanager
+  def MeasureCommand(self, command:str):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.commands.append((command, start, time.time()))
+
+  def RecordMemory(self, peak:int):
+    self.peak_memory = max(peak, self.peak_memory or 0)
+
+  def Durations(self) -> typing.Dict[str, float]:
+    durations = collections.defaultdict(float)
+    for phase, start, end in self.spans:
+      durations[phase] += end - start
+    return dict(durations)
+
+  def Ran(self, phase:str) -> bool:
+    return any(p == phase for p, _, _ in self.spans)
+
+
+class JobReport(object):
+  """What a finished build job sends back to the pool about itself."""
+  __slots__ = ('timer', 'input_hash')
+
+  def __init__(self, timer:PhaseTimer|None, input_hash:str|None):
+    self.timer = timer
+    self.input_hash = input_hash
+
+
+def Percentile(values:typing.List[float], percent:float) -> float:
+  """Nearest-rank percentile of |values|."""
+  ordered = sorted(values)
+  rank = max(0, int(round(percent / 100 * len(ordered))) - 1)
+  return ordered[min(rank, len(ordered) - 1)]
+
+
+def InputHash(files:typing.Iterable[typing.Any]) -> str:
+  """Combines a set of HashedFiles into one digest."""
+  digest = hashlib.md5()
+  for f in sorted(files, key=lambda f: f.file):
+    digest.update(f'{f.file}//{f.hash}\n'.encode())
+  return digest.hexdigest()
+
+
+class TimingDatabase(threading.PoolObserver):
+  """Per-target job durations, persisted to a sqlite file under GENERATED/.
+
+  The pool runs on a forked process, so the connection is only opened the
+  first time it is needed, on whichever process needs it.
+  """
+  SCHEMA = f'''
+    CREATE TABLE IF NOT EXISTS runs (
+      target TEXT NOT NULL,
+      ruletype TEXT NOT NULL,
+      input_hash TEXT,
+      recorded REAL NOT NULL,
+      built INTEGER NOT NULL,
+      total REAL NOT NULL,
+      {", ".join(f"{p} REAL" for p in Phase.ALL)},
+      {", ".join(f"{c} {t}" for c, t in ADDED_COLUMNS.items())}
+    );
+    CREATE INDEX IF NOT EXISTS runs_by_target ON runs (target, recorded);
+    CREATE INDEX IF NOT EXISTS runs_by_ruletype ON runs (ruletype, recorded);
+  '''
+
+  def __init__(self, filename:str):
+    self._filename = filename
+    self._connection = None
+    self._pending = []
+    self.Reload()
+
+  def _Connect(self) -> sqlite3.Connection:
+    if self._connection is None:
+      os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+      self._connection = sqlite3.connect(self._filename)
+      self._connection.executescript(TimingDatabase.SCHEMA)
+      columns = {row[1] for row in
+                 self._connection.execute('PRAGMA table_info(runs)')}
+      for column, kind in ADDED_COLUMNS.items():
+        if column not in columns:
+          self._connection.execute(
+            f'ALTER TABLE runs ADD COLUMN {column} {kind}')
+    return self._connection
+
+  def Record(self, target:str, ruletype:str, input_hash:str|None,
+             timer:PhaseTimer):
+    durations = timer.Durations()
+    self._pending.append((
+      target, ruletype, input_hash, time.time(), timer.Ran(Phase.RULE),
+      sum(durations.values()), *(durations.get(p) for p in Phase.ALL),
+      timer.peak_memory))
+
+  def Flush(self):
+    if not self._pending:
+      return
+    with self._Connect() as connection:
+      connection.executemany(
+        f'INSERT INTO runs VALUES '
+        f'({", ".join("?" * (6 + len(Phase.ALL) + len(ADDED_COLUMNS)))})',
+        self._pending)
+    self._pending = []
+    self.Reload()
+
+  def Reload(self):
+    """Drops the estimates and hints, so they're read again when next used."""
+    self._target_estimates = None
+    self._ruletype_estimates = None
+    self._memory_hints = None
+
+  def _Durations(self, column:str) -> typing.Dict[str, typing.List[float]]:
+    """Recent durations of builds that ran their rule, grouped by |column|."""
+    result = collections.defaultdict(list)
+    rows = self._Connect().execute(
+      f'SELECT {column}, total FROM runs WHERE built ORDER BY recorded DESC')
+    for key, total in rows:
+      if len(result[key]) < ESTIMATE_WINDOW:
+        result[key].append(total)
+    return result
+
+  def Estimate(self, node:threading.GraphNode) -> float|None:
+    """The median duration of recent builds of |node|, or of its rule type."""
+    if self._target_estimates is None:
+      self._target_estimates = {
+        k:Percentile(v, 50) for k,v in self._Durations('target').items()}
+      self._ruletype_estimates = {
+        k:Percentile(v, 50) for k,v in self._Durations('ruletype').items()}
+    estimate = self._target_estimates.get(node.get_name(), None)
+    if estimate is None:
+      ruletype = str(node.data().package_ruletype)
+      estimate = self._ruletype_estimates.get(ruletype, None)
+    return estimate
+
+  def MemoryHint(self, node:threading.GraphNode) -> int|None:
+    """The p95 peak memory, in bytes, of recent builds of |node|'s rule type."""
+    if self._memory_hints is None:
+      result = collections.defaultdict(list)
+      rows = self._Connect().execute(
+        'SELECT ruletype, peak_memory FROM runs WHERE peak_memory IS NOT NULL '
+        'ORDER BY recorded DESC')
+      for ruletype, peak in rows:
+        if len(result[ruletype]) < ESTIMATE_WINDOW:
+          result[ruletype].append(peak)
+      self._memory_hints = {k:Percentile(v, 95) for k,v in result.items()}
+    return self._memory_hints.get(str(node.data().package_ruletype), None)
+
+  def Summarize(self, column:str) -> typing.Iterator[tuple]:
+    """Yields (key, runs, p50, p95) for builds grouped by |column|."""
+    result = collections.defaultdict(list)
+    rows = self._Connect().execute(f'SELECT {column}, total FROM runs '
+                                   'WHERE built ORDER BY recorded DESC')
+    for key, total in rows:
+      result[key].append(total)
+    for key in sorted(result):
+      durations = result[key]
+      yield (key, len(durations),
+             Percentile(durations, 50), Percentile(durations, 95))
+
+  def JobCompleted(self, response:threading.JobResponse):
+    result = response.result()
+    if isinstance(result, threading.UpdateGraphResponseData):
+      if result.rerun_more_deps:
+        return
+    report = response.report()
+    if not isinstance(report, JobReport) or report.timer is None:
+      return
+    node = response.job()
+    self.Record(node.get_name(), str(node.data().package_ruletype),
+                report.input_hash, report.timer)
+
+  def PoolFinished(self, err:str=None):
+    self.Flush()
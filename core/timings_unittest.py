@@ -0,0 +1,149 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from impulse.core import threading
+from impulse.core import timings
+from impulse.testing import unittest
+
+
+# The runs table as it was before peak_memory was added.
+OLD_SCHEMA = f'''
+  CREATE TABLE runs (
+    target TEXT NOT NULL,
+    ruletype TEXT NOT NULL,
+    input_hash TEXT,
+    recorded REAL NOT NULL,
+    built INTEGER NOT NULL,
+    total REAL NOT NULL,
+    {", ".join(f"{p} REAL" for p in timings.Phase.ALL)}
+  );
+'''
+
+
+class FakePackage(object):
+  def __init__(self, ruletype):
+    self.package_ruletype = ruletype
+
+
+class FakeNode(threading.GraphNode):
+  def __init__(self, name, ruletype):
+    super().__init__(set(), False)
+    self._name = name
+    self._package = FakePackage(ruletype)
+
+  def run_job(self, debug, internal_access=None):
+    pass
+
+  def __hash__(self):
+    return hash(self._name)
+
+  def get_name(self):
+    return self._name
+
+  def data(self):
+    return self._package
+
+
+def Timer(rule:float|None, memory:int|None=None) -> timings.PhaseTimer:
+  """A job which took a second to load, and |rule| seconds to build if any."""
+  timer = timings.PhaseTimer()
+  timer.spans.append((timings.Phase.LOAD_DEPS, 0, 1))
+  if rule is not None:
+    timer.spans.append((timings.Phase.RULE, 1, 1 + rule))
+  if memory is not None:
+    timer.RecordMemory(memory)
+  return timer
+
+
+class TimingDatabaseTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'GENERATED', 'timings.db')
+
+  def cleanup(self):
+    shutil.rmtree(self.directory)
+
+  def Database(self, *runs):
+    """Records |runs| of (target, ruletype, timer), then opens them again."""
+    database = timings.TimingDatabase(self.filename)
+    for target, ruletype, timer in runs:
+      database.Record(target, ruletype, None, timer)
+    database.PoolFinished()
+    return timings.TimingDatabase(self.filename)
+
+  def test_EstimatesFromBuiltRuns(self):
+    database = self.Database(
+      ('//a:a', 'cc_object', Timer(1)),
+      ('//a:a', 'cc_object', Timer(3)),
+      ('//a:a', 'cc_object', Timer(5)),
+      ('//a:a', 'cc_object', Timer(None)),
+      ('//b:b', 'cc_object', Timer(9)))
+    # Runs which didn't build don't count towards the estimate.
+    self.assertEqual(database.Estimate(FakeNode('//a:a', 'cc_object')), 4)
+    # Unknown targets are estimated from their rule type.
+    self.assertEqual(database.Estimate(FakeNode('//c:c', 'cc_object')), 4)
+    self.assertEqual(database.Estimate(FakeNode('//b:b', 'cc_object')), 10)
+    self.assertEqual(database.Estimate(FakeNode('//d:d', 'py_library')), None)
+
+  def test_EstimatesFromRecentRuns(self):
+    runs = [('//a:a', 'cc_object', Timer(100))]
+    runs += [('//a:a', 'cc_object', Timer(1))] * timings.ESTIMATE_WINDOW
+    database = self.Database(*runs)
+    self.assertEqual(database.Estimate(FakeNode('//a:a', 'cc_object')), 2)
+
+  def test_EstimatesFromLaterBuilds(self):
+    database = self.Database(('//a:a', 'cc_object', Timer(1)))
+    node = FakeNode('//a:a', 'cc_object')
+    self.assertEqual(database.Estimate(node), 2)
+    self.assertEqual(database.MemoryHint(node), None)
+    # A long running database, like the build server's, learns from its own
+    # builds once they're flushed.
+    database.Record('//a:a', 'cc_object', None, Timer(5, 7))
+    database.Record('//a:a', 'cc_object', None, Timer(5, 7))
+    database.PoolFinished()
+    self.assertEqual(database.Estimate(node), 6)
+    self.assertEqual(database.MemoryHint(node), 7)
+    # And from anyone else's once it's reloaded.
+    self.Database(*[('//a:a', 'cc_object', Timer(9))] * 5)
+    self.assertEqual(database.Estimate(node), 6)
+    database.Reload()
+    self.assertEqual(database.Estimate(node), 10)
+
+  def test_HintsMemoryByRuleType(self):
+    runs = [('//a:a', 'cc_object', Timer(1, memory))
+            for memory in range(1, 21)]
+    database = self.Database(*runs, ('//b:b', 'cc_object', Timer(1)))
+    self.assertEqual(database.MemoryHint(FakeNode('//c:c', 'cc_object')), 19)
+    self.assertEqual(
+      database.MemoryHint(FakeNode('//c:c', 'py_library')), None)
+
+  def test_Summarizes(self):
+    database = self.Database(
+      ('//a:a', 'cc_object', Timer(1)),
+      ('//a:a', 'cc_object', Timer(3)),
+      ('//b:b', 'py_library', Timer(2)),
+      ('//b:b', 'py_library', Timer(None)))
+    self.assertEqual(list(database.Summarize('target')), [
+      ('//a:a', 2, 2, 4),
+      ('//b:b', 1, 3, 3),
+    ])
+    self.assertEqual(list(database.Summarize('ruletype')), [
+      ('cc_object', 2, 2, 4),
+      ('py_library', 1, 3, 3),
+    ])
+
+  def test_AddsColumnsToOldDatabases(self):
+    os.makedirs(os.path.dirname(self.filename))
+    with sqlite3.connect(self.filename) as connection:
+      connection.executescript(OLD_SCHEMA)
+      connection.execute(
+        f'INSERT INTO runs VALUES '
+        f'({", ".join("?" * (6 + len(timings.Phase.ALL)))})',
+        ('//a:a', 'cc_object', None, 0, 1, 5,
+         *([None] * len(timings.Phase.ALL))))
+    connection.close()
+    database = self.Database(('//a:a', 'cc_object', Timer(1, 100)))
+    self.assertEqual(list(database.Summarize('target')), [('//a:a', 2, 2, 5)])
+    self.assertEqual(database.MemoryHint(FakeNode('//a:a', 'cc_object')), 100)
@@ -0,0 +1,139 @@
+"""Chrome trace-event export of a build, viewable in Perfetto or about:tracing.
+
+Every watchdog gets its own track. Jobs are drawn as spans on the track of the
+watchdog that ran them, with their phases and subprocesses nested inside, and
+flow arrows connect each job to the jobs that were waiting on it.
+"""
+
+import json
+import os
+import typing
+
+from impulse.core import threading
+
+
+# All timestamps are in microseconds in the trace event format.
+def _Micros(seconds:float) -> int:
+  return int(seconds * 1000000)
+
+
+def _CommandName(command:str) -> str:
+  """The program a command runs, skipping leading environment assignments."""
+  for word in command.split():
+    if '=' not in word:
+      return os.path.basename(word)
+  return 'exec'
+
+
+class ChromeTrace(threading.PoolObserver):
+  """Collects job timings from pool responses and writes them as a trace."""
+  PID = 1
+
+  def __init__(self, filename:str):
+    self._filename = filename
+    self._events:typing.List[dict] = []
+    self._tracks:typing.Set[int] = set()
+    self._started:typing.Dict[str, typing.Tuple[int, float]] = {}
+    # The track and end time of the last completed run of each job, which is
+    # where flow arrows to its consumers begin.
+    self._finished:typing.Dict[str, typing.Tuple[int, float]] = {}
+    self._flow_ids = 0
+
+  def _Span(self, name:str, category:str, track:int,
+            start:float, end:float, args:dict=None):
+    event = {
+      'name': name,
+      'cat': category,
+      'ph': 'X',
+      'pid': ChromeTrace.PID,
+      'tid': track,
+      'ts': _Micros(start),
+      'dur': max(1, _Micros(end) - _Micros(start)),
+    }
+    if args:
+      event['args'] = args
+    self._events.append(event)
+
+  def _Flow(self, source:typing.Tuple[int, float],
+            target:typing.Tuple[int, float], name:str):
+    self._flow_ids += 1
+    for phase, (track, timestamp) in (('s', source), ('f', target)):
+      event = {
+        'name': name,
+        'cat': 'dependency',
+        'ph': phase,
+        'id': self._flow_ids,
+        'pid': ChromeTrace.PID,
+        'tid': track,
+        'ts': _Micros(timestamp),
+      }
+      if phase == 'f':
+        event['bp'] = 'e'
+      self._events.append(event)
+
+  def JobStarted(self, response:threading.JobResponse):
+    self._started[response.job().get_name()] = (
+      response.id(), response.timestamp())
+
+  def JobCompleted(self, response:threading.JobResponse):
+    job = response.job()
+    name = job.get_name()
+    track, start = self._started.pop(name, (response.id(), None))
+    if start is None:
+      return
+    end = response.timestamp()
+    self._tracks.add(track)
+
+    rerun = False
+    result = response.result()
+    if isinstance(result, threading.UpdateGraphResponseData):
+      rerun = result.rerun_more_deps
+    self._Span(name, 'job', track, start, end, {'rerun': rerun})
+
+    timer = getattr(response.report(), 'timer', None)
+    if timer is not None:
+      for phase, phase_start, phase_end in timer.spans:
+        self._Span(phase, 'phase', track, phase_start, phase_end)
+      for command, command_start, command_end in timer.commands:
+        self._Span(_CommandName(command), 'exec', track,
+                   command_start, command_end, {'command': command})
+
+    for dependency in job.dependencies:
+      source = self._finished.get(dependency.get_name(), None)
+      if source is not None:
+        self._Flow(source, (track, start), dependency.get_name())
+    if not rerun:
+      self._finished[name] = (track, end)
+
+  def JobFailed(self, response:threading.JobResponse):
+    name = response.job().get_name()
+    track, start = self._started.pop(name, (response.id(), None))
+    if start is None:
+      return
+    self._tracks.add(track)
+    self._Span(name, 'job', track, start, response.timestamp(),
+               {'failed': True, 'error': response.message()})
+
+  def _TrackNames(self) -> typing.Iterator[dict]:
+    yield {
+      'name': 'process_name', 'ph': 'M', 'pid': ChromeTrace.PID,
+      'args': {'name': 'impulse'},
+    }
+    for track in sorted(self._tracks):
+      yield {
+        'name': 'thread_name', 'ph': 'M', 'pid': ChromeTrace.PID,
+        'tid': track, 'args': {'name': f'Watchdog#{track}'},
+      }
+
+  def Write(self):
+    directory = os.path.dirname(self._filename)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    with open(self._filename, 'w') as f:
+      json.dump({
+        'traceEvents': list(self._TrackNames()) + self._events,
+        'displayTimeUnit': 'ms',
+      }, f)
+
+  def PoolFinished(self, err:str=None):
+    self.Write()
@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+
+from impulse.core import threading
+from impulse.core import timings
+from impulse.core import trace
+from impulse.testing import unittest
+
+
+class FakeNode(threading.GraphNode):
+  def __init__(self, name, *dependencies):
+    super().__init__(set(dependencies), False)
+    self._name = name
+    self._timer = timings.PhaseTimer()
+
+  def run_job(self, debug, internal_access=None):
+    pass
+
+  def __hash__(self):
+    return hash(self._name)
+
+  def get_name(self):
+    return self._name
+
+
+def Response(level, watchdog, node, timestamp):
+  response = threading.JobResponse(
+    level, watchdog, 0, report=timings.JobReport(node._timer, None))
+  response.resolve(node)
+  response._timestamp = timestamp
+  return response
+
+
+class ChromeTraceTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'trace.json')
+
+  def cleanup(self):
+    if os.path.exists(self.filename):
+      os.unlink(self.filename)
+    os.rmdir(self.directory)
+
+  def Run(self, *responses):
+    tracer = trace.ChromeTrace(self.filename)
+    for response in responses:
+      if response.level() == threading.JobResponse.LEVEL.YELLOW:
+        tracer.JobStarted(response)
+      else:
+        tracer.JobCompleted(response)
+    tracer.PoolFinished()
+    with open(self.filename) as f:
+      return json.load(f)['traceEvents']
+
+  def test_TracksPhasesAndFlows(self):
+    YELLOW = threading.JobResponse.LEVEL.YELLOW
+    GREEN = threading.JobResponse.LEVEL.GREEN
+    lib = FakeNode('//a:lib')
+    lib._timer.spans.append((timings.Phase.RULE, 1.5, 2.0))
+    lib._timer.commands.append(('CC=gcc /usr/bin/gcc -c a.c', 1.6, 1.9))
+    binary = FakeNode('//a:bin', lib)
+    events = self.Run(
+      Response(YELLOW, 0, lib, 1.0),
+      Response(GREEN, 0, lib, 2.0),
+      Response(YELLOW, 3, binary, 2.5),
+      Response(GREEN, 3, binary, 4.0))
+
+    tracks = {e['tid']: e['args']['name'] for e in events
+              if e['name'] == 'thread_name'}
+    self.assertEqual(tracks, {0: 'Watchdog#0', 3: 'Watchdog#3'})
+
+    spans = {e['name']: e for e in events if e['ph'] == 'X'}
+    self.assertEqual(spans['//a:lib']['ts'], 1000000)
+    self.assertEqual(spans['//a:lib']['dur'], 1000000)
+    self.assertEqual(spans['//a:bin']['tid'], 3)
+    self.assertEqual(spans[timings.Phase.RULE]['cat'], 'phase')
+    self.assertEqual(spans['gcc']['cat'], 'exec')
+
+    flow = [e for e in events if e['ph'] in ('s', 'f')]
+    self.assertEqual([(e['ph'], e['tid'], e['ts']) for e in flow],
+                     [('s', 0, 2000000), ('f', 3, 2500000)])
+    self.assertEqual(flow[0]['id'], flow[1]['id'])
@@ -3,20 +3,36 @@
 import json
 import glob
 import os
+import tempfile
+import time
 import typing
 
+from impulse import build_server
 from impulse import impulse_paths
 from impulse import recursive_loader
 from impulse.args import args
+from impulse.core import capacity
 from impulse.core import debug
 from impulse.core import exceptions
 from impulse.core import threading
+from impulse.core import timings
+from impulse.core import trace as chrome_trace
 from impulse.lib import run as exec_run
+from impulse.pkg import action_cache
+from impulse.pkg import archive
+from impulse.pkg import cache_server as http_cache_server
+from impulse.pkg import digest as file_digest
+from impulse.pkg import hashing
+from impulse.pkg import remote_cache as http_cache
+from impulse.pkg import remote_worker
+from impulse.pkg import sandbox as build_sandbox
 from impulse.util import temp_dir
 from impulse.util import tree_builder
 from impulse.format import format as fmt
 
 command = args.ArgumentParser(complete=True)
+TIMINGS_FILE = 'timings.db'
+DEFAULT_THREADS = 6
 
 
 def setup(enable_debug:bool, fakeroot:typing.Optional[args.Directory]) -> None:
@@ -28,11 +44,40 @@ def setup(enable_debug:bool, fakeroot:typing.Optional[args.Directory]) -> None:
     os.environ['impulse_root'] = typing.cast(str, fakeroot.value())
 
 
-def build_and_await(debug:bool, graph:set, N:int=6) -> None:
-  """Starts a pool with N threads and waits for graph run completion."""
-  pool = threading.DependentPool(N, debug=debug)
+def timing_database() -> timings.TimingDatabase:
+  return timings.TimingDatabase(
+    os.path.join(impulse_paths.output_directory(), TIMINGS_FILE))
+
+
+def build_and_await(debug:bool, graph:set, N:int=6,
+                    schedule:str=threading.Schedule.FIFO,
+                    trace:str|None=None, jobs:str|None=None,
+                    failure_mode:str=threading.FailureMode.FAIL_FAST,
+                    executor:str=threading.Executor.PROCESSES) -> None:
+  """Starts a pool with N threads and waits for graph run completion.
+
+  |jobs| overrides N, and can be 'auto' to size the pool by the load and
+  memory available on this machine. |executor| picks whether jobs run on
+  worker processes or on threads. With $impulse_remote_workers set, jobs also
+  run on those workers, and local jobs run on threads.
+  """
+  history = timing_database()
+  observers = [history]
+  if trace:
+    observers.append(chrome_trace.ChromeTrace(trace))
+  slots = capacity.FromFlag(jobs, N, history.MemoryHint)
+  workers = os.environ.get(remote_worker.ENVIRONMENT_VARIABLE, None)
+  if workers:
+    executor, remote_slots = remote_worker.Connect(workers.split(','),
+                                                   slots.Limit())
+    slots = capacity.FixedCapacity(slots.Limit() + remote_slots)
+  pool = threading.DependentPool(
+    slots.Limit(), debug=debug, schedule=schedule, estimator=history.Estimate,
+    observers=observers, capacity=slots, failure_mode=failure_mode,
+    executor=executor, file_digester=hashing.Digester())
   pool.Start(graph)
   pool.join()
+  action_cache.Trim()
 
 
 def fix_build_target(
@@ -63,6 +108,14 @@ def graph_for_directory(project=None, testonly=False):
     return targets, targets
 
 
+def human_size(size:int) -> str:
+  for unit in ('B', 'K', 'M', 'G'):
+    if size < 1024:
+      return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+    size /= 1024
+  return f'{size:.1f}T'
+
+
 def check_exactly(count, *args):
   for arg in args:
     if arg:
@@ -86,10 +139,38 @@ def build(
   debug:bool=False,
   force:bool=False,
   fakeroot:args.Directory=None,
-  threads:int=6,
-  hackermode:bool=False
+  threads:int=None,
+  hackermode:bool=False,
+  schedule:str=threading.Schedule.FIFO,
+  noserver:bool=False,
+  trace:str=None,
+  jobs:str=None,
+  keep_going:bool=False,
+  fail_fast:bool=False,
+  executor:str=None,
+  digest:str=None,
+  compression:int=None,
+  sandbox:str=None,
+  remote_cache:str=None,
+  remote_workers:str=None
 ):
-  """Builds the given target."""
+  """Builds the given target.
+
+  By default the build stops at the first failure (--fail_fast). With
+  --keep_going, everything which doesn't depend on a failed target is still
+  built. --threads is the number of workers, 6 by default. --executor=threads
+  runs jobs on threads rather than processes. They start faster, but take turns
+  at everything but waiting on commands, since they share a working directory.
+  --digest picks the hash function for files, changing it rebuilds everything.
+  --compression is the zip level of packages, 0 (stored) to 9. Without it,
+  packages of less than 1MiB are stored, and larger ones use level 6.
+  --sandbox picks how a job's inputs are put in front of it: overlay (the
+  default) mounts the kernel's overlay in a user namespace, or else fuse's,
+  links fills a directory with hardlinks, and none with symlinks.
+  --remote_cache shares built packages through a server at that url, see
+  `impulse cache_server`. --remote_workers, a comma separated list of urls,
+  also runs jobs on those `impulse worker`s, which needs a remote cache.
+  """
   if hackermode:
     os.system('impulse build //impulse:impulse')
     binary = f'{impulse_paths.root()}/GENERATED/BINARIES/impulse/impulse'
@@ -98,15 +179,208 @@ def build(
 
   setup(debug, fakeroot)
   parsed_target = fix_build_target(target)
+  if trace:
+    trace = os.path.abspath(trace)
+  if executor is not None and executor not in threading.Executor.ALL:
+    raise exceptions.ImpulseBaseException(
+      f'--executor must be one of {", ".join(threading.Executor.ALL)}')
+  if digest:
+    if digest not in file_digest.Available():
+      raise exceptions.ImpulseBaseException(
+        f'--digest must be one of {", ".join(file_digest.Available())}')
+    os.environ[file_digest.ENVIRONMENT_VARIABLE] = digest
+  if compression is not None:
+    if not 0 <= compression <= 9:
+      raise exceptions.ImpulseBaseException('--compression must be 0-9')
+    os.environ[archive.ENVIRONMENT_VARIABLE] = str(compression)
+  if sandbox:
+    if sandbox not in build_sandbox.Strategy.ALL:
+      raise exceptions.ImpulseBaseException(
+        f'--sandbox must be one of {", ".join(build_sandbox.Strategy.ALL)}')
+    os.environ[build_sandbox.ENVIRONMENT_VARIABLE] = sandbox
+  if remote_cache:
+    try:
+      http_cache.ConnectionPool(remote_cache)
+    except ValueError as e:
+      raise exceptions.ImpulseBaseException(f'--remote_cache: {e}')
+    os.environ[http_cache.ENVIRONMENT_VARIABLE] = remote_cache
+  if remote_workers:
+    if not os.environ.get(http_cache.ENVIRONMENT_VARIABLE, None):
+      raise exceptions.ImpulseBaseException(
+        '--remote_workers needs a --remote_cache to share files through')
+    os.environ[remote_worker.ENVIRONMENT_VARIABLE] = remote_workers
+  failure_mode = threading.FailureMode.FAIL_FAST
+  if keep_going and not fail_fast:
+    failure_mode = threading.FailureMode.KEEP_GOING
+  # Forced builds, and builds picking their own workers, digest, compression,
+  # sandbox, remote cache or remote workers, always run locally since the
+  # server's workers are shared.
+  if not (noserver or force or threads is not None or executor or digest
+          or compression is not None or sandbox or remote_cache
+          or remote_workers):
+    served = build_server.RequestBuild(
+      parsed_target.GetFullyQualifiedRulePath(),
+      platform.value() if platform else None, schedule, trace, jobs,
+      failure_mode)
+    if served is not None:
+      return parsed_target.GetRuleInfo()
+
   build_and_await(
     debug,
     recursive_loader.generate_graph(
       parsed_target, platform=platform, force_build=force, allow_meta=True
-    ), threads
+    ), DEFAULT_THREADS if threads is None else threads, schedule, trace, jobs,
+    failure_mode, executor or threading.Executor.PROCESSES
   )
   return parsed_target.GetRuleInfo()
 
 
+@command
+def serve(
+  fakeroot:args.Directory=None,
+  threads:int=DEFAULT_THREADS,
+  debug:bool=False,
+  executor:str=threading.Executor.PROCESSES
+):
+  """Runs a build server which keeps targets parsed and workers warm."""
+  setup(debug, fakeroot)
+  build_server.BuildServer(
+    threads, timing_database(), debug, executor).Serve()
+
+
+@command
+def stats(
+  fakeroot:args.Directory=None,
+  ruletypes:bool=False,
+  filter:str=None
+):
+  """Shows p50/p95 build durations per target and per rule type."""
+  setup(False, fakeroot)
+  history = timing_database()
+  columns = ['ruletype'] if ruletypes else ['target', 'ruletype']
+  for column in columns:
+    rows = [r for r in history.Summarize(column)
+            if filter is None or filter in r[0]]
+    if not rows:
+      continue
+    width = max(len(r[0]) for r in rows)
+    print(f'{column:<{width}}  {"runs":>6}  {"p50":>8}  {"p95":>8}')
+    for key, runs, p50, p95 in rows:
+      print(f'{key:<{width}}  {runs:>6}  {p50:>7.2f}s  {p95:>7.2f}s')
+    print('')
+
+
+@command
+def cache(
+  action:str,
+  fakeroot:args.Directory=None,
+  max_size:str=None
+):
+  """Shows, trims or clears the cache of built packages and binaries.
+
+  `impulse cache stats` shows what is cached. `impulse cache gc` evicts the
+  least recently used until the cache fits in --max_size, and `impulse cache
+  clear` empties it. Builds trim the cache to $impulse_cache_size, or 10G.
+  """
+  setup(False, fakeroot)
+  store = action_cache.ForOutputDirectory()
+  try:
+    limit = action_cache.ParseSize(max_size) if max_size else (
+      action_cache.MaxSize())
+  except ValueError as e:
+    raise exceptions.ImpulseBaseException(str(e))
+  if action == 'stats':
+    stats = store.Stats()
+    print(f'blobs:    {stats["blobs"]}')
+    print(f'actions:  {stats["actions"]}')
+    print(f'size:     {human_size(stats["size"])} of '
+          f'{human_size(limit)}')
+    for name in ('oldest', 'newest'):
+      if stats[name] is not None:
+        used = time.strftime('%Y-%m-%d %H:%M:%S',
+                             time.localtime(stats[name] / 1e9))
+        print(f'{name}:   {used}')
+  elif action == 'gc':
+    evicted, freed = store.Collect(limit)
+    print(f'Evicted {evicted} blobs, freeing {human_size(freed)}')
+  elif action == 'clear':
+    store.Clear()
+  else:
+    raise exceptions.ImpulseBaseException(
+      'cache must be one of stats, gc or clear')
+
+
+@command
+def cache_server(
+  fakeroot:args.Directory=None,
+  directory:args.Directory=None,
+  address:str='127.0.0.1',
+  port:int=8976,
+  max_size:str=None,
+  verbose:bool=False
+):
+  """Serves a remote cache, for builds run with --remote_cache.
+
+  Everything is kept in --directory, GENERATED/cache_server by default, and
+  trimmed to --max_size ($impulse_cache_size, or 10G). To share it with other
+  machines, give an --address they can reach it on.
+  """
+  setup(False, fakeroot)
+  if directory and directory.value():
+    store = os.path.abspath(directory.value())
+  else:
+    store = os.path.join(impulse_paths.output_directory(), 'cache_server')
+  try:
+    limit = action_cache.ParseSize(max_size) if max_size else (
+      action_cache.MaxSize())
+  except ValueError as e:
+    raise exceptions.ImpulseBaseException(str(e))
+  server = http_cache_server.CacheServer(
+    store, address, port, limit, verbose)
+  print(f'Serving the cache in {store} on {server.Url()}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+@command
+def worker(
+  remote_cache:str,
+  directory:args.Directory=None,
+  address:str='127.0.0.1',
+  port:int=8977,
+  jobs:int=None,
+  verbose:bool=False
+):
+  """Runs jobs sent by `impulse build --remote_workers`.
+
+  Inputs come from, and outputs go to, the cache at |remote_cache|. Jobs are
+  run in workspaces under --directory, a temporary directory by default. Jobs
+  are arbitrary code, so only give an --address trusted machines can reach.
+  """
+  try:
+    http_cache.ConnectionPool(remote_cache)
+  except ValueError as e:
+    raise exceptions.ImpulseBaseException(str(e))
+  if directory and directory.value():
+    workspace = os.path.abspath(directory.value())
+  else:
+    workspace = os.path.join(tempfile.gettempdir(), 'impulse_worker')
+  server = remote_worker.Worker(
+    workspace, remote_cache, jobs, address, port, verbose)
+  print(f'Running {server.jobs} jobs at a time in {workspace} on '
+        f'{server.Url()}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
 @command
 def info(
   target:impulse_paths.BuildTarget,
@@ -232,7 +506,7 @@ def testsuite(
   project:str=None,
   debug:bool=False,
   notermcolor:bool=False,
-  threads:int=6,
+  threads:int=DEFAULT_THREADS,
   filter:str=None,
   fakeroot:args.Directory=None
 ):
@@ -0,0 +1,412 @@
+"""Content addressed store of build outputs, keyed by what they were built from.
+
+A target's action key covers everything that can change its output: the rule
+code, the arguments it was given, the platform, the digests of its input
+files, and the *output* digests of its dependencies. The result of building
+it (its package, and binary if it has one) is kept in a blob store by digest,
+and the action key maps to those digests.
+
+So a target whose key has been seen before doesn't have to be built. If what
+is already in GENERATED/ matches, there's nothing to do, and otherwise it can
+be copied back out of the store. Since dependencies are keyed by what they
+produced rather than when, a dependency which is rebuilt but produces the
+same output doesn't cause anything depending on it to be rebuilt (early
+cutoff).
+
+  GENERATED/cas/blobs/ab/abcdef...   file contents, named by digest
+  GENERATED/cas/actions/01/0123...   action results, named by action key
+  GENERATED/cas/index                when each blob was last used
+  GENERATED/cas/size                 how many bytes of blobs there are
+
+The store is kept under a size cap by evicting the least recently used blobs.
+Filesystem atime is too often disabled or relaxed to be trusted for that, so
+every use of a blob is appended to the index instead, and collection compacts
+it down to one line per blob.
+
+Finding out how much is stored means reading every blob's size, so that isn't
+done after every build. Collection writes down the size it leaves, and each
+blob added appends its own. Their total can only overestimate, so the store
+is only collected when it could be over the cap.
+"""
+
+import contextlib
+import fcntl
+import json
+import marshal
+import os
+import shutil
+import tempfile
+import time
+import types
+import typing
+
+from impulse.core import environment
+from impulse.pkg import digest
+from impulse.pkg import hashing
+
+
+# The output directory, under the root.
+EXPORT_DIR = 'GENERATED'
+CAS_DIR = 'cas'
+BLOBS_DIR = 'blobs'
+ACTIONS_DIR = 'actions'
+INDEX_FILE = 'index'
+INDEX_LOCK = 'index.lock'
+SIZE_FILE = 'size'
+
+# The size cap can be set with this, like 500M or 20G.
+SIZE_ENVIRONMENT_VARIABLE = 'impulse_cache_size'
+DEFAULT_MAX_SIZE = 10 << 30
+_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# Changing what goes into an action key or result should change this, so that
+# results from an older impulse are never used.
+VERSION = 'impulse-action-2'
+
+
+def _Sharded(directory:str, name:str) -> str:
+  return os.path.join(directory, name[:2], name)
+
+
+def ParseSize(size:str) -> int:
+  """The number of bytes in a size like 4096, 500M or 20G."""
+  value = size.strip().upper().removesuffix('B')
+  try:
+    if value and value[-1] in _UNITS:
+      return int(float(value[:-1]) * _UNITS[value[-1]])
+    return int(value)
+  except ValueError:
+    raise ValueError(f'"{size}" is not a size, like 500M or 20G') from None
+
+
+def MaxSize() -> int:
+  """The configured size cap, in bytes."""
+  size = os.environ.get(SIZE_ENVIRONMENT_VARIABLE, None)
+  return DEFAULT_MAX_SIZE if size is None else ParseSize(size)
+
+
+@contextlib.contextmanager
+def AtomicWrite(destination:str, mode:str='wb'):
+  """A file which only replaces |destination| once it is completely written."""
+  directory = os.path.dirname(destination)
+  os.makedirs(directory, exist_ok=True)
+  fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp')
+  try:
+    with os.fdopen(fd, mode) as f:
+      yield f
+    os.replace(temporary, destination)
+  except:
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(temporary)
+    raise
+
+
+def _AtomicCopy(source:str, destination:str):
+  """Copies |source| so that |destination| is never seen half written."""
+  directory = os.path.dirname(destination)
+  os.makedirs(directory, exist_ok=True)
+  fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp')
+  os.close(fd)
+  try:
+    shutil.copy2(source, temporary)
+    os.replace(temporary, destination)
+  except:
+    os.unlink(temporary)
+    raise
+
+
+class ActionResult(object):
+  """Blob digests of what building a target produced."""
+  __slots__ = ('package', 'binary', 'binary_mode', 'output_digest')
+
+  def __init__(self, package:str, output_digest:str,
+               binary:str|None=None, binary_mode:int|None=None):
+    self.package = package
+    self.output_digest = output_digest
+    self.binary = binary
+    self.binary_mode = binary_mode
+
+  def dict(self) -> dict:
+    return {k: getattr(self, k) for k in ActionResult.__slots__}
+
+  @classmethod
+  def FromDict(cls, value:dict) -> 'ActionResult':
+    return cls(value['package'], value['output_digest'],
+               value.get('binary', None), value.get('binary_mode', None))
+
+
+class ActionCache(object):
+  def __init__(self, directory:str, algorithm:str=None,
+               clock:typing.Callable[[], int]=time.time_ns):
+    self.directory = directory
+    self.algorithm = algorithm or digest.Configured()
+    self._clock = clock
+
+  def BlobPath(self, blob:str) -> str:
+    return _Sharded(os.path.join(self.directory, BLOBS_DIR), blob)
+
+  def ActionPath(self, key:str) -> str:
+    return _Sharded(os.path.join(self.directory, ACTIONS_DIR), key)
+
+  def PutBlob(self, filename:str) -> str:
+    """Stores the contents of |filename|, and returns their digest."""
+    blob = digest.Compute(filename, self.algorithm).hex()
+    path = self.BlobPath(blob)
+    if not os.path.exists(path):
+      _AtomicCopy(filename, path)
+      self.Added(blob)
+    self.Touch([blob])
+    return blob
+
+  def Added(self, blob:str):
+    """Counts a blob which was just written to its path, for Trim."""
+    try:
+      size = os.path.getsize(self.BlobPath(blob))
+    except FileNotFoundError:
+      return
+    with self._IndexLocked(exclusive=False):
+      # Until a collection has written down the size, there's nothing to add
+      # to, and the next Trim collects.
+      try:
+        sizes = os.open(os.path.join(self.directory, SIZE_FILE),
+                        os.O_WRONLY | os.O_APPEND)
+      except FileNotFoundError:
+        return
+      with os.fdopen(sizes, 'w') as f:
+        f.write(f'{size}\n')
+
+  def HasBlob(self, blob:str) -> bool:
+    return os.path.exists(self.BlobPath(blob))
+
+  def GetBlob(self, blob:str, destination:str, mode:int=None) -> bool:
+    """Copies a blob to |destination|, returning whether there was one."""
+    try:
+      _AtomicCopy(self.BlobPath(blob), destination)
+    except FileNotFoundError:
+      # Not stored, or evicted since the action was looked up.
+      return False
+    if mode is not None:
+      os.chmod(destination, mode)
+    return True
+
+  def Matches(self, blob:str, filename:str) -> bool:
+    """Whether |filename| already has the contents of |blob|."""
+    try:
+      return hashing.Digest(filename, self.algorithm) == blob
+    except IsADirectoryError:
+      return False
+
+  def PutAction(self, key:str, result:ActionResult):
+    with AtomicWrite(self.ActionPath(key), 'w') as f:
+      json.dump(result.dict(), f)
+
+  def GetAction(self, key:str) -> ActionResult|None:
+    """The result of the action, as long as all of its blobs are stored."""
+    try:
+      with open(self.ActionPath(key)) as f:
+        result = ActionResult.FromDict(json.load(f))
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+      return None
+    blobs = [b for b in (result.package, result.binary) if b is not None]
+    if not all(self.HasBlob(blob) for blob in blobs):
+      return None
+    self.Touch(blobs)
+    return result
+
+  @contextlib.contextmanager
+  def _IndexLocked(self, exclusive:bool):
+    """Appending to the index is shared, rewriting it is exclusive.
+
+    The lock is on a file of its own, since the index is replaced when it is
+    rewritten, and writers waiting on the old one would append to nothing.
+    """
+    os.makedirs(self.directory, exist_ok=True)
+    with open(os.path.join(self.directory, INDEX_LOCK), 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+  def Touch(self, blobs:typing.List[str]):
+    now = self._clock()
+    lines = ''.join(f'{now} {blob}\n' for blob in blobs)
+    with self._IndexLocked(exclusive=False):
+      with open(os.path.join(self.directory, INDEX_FILE), 'a') as index:
+        index.write(lines)
+
+  def _ReadIndex(self) -> typing.Dict[str, int]:
+    used = {}
+    try:
+      with open(os.path.join(self.directory, INDEX_FILE)) as index:
+        for line in index:
+          parts = line.split()
+          if len(parts) == 2 and parts[0].isdigit():
+            used[parts[1]] = max(int(parts[0]), used.get(parts[1], 0))
+    except FileNotFoundError:
+      pass
+    return used
+
+  def _Blobs(self) -> typing.List[typing.Tuple[int, str, int]]:
+    """(last used, digest, size) of every stored blob, least recent first.
+
+    Blobs the index doesn't know about count as used when they were written.
+    """
+    used = self._ReadIndex()
+    blobs = []
+    for shard in _ScanDirectories(os.path.join(self.directory, BLOBS_DIR)):
+      for entry in os.scandir(shard):
+        if entry.name.startswith('.tmp'):
+          continue
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        blobs.append(
+          (used.get(entry.name, stat.st_mtime_ns), entry.name, stat.st_size))
+    return sorted(blobs)
+
+  def _Actions(self) -> typing.Iterator[str]:
+    for shard in _ScanDirectories(os.path.join(self.directory, ACTIONS_DIR)):
+      for entry in os.scandir(shard):
+        if not entry.name.startswith('.tmp'):
+          yield entry.path
+
+  def Stats(self) -> typing.Dict[str, int|None]:
+    blobs = self._Blobs()
+    return {
+      'blobs': len(blobs),
+      'actions': sum(1 for _ in self._Actions()),
+      'size': sum(size for _, _, size in blobs),
+      'oldest': blobs[0][0] if blobs else None,
+      'newest': max(used for used, _, _ in blobs) if blobs else None,
+    }
+
+  def _Size(self) -> int|None:
+    """At least how many bytes are stored, or None if that isn't known."""
+    try:
+      with open(os.path.join(self.directory, SIZE_FILE)) as sizes:
+        return sum(int(line) for line in sizes)
+    except (FileNotFoundError, ValueError):
+      return None
+
+  def Trim(self, max_size:int) -> typing.Tuple[int, int]:
+    """Collects, unless the store is known to be under |max_size| already."""
+    size = self._Size()
+    if size is not None and size <= max_size:
+      return 0, 0
+    return self.Collect(max_size)
+
+  def Collect(self, max_size:int) -> typing.Tuple[int, int]:
+    """Evicts the least recently used blobs until at most |max_size| is left.
+
+    Actions which have lost a blob are removed with it. Returns the number of
+    blobs evicted, and the bytes that freed.
+    """
+    with self._IndexLocked(exclusive=True):
+      blobs = self._Blobs()
+      size = sum(size for _, _, size in blobs)
+      evicted, freed = 0, 0
+      while blobs and size > max_size:
+        _, blob, blob_size = blobs.pop(0)
+        with contextlib.suppress(FileNotFoundError):
+          os.unlink(self.BlobPath(blob))
+        size -= blob_size
+        evicted += 1
+        freed += blob_size
+      if evicted:
+        for action in self._Actions():
+          if self._IsDangling(action):
+            with contextlib.suppress(FileNotFoundError):
+              os.unlink(action)
+      self._WriteIndex(blobs)
+      with AtomicWrite(os.path.join(self.directory, SIZE_FILE), 'w') as f:
+        f.write(f'{size}\n')
+    return evicted, freed
+
+  def _IsDangling(self, action:str) -> bool:
+    try:
+      with open(action) as f:
+        result = ActionResult.FromDict(json.load(f))
+    except FileNotFoundError:
+      return False
+    except (ValueError, KeyError, TypeError):
+      return True
+    blobs = [b for b in (result.package, result.binary) if b is not None]
+    return not all(self.HasBlob(blob) for blob in blobs)
+
+  def _WriteIndex(self, blobs:typing.List[typing.Tuple[int, str, int]]):
+    with AtomicWrite(os.path.join(self.directory, INDEX_FILE), 'w') as index:
+      index.write(''.join(f'{used} {blob}\n' for used, blob, _ in blobs))
+
+  def Clear(self) -> None:
+    with self._IndexLocked(exclusive=True):
+      for name in (BLOBS_DIR, ACTIONS_DIR):
+        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+      for name in (INDEX_FILE, SIZE_FILE):
+        with contextlib.suppress(FileNotFoundError):
+          os.unlink(os.path.join(self.directory, name))
+
+
+def _Relocated(code:types.CodeType, root:str,
+               new_root:str) -> types.CodeType:
+  filename = code.co_filename
+  if filename.startswith(root + os.sep):
+    filename = os.path.join(new_root, filename[len(root) + 1:])
+  return code.replace(co_filename=filename, co_consts=tuple(
+    _Relocated(const, root, new_root) if isinstance(const, types.CodeType)
+    else const for const in code.co_consts))
+
+
+def Relocated(marshalled:bytes, root:str, new_root:str='') -> bytes:
+  """Marshalled code, as if compiled from files under |new_root| not |root|.
+
+  That includes the functions defined in it. With no |new_root|, the files
+  are named relative to |root|.
+  """
+  return marshal.dumps(_Relocated(marshal.loads(marshalled), root, new_root))
+
+
+def _ScanDirectories(directory:str) -> typing.Iterator[str]:
+  try:
+    entries = list(os.scandir(directory))
+  except FileNotFoundError:
+    return
+  for entry in entries:
+    if entry.is_dir():
+      yield entry.path
+
+
+def ForOutputDirectory() -> ActionCache:
+  return ActionCache(os.path.join(environment.Root(), EXPORT_DIR, CAS_DIR))
+
+
+def Trim() -> typing.Tuple[int, int]:
+  """Brings the output directory's store back under the size cap."""
+  return ForOutputDirectory().Trim(MaxSize())
+
+
+class KeyBuilder(object):
+  """Hashes the parts of an action key in a fixed, unambiguous order."""
+  def __init__(self):
+    self._hash = digest.New(digest.BLAKE2B)
+    self.Add('version', VERSION)
+
+  def Add(self, name:str, value:typing.Any):
+    if not isinstance(value, bytes):
+      value = json.dumps(value, sort_keys=True, default=str).encode()
+    for part in (name.encode(), value):
+      self._hash.update(len(part).to_bytes(8, 'little'))
+      self._hash.update(part)
+    return self
+
+  def AddCode(self, name:str, marshalled:bytes):
+    """Adds marshalled code, wherever the root it was compiled in is.
+
+    Code records the absolute path of the file it came from, which would keep
+    checkouts in different places from sharing keys.
+    """
+    return self.Add(name, Relocated(marshalled, environment.Root()))
+
+  def Key(self) -> str:
+    return self._hash.hexdigest()
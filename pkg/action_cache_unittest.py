@@ -0,0 +1,156 @@
+import marshal
+import os
+import shutil
+import tempfile
+
+from impulse.pkg import action_cache
+from impulse.pkg import digest
+from impulse.testing import unittest
+
+
+class Clock(object):
+  def __init__(self):
+    self.now = 0
+
+  def __call__(self):
+    self.now += 1
+    return self.now
+
+
+class ActionCacheTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = action_cache.ActionCache(
+      os.path.join(self.directory, 'cas'), digest.BLAKE2B, Clock())
+
+  def cleanup(self):
+    shutil.rmtree(self.directory)
+
+  def Write(self, name, content):
+    filename = os.path.join(self.directory, name)
+    with open(filename, 'w') as f:
+      f.write(content)
+    return filename
+
+  def test_RestoresBlobs(self):
+    package = self.Write('package.zip', 'contents')
+    blob = self.cache.PutBlob(package)
+    self.assertTrue(self.cache.Matches(blob, package))
+
+    os.unlink(package)
+    self.assertFalse(self.cache.Matches(blob, package))
+    self.assertTrue(self.cache.GetBlob(blob, package, 0o755))
+    self.assertTrue(self.cache.Matches(blob, package))
+    self.assertEqual(os.stat(package).st_mode & 0o777, 0o755)
+
+  def test_ActionsNeedTheirBlobs(self):
+    package = self.Write('package.zip', 'contents')
+    binary = self.Write('binary', 'binary')
+    result = action_cache.ActionResult(
+      self.cache.PutBlob(package), 'output', 'f' * 64, 0o755)
+    self.cache.PutAction('key', result)
+    # The binary was never stored.
+    self.assertEqual(self.cache.GetAction('key'), None)
+
+    result.binary = self.cache.PutBlob(binary)
+    self.cache.PutAction('key', result)
+    self.assertEqual(self.cache.GetAction('key').dict(), result.dict())
+    self.assertEqual(self.cache.GetAction('other'), None)
+
+  def test_KeysAreUnambiguous(self):
+    def Key(*parts):
+      builder = action_cache.KeyBuilder()
+      for name, value in parts:
+        builder.Add(name, value)
+      return builder.Key()
+    self.assertEqual(Key(('kwargs', {'a': 1, 'b': 2})),
+                     Key(('kwargs', {'b': 2, 'a': 1})))
+    self.assertNotEqual(Key(('a', b'bc')), Key(('ab', b'c')))
+    self.assertNotEqual(Key(('a', b''), ('b', b'')),
+                        Key(('b', b''), ('a', b'')))
+
+  def _CodeKey(self, root, source):
+    os.environ['impulse_root'] = root
+    code = compile(source, os.path.join(root, 'rules', 'rule.py'), 'exec')
+    return action_cache.KeyBuilder().AddCode(
+      'rule', marshal.dumps(code)).Key()
+
+  def test_CodeKeysDontDependOnTheRoot(self):
+    source = 'def rule(target):\n  def helper():\n    pass\n  helper()\n'
+    environ = dict(os.environ)
+    try:
+      key = self._CodeKey('/home/alice/src', source)
+      self.assertEqual(self._CodeKey('/home/bob/checkout', source), key)
+      self.assertFalse(
+        self._CodeKey('/home/bob/checkout', source + 'x = 1\n') == key)
+      # As a remote worker would see code compiled in another root.
+      code = compile(source, '/home/alice/src/rules/rule.py', 'exec')
+      moved = action_cache.Relocated(
+        marshal.dumps(code), '/home/alice/src', '/home/bob/checkout')
+      self.assertEqual(marshal.loads(moved).co_filename,
+                       '/home/bob/checkout/rules/rule.py')
+      self.assertEqual(
+        action_cache.KeyBuilder().AddCode('rule', moved).Key(), key)
+    finally:
+      os.environ.clear()
+      os.environ.update(environ)
+
+  def test_EvictsLeastRecentlyUsed(self):
+    packages = [self.Write(f'{n}.zip', n * 100) for n in 'abc']
+    blobs = [self.cache.PutBlob(package) for package in packages]
+    for key, blob in zip('abc', blobs):
+      self.cache.PutAction(key, action_cache.ActionResult(blob, key))
+    # Using 'a' again makes 'b' the least recently used.
+    self.assertTrue(self.cache.GetAction('a'))
+    self.assertEqual(self.cache.Stats()['size'], 300)
+
+    self.assertEqual(self.cache.Collect(250), (1, 100))
+    self.assertEqual(self.cache.GetAction('b'), None)
+    self.assertTrue(self.cache.GetAction('a'))
+    self.assertTrue(self.cache.GetAction('c'))
+    stats = self.cache.Stats()
+    self.assertEqual((stats['blobs'], stats['actions']), (2, 2))
+
+    # Recency survives compacting the index: 'c' is now the oldest.
+    self.assertTrue(self.cache.GetAction('a'))
+    self.cache.Collect(100)
+    self.assertEqual(self.cache.GetAction('c'), None)
+    self.assertTrue(self.cache.GetAction('a'))
+
+    self.cache.Clear()
+    self.assertEqual(self.cache.Stats()['blobs'], 0)
+    self.assertEqual(self.cache.GetAction('a'), None)
+
+  def test_TrimsOnlyWhenItCouldBeOverTheCap(self):
+    a = self.cache.PutBlob(self.Write('a.zip', 'a' * 100))
+    # Nothing has counted what is stored yet, so this collects.
+    stray = self.cache.BlobPath('ff' * 32)
+    os.makedirs(os.path.dirname(stray))
+    with open(stray, 'w') as f:
+      f.write('f' * 1000)
+    os.utime(stray, ns=(0, 0))
+    self.assertEqual(self.cache.Trim(250), (1, 1000))
+    self.assertTrue(self.cache.HasBlob(a))
+    # Written behind the store's back, so only a collection would find it.
+    with open(stray, 'w') as f:
+      f.write('f' * 1000)
+    os.utime(stray, ns=(0, 0))
+    self.assertEqual(self.cache.Trim(250), (0, 0))
+    self.assertTrue(os.path.exists(stray))
+
+    b = self.cache.PutBlob(self.Write('b.zip', 'b' * 100))
+    self.assertEqual(self.cache.Trim(250), (0, 0))
+    c = self.cache.PutBlob(self.Write('c.zip', 'c' * 100))
+    self.assertEqual(self.cache.Trim(250), (2, 1100))
+    self.assertFalse(os.path.exists(stray))
+    self.assertFalse(self.cache.HasBlob(a))
+    self.assertTrue(self.cache.HasBlob(b) and self.cache.HasBlob(c))
+    self.assertEqual(self.cache.Trim(250), (0, 0))
+    self.assertEqual(self.cache.Stats()['size'], 200)
+
+  def test_ParsesSizes(self):
+    self.assertEqual(action_cache.ParseSize('4096'), 4096)
+    self.assertEqual(action_cache.ParseSize('500M'), 500 << 20)
+    self.assertEqual(action_cache.ParseSize('1.5g'), 3 << 29)
+    with unittest.ExpectException(self, ValueError):
+      action_cache.ParseSize('lots')
@@ -0,0 +1,362 @@
+"""Package files are zip archives, written and extracted in process.
+
+Symlinks are kept as symlinks, the way `zip --symlinks` stores them: as an
+entry holding the link's target, with S_IFLNK in its unix mode. Directories
+which are named are stored as empty directory entries, not recursively, and
+permission bits and modification times are restored on extraction.
+
+The compression level is 0-9, where 0 stores everything as is. Unless one is
+configured, packages smaller than SMALL_PACKAGE are stored, since they take
+longer to deflate and inflate than to read, and the rest use DEFAULT_LEVEL.
+Files which are already compressed are always stored, deflating them again
+costs time and saves nothing.
+"""
+
+import errno
+import os
+import stat
+import struct
+import time
+import typing
+import zipfile
+import zlib
+
+from impulse.pkg import digest
+
+
+# Set by `impulse build --compression`, and inherited by the workers.
+ENVIRONMENT_VARIABLE = 'impulse_compression'
+STORED = 0
+DEFAULT_LEVEL = 6
+# Bytes of files below which a package is stored, unless a level is set.
+SMALL_PACKAGE = 1 << 20
+
+_COMPRESSED_SUFFIXES = frozenset((
+  '.7z', '.br', '.bz2', '.gif', '.gz', '.jar', '.jpeg', '.jpg', '.lz4',
+  '.mp3', '.mp4', '.png', '.tgz', '.webm', '.webp', '.whl', '.xz', '.zip',
+  '.zst',
+))
+
+# The unix mode of an entry is kept in the high bits of its external attributes.
+_MODE_SHIFT = 16
+_MSDOS_DIRECTORY = 0x10
+_ENCRYPTED = 0x1
+# Zip can't represent anything before 1980.
+_EPOCH = (1980, 1, 1, 0, 0, 0)
+_LOCAL_SIGNATURE = b'PK\x03\x04'
+# Signature through to the name and extra field lengths.
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def Configured() -> int|None:
+  """The compression level this build uses, or None to pick by size."""
+  level = os.environ.get(ENVIRONMENT_VARIABLE, None)
+  if level is None:
+    return None
+  if not level.isdigit() or int(level) > 9:
+    raise ValueError(f'Compression level "{level}" is not one of 0-9')
+  return int(level)
+
+
+def _ArchiveName(name:str) -> str:
+  """|name| as zip stores it, relative and without any leading ../"""
+  name = os.path.normpath(name).lstrip('/')
+  while name.startswith('../'):
+    name = name[3:]
+  return '' if name in ('.', '..') else name
+
+
+def _Entry(name:str, mode:int, mtime:float,
+           compression:int=zipfile.ZIP_STORED) -> zipfile.ZipInfo:
+  info = zipfile.ZipInfo(name, max(time.localtime(mtime)[:6], _EPOCH))
+  info.external_attr = mode << _MODE_SHIFT
+  info.compress_type = compression
+  return info
+
+
+def Write(filename:str, files:typing.Iterable[str],
+          contents:typing.Dict[str, str|bytes]=None,
+          level:int=None) -> typing.List[str]:
+  """Writes the |files| in the current directory to a new zip at |filename|.
+
+  |contents| are extra entries, written first from memory. |level| is picked
+  by the size of the files if it isn't given, see above. Returns the files
+  which couldn't be found, which are left out like zip leaves them out.
+  """
+  contents = contents or {}
+  missing = []
+  written = set(contents)
+  entries = []
+  for name in files:
+    arcname = _ArchiveName(name)
+    if not arcname or arcname in written:
+      continue
+    try:
+      entries.append((name, arcname, os.lstat(name)))
+    except FileNotFoundError:
+      missing.append(name)
+      continue
+    written.add(arcname)
+  if level is None:
+    size = sum(status.st_size for _, _, status in entries
+               if stat.S_ISREG(status.st_mode))
+    level = STORED if size < SMALL_PACKAGE else DEFAULT_LEVEL
+  compression = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+  level = level or None
+  with zipfile.ZipFile(filename, 'w', compression, compresslevel=level,
+                       strict_timestamps=False) as archive:
+    for name, data in contents.items():
+      archive.writestr(_Entry(name, stat.S_IFREG | 0o644, time.time(),
+                              compression), data, compresslevel=level)
+    for name, arcname, status in entries:
+      mode, mtime = status.st_mode, status.st_mtime
+      if stat.S_ISLNK(mode):
+        archive.writestr(_Entry(arcname, mode, mtime), os.readlink(name))
+      elif stat.S_ISDIR(mode):
+        info = _Entry(arcname + '/', mode, mtime)
+        info.external_attr |= _MSDOS_DIRECTORY
+        archive.writestr(info, b'')
+      else:
+        compress_type = compression
+        if os.path.splitext(arcname)[1].lower() in _COMPRESSED_SUFFIXES:
+          compress_type = zipfile.ZIP_STORED
+        if status.st_size > digest.BUFFER_SIZE:
+          archive.write(name, arcname, compress_type, level)
+          continue
+        with open(name, 'rb', buffering=0) as f:
+          archive.writestr(_Entry(arcname, mode, mtime, compress_type),
+                           f.readall(), compresslevel=level)
+  return missing
+
+
+def _Destination(directory:str, name:str, links:typing.Set[str]) -> str:
+  """Where entry |name| goes within |directory|, which it must not escape."""
+  parts = name.rstrip('/').split('/')
+  if name.startswith('/') or '..' in parts or '' in parts:
+    raise ValueError(f'"{name}" is outside of the archive')
+  destination = os.path.join(directory, *parts)
+  # An entry within a symlinked directory may only go where it could have
+  # gone without the link.
+  if links and any('/'.join(parts[:i]) in links for i in range(1, len(parts))):
+    real = os.path.realpath(os.path.dirname(destination))
+    if os.path.commonpath((real, os.path.realpath(directory))) != (
+        os.path.realpath(directory)):
+      raise ValueError(f'"{name}" is outside of the archive')
+  return destination
+
+
+def _DataOffset(fd:int, info:zipfile.ZipInfo) -> int:
+  """Where the data of an entry starts, after its local header."""
+  header = os.pread(fd, _LOCAL_HEADER.size, info.header_offset)
+  fields = _LOCAL_HEADER.unpack(header)
+  if fields[0] != _LOCAL_SIGNATURE:
+    raise zipfile.BadZipFile(f'Bad local header for {info.filename}')
+  return info.header_offset + _LOCAL_HEADER.size + fields[-2] + fields[-1]
+
+
+def _Read(archive:zipfile.ZipFile, fd:int, info:zipfile.ZipInfo) -> bytes:
+  """The contents of a small entry, read without zipfile's per entry setup.
+
+  Anything unusual, like encryption or other compression methods, goes
+  through zipfile.
+  """
+  if (info.flag_bits & _ENCRYPTED or
+      info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+    return archive.read(info)
+  data = os.pread(fd, info.compress_size, _DataOffset(fd, info))
+  if info.compress_type == zipfile.ZIP_DEFLATED:
+    data = zlib.decompress(data, -zlib.MAX_WBITS)
+  if zlib.crc32(data) != info.CRC or len(data) != info.file_size:
+    raise zipfile.BadZipFile(f'Bad CRC for {info.filename}')
+  return data
+
+
+def _WriteFile(archive:zipfile.ZipFile, fd:int, info:zipfile.ZipInfo,
+               destination:str, mode:int, mtime:float):
+  # Plain file descriptors, buffered files cost more than the write itself.
+  output = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+  try:
+    if info.file_size <= digest.BUFFER_SIZE:
+      chunks = [_Read(archive, fd, info)]
+    else:
+      chunks = _Chunks(archive, info)
+    for chunk in chunks:
+      view = memoryview(chunk)
+      while view:
+        view = view[os.write(output, view):]
+    if mode & 0o7777:
+      os.fchmod(output, mode & 0o7777)
+    os.utime(output, (mtime, mtime))
+  finally:
+    os.close(output)
+
+
+def _Chunks(archive:zipfile.ZipFile, info:zipfile.ZipInfo):
+  with archive.open(info) as source:
+    while chunk := source.read(digest.BUFFER_SIZE):
+      yield chunk
+
+
+def Extract(filename:str, directory:str) -> None:
+  """Extracts all of a zip written by Write, or by `zip --symlinks`."""
+  links = set()
+  os.makedirs(directory, exist_ok=True)
+  made = {directory}
+  times = {}
+  with open(filename, 'rb') as f, zipfile.ZipFile(f, 'r') as archive:
+    fd = f.fileno()
+    for info in archive.infolist():
+      destination = _Destination(directory, info.filename, links)
+      mode = info.external_attr >> _MODE_SHIFT
+      if info.date_time not in times:
+        times[info.date_time] = time.mktime(info.date_time + (0, 0, -1))
+      mtime = times[info.date_time]
+      if info.is_dir():
+        os.makedirs(destination, exist_ok=True)
+        made.add(destination)
+        continue
+      parent = os.path.dirname(destination)
+      if parent not in made:
+        os.makedirs(parent, exist_ok=True)
+        made.add(parent)
+      if stat.S_ISLNK(mode):
+        os.symlink(_Read(archive, fd, info).decode(), destination)
+        os.utime(destination, (mtime, mtime), follow_symlinks=False)
+        links.add(info.filename)
+      else:
+        _WriteFile(archive, fd, info, destination, mode, mtime)
+    # Named directories keep their own times, not those of being filled.
+    for info in archive.infolist():
+      if info.is_dir():
+        destination = _Destination(directory, info.filename, links)
+        mode = info.external_attr >> _MODE_SHIFT
+        if mode & 0o7777:
+          os.chmod(destination, mode & 0o7777)
+        os.utime(destination, (times[info.date_time], times[info.date_time]))
+
+
+class Archive(object):
+  """A zip whose entries are read in place, rather than extracted.
+
+  The central directory is indexed once, including the directories which
+  are only implied by the paths of the entries in them. Stored entries are
+  read straight out of the archive, compressed ones are inflated whole the
+  first time they're read, and kept while they're being read.
+  """
+  def __init__(self, filename:str):
+    self.filename = filename
+    self._file = open(filename, 'rb')
+    self._fd = self._file.fileno()
+    self._zip = zipfile.ZipFile(self._file, 'r')
+    status = os.fstat(self._fd)
+    self._owner = (status.st_uid, status.st_gid)
+    self._entries:typing.Dict[str, zipfile.ZipInfo] = {}
+    self._children:typing.Dict[str, typing.Set[str]] = {'': set()}
+    self._data_offsets:typing.Dict[str, int] = {}
+    self._inflated:typing.Dict[str, bytes] = {}
+    self._mtime = status.st_mtime
+    for info in self._zip.infolist():
+      name = info.filename.rstrip('/')
+      if not name or name.startswith('/') or '..' in name.split('/'):
+        continue
+      self._entries[name] = info
+      if info.is_dir():
+        self._children.setdefault(name, set())
+      while name:
+        parent, _, child = name.rpartition('/')
+        self._children.setdefault(parent, set()).add(child)
+        name = parent
+
+  def Close(self) -> None:
+    self._zip.close()
+    self._file.close()
+
+  def Exists(self, path:str) -> bool:
+    return path in self._entries or path in self._children
+
+  def IsDirectory(self, path:str) -> bool:
+    return path in self._children
+
+  def _Mode(self, path:str) -> int:
+    info = self._entries.get(path, None)
+    mode = info.external_attr >> _MODE_SHIFT if info else 0
+    if path in self._children:
+      return stat.S_IFDIR | ((mode & 0o7777) or 0o755)
+    if not stat.S_IFMT(mode):
+      mode |= stat.S_IFREG
+    return mode if mode & 0o7777 else mode | 0o644
+
+  def Stat(self, path:str) -> typing.Dict[str, int|float]:
+    """The entry as os.lstat would see it if it were extracted."""
+    if not self.Exists(path):
+      raise FileNotFoundError(path)
+    info = self._entries.get(path, None)
+    mtime = self._mtime
+    if info is not None:
+      mtime = time.mktime(info.date_time + (0, 0, -1))
+    directory = path in self._children
+    return {
+      'st_atime': mtime,
+      'st_ctime': mtime,
+      'st_gid': self._owner[1],
+      'st_mode': self._Mode(path),
+      'st_mtime': mtime,
+      'st_nlink': 2 if directory else 1,
+      'st_size': 0 if directory else info.file_size,
+      'st_uid': self._owner[0],
+    }
+
+  def Access(self, path:str, mode:int) -> bool:
+    """Whether the owner of the archive would have |mode| access to |path|."""
+    if not self.Exists(path):
+      return False
+    permissions = self._Mode(path)
+    return not any(mode & wanted and not permissions & granted
+                   for wanted, granted in ((os.R_OK, stat.S_IRUSR),
+                                           (os.W_OK, stat.S_IWUSR),
+                                           (os.X_OK, stat.S_IXUSR)))
+
+  def Children(self, path:str) -> typing.Set[str]:
+    if path not in self._children:
+      raise NotADirectoryError(path)
+    return self._children[path]
+
+  def ReadLink(self, path:str) -> str:
+    if not stat.S_ISLNK(self._Mode(path)):
+      raise OSError(errno.EINVAL, 'Not a symlink', path)
+    return _Read(self._zip, self._fd, self._entries[path]).decode()
+
+  def _File(self, path:str) -> zipfile.ZipInfo:
+    if path in self._children:
+      raise IsADirectoryError(path)
+    if path not in self._entries:
+      raise FileNotFoundError(path)
+    return self._entries[path]
+
+  def Read(self, path:str, length:int, offset:int) -> bytes:
+    info = self._File(path)
+    if offset >= info.file_size:
+      return b''
+    length = min(length, info.file_size - offset)
+    if info.compress_type == zipfile.ZIP_STORED and not (
+        info.flag_bits & _ENCRYPTED):
+      if path not in self._data_offsets:
+        self._data_offsets[path] = _DataOffset(self._fd, info)
+      return os.pread(self._fd, length, self._data_offsets[path] + offset)
+    if path not in self._inflated:
+      self._inflated[path] = _Read(self._zip, self._fd, info)
+    return self._inflated[path][offset:offset + length]
+
+  def Release(self, path:str) -> None:
+    """Forgets the inflated contents of |path|, once nothing is reading it."""
+    self._inflated.pop(path, None)
+
+  def CopyTo(self, path:str, destination:str) -> None:
+    """Extracts the one entry |path| to |destination|."""
+    info = self._File(path)
+    mode = self._Mode(path)
+    if stat.S_ISLNK(mode):
+      os.symlink(self.ReadLink(path), destination)
+      return
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    _WriteFile(self._zip, self._fd, info, destination, mode, mtime)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from impulse.args import args
+from impulse.pkg import archive
+
+
+command = args.ArgumentParser(complete=True)
+
+
+def MakeFiles(root, count, size):
+  """Source-like files, spread over directories of 100."""
+  words = b'import def return class self None True for in if else '
+  filenames = []
+  for index in range(count):
+    filename = f'dir_{index // 100}/file_{index}.py'
+    os.makedirs(os.path.join(root, os.path.dirname(filename)), exist_ok=True)
+    with open(os.path.join(root, filename), 'wb') as f:
+      f.write((words * (size // len(words) + 1))[:size - 8] + os.urandom(8))
+    filenames.append(filename)
+  return filenames
+
+
+def ShellExport(package, filenames):
+  # The file list goes through stdin, a command line this long is past
+  # ARG_MAX for larger targets.
+  subprocess.run(f'zip -q --symlinks {package} -@', shell=True, check=True,
+                 input='\n'.join(filenames).encode())
+
+
+def ShellExtract(package, directory):
+  subprocess.run(f'unzip -q {package} -d {directory}', shell=True, check=True)
+
+
+def Time(run, repeat):
+  best = None
+  for attempt in range(repeat):
+    start = time.perf_counter()
+    run(attempt)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+@command
+def package(files:int=5000, size:int=2048, repeat:int=3):
+  """Times exporting and extracting one package of many files."""
+  root = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  try:
+    source = os.path.join(root, 'source')
+    filenames = MakeFiles(source, files, size)
+    os.chdir(source)
+    runs = [('zip/unzip', ShellExport, ShellExtract)] + [
+      (f'zipfile, level {level}',
+       lambda p, f, l=level: archive.Write(p, f, level=l), archive.Extract)
+      for level in (archive.STORED, 1, archive.DEFAULT_LEVEL)] + [
+      ('zipfile, by size', archive.Write, archive.Extract)]
+    print(f'{files} x {size} bytes:')
+    for index, (name, export, extract) in enumerate(runs):
+      # Every attempt gets new files, since removing the last attempt's leaves
+      # the filesystem busy long enough to slow the next one down.
+      package = lambda attempt: os.path.join(root, f'{index}_{attempt}.zip')
+      destination = lambda attempt: os.path.join(root, f'{index}_{attempt}')
+      export_time = Time(lambda a: export(package(a), filenames), repeat)
+      extract_time = Time(lambda a: extract(package(a), destination(a)), repeat)
+      print(f'  {name:18} export {export_time:.3f}s  '
+            f'extract {extract_time:.3f}s  '
+            f'{os.path.getsize(package(0)) / 1e6:.1f}MB')
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(root)
+
+
+@command
+def layer(files:int=5000, size:int=2048, repeat:int=3):
+  """Times extracting a package, against reading it in place as a layer."""
+  root = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  try:
+    filenames = MakeFiles(os.path.join(root, 'source'), files, size)
+    os.chdir(os.path.join(root, 'source'))
+    package = os.path.join(root, 'package.zip')
+    archive.Write(package, filenames)
+    def extracted(attempt):
+      archive.Extract(package, os.path.join(root, f'{attempt}'))
+    def indexed(attempt):
+      archive.Archive(package).Close()
+    def read(attempt):
+      layer = archive.Archive(package)
+      for filename in filenames:
+        layer.Read(filename, size, 0)
+        layer.Release(filename)
+      layer.Close()
+    print(f'{files} x {size} bytes:')
+    print(f'  extract            {Time(extracted, repeat):.3f}s')
+    print(f'  index in place     {Time(indexed, repeat):.3f}s')
+    print(f'  index, read all    {Time(read, repeat):.3f}s')
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(root)
+
+
+def main():
+  command.eval()
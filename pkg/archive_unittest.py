@@ -0,0 +1,128 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import zipfile
+
+from impulse.pkg import archive
+from impulse.testing import unittest
+
+
+class ArchiveTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    self.source = os.path.join(self.directory, 'source')
+    os.makedirs(os.path.join(self.source, 'lib', 'empty'))
+    os.chdir(self.source)
+    with open('lib/code.py', 'w') as f:
+      f.write('print("hi")\n' * 100)
+    with open('lib/run.sh', 'w') as f:
+      f.write('#!/bin/sh\n')
+    os.chmod('lib/run.sh', 0o755)
+    with open('lib/image.png', 'wb') as f:
+      f.write(os.urandom(1000))
+    os.symlink('code.py', 'lib/link.py')
+    self.files = ['lib/code.py', 'lib/run.sh', 'lib/image.png', 'lib/link.py',
+                  'lib/empty']
+
+  def cleanup(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def _Extracted(self, package:str) -> str:
+    destination = os.path.join(self.directory, 'extracted')
+    archive.Extract(package, destination)
+    return destination
+
+  def test_RoundTrip(self):
+    package = os.path.join(self.directory, 'package.zip')
+    missing = archive.Write(package, self.files + ['lib/gone'],
+                            {'pkg_contents.json': '{}'},
+                            level=archive.DEFAULT_LEVEL)
+    self.assertEqual(missing, ['lib/gone'])
+    out = self._Extracted(package)
+    self.assertEqual(open(f'{out}/pkg_contents.json').read(), '{}')
+    self.assertEqual(os.readlink(f'{out}/lib/link.py'), 'code.py')
+    self.assertEqual(open(f'{out}/lib/link.py').read(), 'print("hi")\n' * 100)
+    self.assertEqual(os.stat(f'{out}/lib/run.sh').st_mode & 0o777, 0o755)
+    self.assertTrue(os.path.isdir(f'{out}/lib/empty'))
+    self.assertEqual(int(os.stat(f'{out}/lib/code.py').st_mtime) // 2,
+                     int(os.stat('lib/code.py').st_mtime) // 2)
+    with zipfile.ZipFile(package) as z:
+      self.assertEqual(z.getinfo('lib/code.py').compress_type,
+                       zipfile.ZIP_DEFLATED)
+      self.assertEqual(z.getinfo('lib/image.png').compress_type,
+                       zipfile.ZIP_STORED)
+
+  def test_StoredLevel(self):
+    package = os.path.join(self.directory, 'package.zip')
+    archive.Write(package, self.files, level=archive.STORED)
+    with zipfile.ZipFile(package) as z:
+      self.assertEqual({i.compress_type for i in z.infolist()},
+                       {zipfile.ZIP_STORED})
+
+  def test_LevelIsPickedBySize(self):
+    package = os.path.join(self.directory, 'package.zip')
+    archive.Write(package, self.files)
+    with zipfile.ZipFile(package) as z:
+      self.assertEqual(z.getinfo('lib/code.py').compress_type,
+                       zipfile.ZIP_STORED)
+    with open('lib/big.txt', 'w') as f:
+      f.write('big\n' * (archive.SMALL_PACKAGE // 4))
+    archive.Write(package, self.files + ['lib/big.txt'])
+    with zipfile.ZipFile(package) as z:
+      self.assertEqual(z.getinfo('lib/code.py').compress_type,
+                       zipfile.ZIP_DEFLATED)
+      self.assertEqual(z.getinfo('lib/big.txt').compress_type,
+                       zipfile.ZIP_DEFLATED)
+      self.assertEqual(z.read('lib/big.txt'),
+                       b'big\n' * (archive.SMALL_PACKAGE // 4))
+
+  def test_ExtractsZipSymlinks(self):
+    if shutil.which('zip') is None:
+      return
+    package = os.path.join(self.directory, 'package.zip')
+    subprocess.run(['zip', '-q', '--symlinks', package] + self.files,
+                   check=True)
+    out = self._Extracted(package)
+    self.assertEqual(os.readlink(f'{out}/lib/link.py'), 'code.py')
+    self.assertEqual(os.stat(f'{out}/lib/run.sh').st_mode & 0o777, 0o755)
+
+  def test_EntriesCantEscape(self):
+    package = os.path.join(self.directory, 'package.zip')
+    for name in ('../escaped', '/escaped', 'lib/link/../../escaped'):
+      with zipfile.ZipFile(package, 'w') as z:
+        z.writestr(name, 'oops')
+      with unittest.ExpectException(self, ValueError):
+        self._Extracted(package)
+    self.assertFalse(os.path.exists(os.path.join(self.directory, 'escaped')))
+    with zipfile.ZipFile(package, 'w') as z:
+      link = zipfile.ZipInfo('lib/up')
+      link.external_attr = 0o120777 << 16
+      z.writestr(link, '../..')
+      z.writestr('lib/up/escaped', 'oops')
+    with unittest.ExpectException(self, ValueError):
+      self._Extracted(package)
+    self.assertFalse(os.path.exists(os.path.join(self.directory, 'escaped')))
+
+  def test_ReadsInPlace(self):
+    package = os.path.join(self.directory, 'package.zip')
+    archive.Write(package, self.files)
+    layer = archive.Archive(package)
+    try:
+      self.assertTrue(layer.IsDirectory('lib'))
+      self.assertEqual(layer.Children(''), {'lib'})
+      self.assertEqual(layer.Children('lib'), {'code.py', 'run.sh', 'image.png',
+                                               'link.py', 'empty'})
+      self.assertEqual(layer.Stat('lib/run.sh')['st_mode'] & 0o777, 0o755)
+      self.assertEqual(layer.Stat('lib/code.py')['st_size'], 1200)
+      self.assertEqual(layer.ReadLink('lib/link.py'), 'code.py')
+      self.assertEqual(layer.Read('lib/code.py', 6, 6), b'"hi")\n')
+      with open('lib/image.png', 'rb') as f:
+        self.assertEqual(layer.Read('lib/image.png', 100, 950), f.read()[950:])
+      self.assertFalse(layer.Exists('lib/gone'))
+      with unittest.ExpectException(self, FileNotFoundError):
+        layer.Read('lib/gone', 1, 0)
+    finally:
+      layer.Close()
@@ -0,0 +1,154 @@
+"""A reference server for the remote cache protocol, see remote_cache.py.
+
+Everything is kept in the same layout as a local ActionCache, and trimmed the
+same way, to --max_size. It is small enough to start on localhost in a test,
+and threaded enough to serve a team.
+"""
+
+import http.server
+import json
+import os
+import re
+import threading
+
+from impulse.pkg import action_cache
+from impulse.pkg import digest
+from impulse.pkg import remote_cache
+
+
+# Blob digests and action keys are hex; anything else could escape the store.
+_NAME = re.compile(r'[0-9a-f]{16,256}')
+MAX_ACTION_SIZE = 1 << 20
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _Parse(self) -> tuple[str, str, str]|None:
+    """The kind, name and path in the store of what is being asked for."""
+    parts = self.path.split('/')
+    if len(parts) != 3 or parts[0] or not _NAME.fullmatch(parts[2]):
+      return None
+    kind, name = parts[1], parts[2]
+    if kind == action_cache.BLOBS_DIR:
+      return kind, name, self.server.store.BlobPath(name)
+    if kind == action_cache.ACTIONS_DIR:
+      return kind, name, self.server.store.ActionPath(name)
+    return None
+
+  def _Respond(self, status:int, length:int=0):
+    self.send_response(status)
+    self.send_header('Content-Length', str(length))
+    self.end_headers()
+
+  def _Open(self):
+    request = self._Parse()
+    if request is None:
+      self._Respond(400)
+      return None
+    kind, name, path = request
+    try:
+      f = open(path, 'rb')
+    except FileNotFoundError:
+      self._Respond(404)
+      return None
+    if kind == action_cache.BLOBS_DIR:
+      self.server.store.Touch([name])
+    return f
+
+  def do_HEAD(self):
+    if f := self._Open():
+      with f:
+        self._Respond(200, os.fstat(f.fileno()).st_size)
+
+  def do_GET(self):
+    if f := self._Open():
+      with f:
+        self._Respond(200, os.fstat(f.fileno()).st_size)
+        while chunk := f.read(digest.BUFFER_SIZE):
+          self.wfile.write(chunk)
+
+  def do_PUT(self):
+    request = self._Parse()
+    length = self.headers.get('Content-Length', None)
+    if request is None or length is None or not length.isdigit():
+      self.close_connection = True
+      self._Respond(411 if request and length is None else 400)
+      return
+    kind, name, path = request
+    if kind == action_cache.ACTIONS_DIR:
+      self._Respond(self._PutAction(path, int(length)))
+    else:
+      self._Respond(self._PutBlob(path, name, int(length)))
+
+  def _PutAction(self, path:str, length:int) -> int:
+    if length > MAX_ACTION_SIZE:
+      self.close_connection = True
+      return 413
+    try:
+      result = action_cache.ActionResult.FromDict(
+        json.loads(self.rfile.read(length)))
+    except (ValueError, KeyError, TypeError):
+      return 400
+    with action_cache.AtomicWrite(path, 'w') as f:
+      json.dump(result.dict(), f)
+    return 200
+
+  def _PutBlob(self, path:str, name:str, length:int) -> int:
+    algorithm = self.headers.get(remote_cache.DIGEST_HEADER, None)
+    if algorithm not in digest.Available():
+      self.close_connection = True
+      return 400
+    hasher = digest.New(algorithm)
+    try:
+      with action_cache.AtomicWrite(path) as f:
+        while length:
+          chunk = self.rfile.read(min(length, digest.BUFFER_SIZE))
+          if not chunk:
+            raise ConnectionError('Upload ended early')
+          hasher.update(chunk)
+          f.write(chunk)
+          length -= len(chunk)
+        if hasher.hexdigest() != name:
+          raise ValueError('Upload does not match its digest')
+    except ValueError:
+      return 400
+    except ConnectionError:
+      self.close_connection = True
+      return 400
+    self.server.store.Added(name)
+    self.server.Stored(name, os.path.getsize(path))
+    return 200
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, directory:str, address:str='127.0.0.1', port:int=0,
+               max_size:int|None=None, verbose:bool=False):
+    super().__init__((address, port), _Handler)
+    self.store = action_cache.ActionCache(directory, digest.DEFAULT)
+    self.verbose = verbose
+    self._max_size = max_size
+    self._stored = 0
+    self._collecting = threading.Lock()
+
+  def Url(self) -> str:
+    host, port = self.server_address[:2]
+    return f'http://{host}:{port}'
+
+  def Stored(self, blob:str, size:int):
+    """Trims the store once a tenth of its cap has been uploaded."""
+    self.store.Touch([blob])
+    if self._max_size is None:
+      return
+    with self._collecting:
+      self._stored += size
+      if self._stored < self._max_size // 10:
+        return
+      self._stored = 0
+      self.store.Collect(self._max_size)
@@ -0,0 +1,72 @@
+"""Content digests of files, with a choice of hash function.
+
+BLAKE2b is the default, it is in hashlib and is a good deal faster than MD5.
+xxh3 is faster still, though it is only available when the xxhash module is
+installed. Whichever is used is recorded in every package, so that changing
+it rebuilds everything rather than comparing digests of different kinds.
+"""
+
+import hashlib
+import os
+import typing
+
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
+
+
+# Files are read this much at a time, small enough to not matter for memory,
+# large enough that the per-read overhead doesn't either.
+BUFFER_SIZE = 1 << 20
+
+BLAKE2B = 'blake2b'
+XXH3 = 'xxh3'
+MD5 = 'md5'
+DEFAULT = BLAKE2B
+
+# Set by `impulse build --digest`, and inherited by the workers.
+ENVIRONMENT_VARIABLE = 'impulse_digest'
+
+
+def _Factories() -> typing.Dict[str, typing.Callable]:
+  factories = {
+    BLAKE2B: lambda: hashlib.blake2b(digest_size=32),
+    MD5: hashlib.md5,
+  }
+  if xxhash is not None:
+    factories[XXH3] = xxhash.xxh3_128
+  return factories
+
+
+def Available() -> typing.List[str]:
+  return sorted(_Factories())
+
+
+def Configured() -> str:
+  """The algorithm this build uses."""
+  algorithm = os.environ.get(ENVIRONMENT_VARIABLE, DEFAULT)
+  if algorithm not in _Factories():
+    raise ValueError(f'Digest algorithm "{algorithm}" is not available, '
+                     f'expected one of {", ".join(Available())}')
+  return algorithm
+
+
+def New(algorithm:str=DEFAULT):
+  """A hashlib style object for |algorithm|."""
+  return _Factories()[algorithm]()
+
+
+def Compute(filename:str, algorithm:str=DEFAULT) -> bytes:
+  hasher = New(algorithm)
+  with open(filename, 'rb', buffering=0) as f:
+    if os.fstat(f.fileno()).st_size <= BUFFER_SIZE:
+      hasher.update(f.read())
+      return hasher.digest()
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+      size = f.readinto(buffer)
+      if not size:
+        return hasher.digest()
+      hasher.update(view[:size])
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from impulse.args import args
+from impulse.pkg import digest
+
+
+command = args.ArgumentParser(complete=True)
+
+
+def OldMD5(filename):
+  """How files used to be hashed, for comparison."""
+  hash_md5 = hashlib.md5()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(4096), b''):
+      hash_md5.update(chunk)
+  return hash_md5.digest()
+
+
+def MakeFiles(root, small, large, small_size, large_size):
+  filenames = []
+  for index in range(small + large):
+    size = small_size if index < small else large_size
+    filename = os.path.join(root, f'file_{index}')
+    with open(filename, 'wb') as f:
+      f.write(os.urandom(size))
+    filenames.append(filename)
+  return filenames
+
+
+def Time(filenames, compute, repeat):
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for filename in filenames:
+      compute(filename)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+@command
+def mixed(small:int=2000,
+          large:int=8,
+          small_size:int=4096,
+          large_size:int=64 * 1024 * 1024,
+          repeat:int=3):
+  """Times each digest algorithm over many small files and a few large ones."""
+  root = tempfile.mkdtemp()
+  try:
+    filenames = MakeFiles(root, small, large, small_size, large_size)
+    total = small * small_size + large * large_size
+    print(f'{small} x {small_size} bytes, {large} x {large_size} bytes:')
+    runs = [('md5, 4KiB reads', OldMD5)] + [
+      (algorithm, lambda f, a=algorithm: digest.Compute(f, a))
+      for algorithm in digest.Available()]
+    for name, compute in runs:
+      elapsed = Time(filenames, compute, repeat)
+      print(f'  {name:16} {elapsed:.3f}s  {total / elapsed / 1e6:.0f}MB/s')
+  finally:
+    shutil.rmtree(root)
+
+
+def main():
+  command.eval()
@@ -0,0 +1,261 @@
+"""Persistent cache of file digests, keyed on what stat says about the file.
+
+Checking whether a target needs to be rebuilt hashes every one of its inputs,
+and its BUILD and rule files, which for a no-op build means reading the whole
+tree again. This keeps each file's digest alongside its device, inode, size,
+mtime and ctime, so a file only has to be read again once one of those changes.
+
+The table is a single file of fixed size records, mapped into every process
+which uses it. It is an open addressed hash table on (device, inode), and
+every record carries a checksum, so a record torn by two processes writing it
+at once reads as a miss rather than as a wrong digest. Writers take a lock,
+readers don't.
+
+Files modified too recently are never cached. A filesystem only stores mtimes
+to some granularity, so a file could be written again right after it was
+hashed and still have the same size and times (git calls these files "racily
+clean"). Anything older than RACY_WINDOW_NS can't change without its stat
+changing, so that's what gets cached.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import typing
+import zlib
+
+from impulse.core import environment
+
+
+# The output directory, under the root.
+EXPORT_DIR = 'GENERATED'
+
+# One table per algorithm, so that builds using different ones don't keep
+# throwing away each other's.
+DIGEST_FILE = 'digests.{}.bin'
+
+MAGIC = b'IMPDGST1'
+# magic, algorithm, slot count, used slots.
+HEADER = struct.Struct('<8s16sQQ')
+HEADER_SIZE = 64
+# device, inode, size, mtime_ns, ctime_ns, digest length, digest, checksum.
+RECORD = struct.Struct('<QQqqqB32sI')
+RECORD_SIZE = 96
+MAX_DIGEST_SIZE = 32
+
+INITIAL_SLOTS = 1 << 14
+# The table is doubled once it is more than this full.
+MAX_LOAD = 0.5
+
+RACY_WINDOW_NS = 2 * 1000000000
+
+# The fields of a stat result a digest is valid for.
+StatKey = typing.Tuple[int, int, int, int, int]
+
+
+def Key(stat:os.stat_result) -> StatKey:
+  return (stat.st_dev, stat.st_ino, stat.st_size,
+          stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+def _Checksum(key:StatKey, digest:bytes) -> int:
+  return zlib.crc32(RECORD.pack(*key, len(digest), digest, 0)) or 1
+
+
+def _Slot(device:int, inode:int, slots:int) -> int:
+  return hash((device, inode)) & (slots - 1)
+
+
+class DigestCache(object):
+  """A digest table for one hash algorithm, stored in |filename|."""
+  def __init__(self, filename:str, algorithm:str,
+               slots:int=INITIAL_SLOTS, clock=time.time_ns):
+    self._filename = filename
+    self._algorithm = algorithm.encode()
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._fd = None
+    self._map = None
+    self._inode = None
+    self._slots = 0
+    self._Open(slots)
+
+  def _Open(self, slots:int):
+    os.makedirs(os.path.dirname(self._filename) or '.', exist_ok=True)
+    fd = os.open(self._filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.lockf(fd, fcntl.LOCK_EX)
+      try:
+        if not self._IsValid(fd):
+          self._Initialize(fd, slots)
+      finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+      self._Map(fd)
+    except:
+      os.close(fd)
+      raise
+
+  def _IsValid(self, fd:int) -> bool:
+    header = os.pread(fd, HEADER.size, 0)
+    if len(header) != HEADER.size:
+      return False
+    magic, algorithm, slots, _ = HEADER.unpack(header)
+    if magic != MAGIC or algorithm.rstrip(b'\0') != self._algorithm:
+      return False
+    if not slots or slots & (slots - 1):
+      return False
+    return os.fstat(fd).st_size == HEADER_SIZE + slots * RECORD_SIZE
+
+  def _Initialize(self, fd:int, slots:int):
+    os.ftruncate(fd, 0)
+    os.ftruncate(fd, HEADER_SIZE + slots * RECORD_SIZE)
+    os.pwrite(fd, HEADER.pack(MAGIC, self._algorithm, slots, 0), 0)
+
+  def _Map(self, fd:int):
+    self.Close()
+    self._fd = fd
+    self._inode = os.fstat(fd).st_ino
+    self._map = mmap.mmap(fd, 0)
+    self._slots = HEADER.unpack_from(self._map, 0)[2]
+
+  def Close(self):
+    if self._map is not None:
+      self._map.close()
+      os.close(self._fd)
+    self._map = None
+    self._fd = None
+
+  def _Records(self, device:int, inode:int) -> typing.Iterator[int]:
+    """Offsets of the records to probe for a file, in order."""
+    slot = _Slot(device, inode, self._slots)
+    for _ in range(self._slots):
+      yield HEADER_SIZE + slot * RECORD_SIZE
+      slot = (slot + 1) & (self._slots - 1)
+
+  def Lookup(self, key:StatKey) -> bytes|None:
+    """The digest of a file with exactly this stat key, if there is one."""
+    table = self._map
+    for offset in self._Records(key[0], key[1]):
+      try:
+        record = RECORD.unpack_from(table, offset)
+      except ValueError:
+        # Another thread replaced the table while this one was reading it.
+        return None
+      if not record[7]:
+        return None
+      if record[:2] != key[:2]:
+        continue
+      digest = record[6][:record[5]]
+      if record[:5] != key or record[7] != _Checksum(key, digest):
+        return None
+      return digest
+    return None
+
+  def _Reopen(self):
+    """Follows the table to a new file, if another process grew it."""
+    try:
+      if os.stat(self._filename).st_ino == self._inode:
+        return
+    except FileNotFoundError:
+      pass
+    self._Open(INITIAL_SLOTS)
+
+  def Store(self, key:StatKey, digest:bytes) -> bool:
+    """Stores the digest of a file, unless it was changed too recently."""
+    if len(digest) > MAX_DIGEST_SIZE:
+      return False
+    if self._clock() - max(key[3], key[4]) < RACY_WINDOW_NS:
+      return False
+    with self._lock:
+      self._Reopen()
+      fcntl.lockf(self._fd, fcntl.LOCK_EX)
+      try:
+        self._Insert(key, digest)
+      finally:
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+    return True
+
+  def _Insert(self, key:StatKey, digest:bytes):
+    used = HEADER.unpack_from(self._map, 0)[3]
+    if used + 1 > self._slots * MAX_LOAD:
+      self._Grow()
+      used = HEADER.unpack_from(self._map, 0)[3]
+    for offset in self._Records(key[0], key[1]):
+      record = RECORD.unpack_from(self._map, offset)
+      if record[7] and record[:2] != key[:2]:
+        continue
+      RECORD.pack_into(self._map, offset, *key, len(digest),
+                       digest, _Checksum(key, digest))
+      if not record[7]:
+        self._map[:HEADER.size] = HEADER.pack(
+          MAGIC, self._algorithm, self._slots, used + 1)
+      return
+
+  def _Grow(self):
+    """Rehashes everything into a table twice the size.
+
+    The new table is written next to the old one and then moved over it, so
+    processes which still have the old one mapped keep working until they
+    next write, which is when they notice it was replaced.
+    """
+    records = []
+    for slot in range(self._slots):
+      record = RECORD.unpack_from(self._map, HEADER_SIZE + slot * RECORD_SIZE)
+      if record[7]:
+        records.append(record)
+    replacement = f'{self._filename}.{os.getpid()}.tmp'
+    fd = os.open(replacement, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    self._Initialize(fd, self._slots * 2)
+    fcntl.lockf(fd, fcntl.LOCK_EX)
+    # Closing the old table also lets go of its lock.
+    self._Map(fd)
+    for record in records:
+      self._Insert(record[:5], record[6][:record[5]])
+    self._map.flush()
+    os.replace(replacement, self._filename)
+
+  def Digest(self, filename:str,
+             compute:typing.Callable[[str], bytes]) -> bytes:
+    """The digest of |filename|, only calling |compute| on a cache miss.
+
+    A file changed while |compute| read it isn't cached, since the digest may
+    be of neither version.
+    """
+    key = Key(os.stat(filename))
+    digest = self.Lookup(key)
+    if digest is not None:
+      return digest
+    digest = compute(filename)
+    if Key(os.stat(filename)) == key:
+      self.Store(key, digest)
+    return digest
+
+
+_CACHES:typing.Dict[typing.Tuple[str, str], DigestCache] = {}
+
+
+def ForOutputDirectory(algorithm:str) -> DigestCache|None:
+  """The shared cache in GENERATED/, or None if it can't be used."""
+  try:
+    filename = os.path.join(
+      environment.Root(), EXPORT_DIR, DIGEST_FILE.format(algorithm))
+  except LookupError:
+    return None
+  if (filename, algorithm) not in _CACHES:
+    try:
+      _CACHES[(filename, algorithm)] = DigestCache(filename, algorithm)
+    except OSError:
+      return None
+  return _CACHES[(filename, algorithm)]
+
+
+def _AfterFork() -> None:
+  # Another thread may have been storing a digest when this process forked,
+  # leaving a cache's lock held, and its table half replaced, forever.
+  _CACHES.clear()
+
+
+os.register_at_fork(after_in_child=_AfterFork)
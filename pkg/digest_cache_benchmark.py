@@ -0,0 +1,69 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from impulse.args import args
+from impulse.pkg import digest_cache
+
+
+command = args.ArgumentParser(complete=True)
+
+
+def MD5(filename):
+  hash_md5 = hashlib.md5()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(4096), b''):
+      hash_md5.update(chunk)
+  return hash_md5.digest()
+
+
+def MakeTree(root, files, size, per_directory=100):
+  filenames = []
+  for index in range(files):
+    directory = os.path.join(root, f'dir_{index // per_directory}')
+    if not index % per_directory:
+      os.makedirs(directory)
+    filename = os.path.join(directory, f'file_{index}.py')
+    with open(filename, 'wb') as f:
+      f.write(os.urandom(size))
+    filenames.append(filename)
+  return filenames
+
+
+def TimeChecks(filenames, digest):
+  start = time.perf_counter()
+  for filename in filenames:
+    digest(filename)
+  return time.perf_counter() - start
+
+
+@command
+def noop(files:int=20000,
+         size:int=16384,
+         directory:args.Directory=None):
+  """Times re-checking the digest of every file in a tree which hasn't changed.
+
+  This is the work a no-op build does for its input, BUILD and rule files.
+  """
+  root = tempfile.mkdtemp(dir=directory.value() if directory else None)
+  try:
+    filenames = MakeTree(os.path.join(root, 'src'), files, size)
+    # Nothing which was changed this recently would be cached.
+    time.sleep(digest_cache.RACY_WINDOW_NS / 1e9)
+    cache = digest_cache.DigestCache(
+      os.path.join(root, 'GENERATED', 'digests'), 'md5')
+    uncached = TimeChecks(filenames, MD5)
+    cold = TimeChecks(filenames, lambda f: cache.Digest(f, MD5))
+    warm = TimeChecks(filenames, lambda f: cache.Digest(f, MD5))
+    print(f'{files} files of {size} bytes:')
+    print(f'  no cache:   {uncached:.3f}s')
+    print(f'  cold cache: {cold:.3f}s')
+    print(f'  warm cache: {warm:.3f}s ({uncached / warm:.1f}x faster)')
+  finally:
+    shutil.rmtree(root)
+
+
+def main():
+  command.eval()
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from impulse.pkg import digest_cache
+from impulse.testing import unittest
+
+
+def AnHourLater():
+  """A clock for which every file was changed well outside the racy window."""
+  return time.time_ns() + 3600 * 1000000000
+
+
+class DigestCacheTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.table = os.path.join(self.directory, 'GENERATED', 'digests.bin')
+    self.computed = []
+
+  def cleanup(self):
+    shutil.rmtree(self.directory)
+
+  def Compute(self, filename):
+    self.computed.append(filename)
+    with open(filename, 'rb') as f:
+      return hashlib.md5(f.read()).digest()
+
+  def Write(self, name, content, mtime_ns=None):
+    filename = os.path.join(self.directory, name)
+    with open(filename, 'w') as f:
+      f.write(content)
+    if mtime_ns is not None:
+      os.utime(filename, ns=(mtime_ns, mtime_ns))
+    return filename
+
+  def Expected(self, content):
+    return hashlib.md5(content.encode()).digest()
+
+  def test_UnchangedFileIsOnlyReadOnce(self):
+    cache = digest_cache.DigestCache(self.table, 'md5', clock=AnHourLater)
+    filename = self.Write('a.py', 'print("a")')
+    self.assertEqual(cache.Digest(filename, self.Compute),
+                     self.Expected('print("a")'))
+    self.assertEqual(cache.Digest(filename, self.Compute),
+                     self.Expected('print("a")'))
+    self.assertEqual(self.computed, [filename])
+
+  def test_RecentlyChangedFileIsNotCached(self):
+    cache = digest_cache.DigestCache(self.table, 'md5')
+    filename = self.Write('a.py', 'first')
+    mtime_ns = os.stat(filename).st_mtime_ns
+    self.assertEqual(cache.Digest(filename, self.Compute),
+                     self.Expected('first'))
+    # Same size and mtime, like a second write within the same tick of a
+    # filesystem's clock.
+    self.Write('a.py', 'other', mtime_ns=mtime_ns)
+    self.assertEqual(cache.Digest(filename, self.Compute),
+                     self.Expected('other'))
+    self.assertEqual(len(self.computed), 2)
+
+  def test_EditKeepingSizeAndMtimeIsNoticed(self):
+    cache = digest_cache.DigestCache(self.table, 'md5', clock=AnHourLater)
+    filename = self.Write('a.py', 'first')
+    mtime_ns = os.stat(filename).st_mtime_ns
+    self.assertEqual(cache.Digest(filename, self.Compute),
+                     self.Expected('first'))
+    # Putting the mtime back still changes the ctime.
+    time.sleep(0.01)
+    self.Write('a.py', 'other', mtime_ns=mtime_ns)
+    self.assertEqual(os.stat(filename).st_mtime_ns, mtime_ns)
+    self.assertEqual(cache.Digest(filename, self.Compute),
+                     self.Expected('other'))
+    self.assertEqual(len(self.computed), 2)
+
+  def test_PersistsAcrossGrowth(self):
+    cache = digest_cache.DigestCache(
+      self.table, 'md5', slots=4, clock=AnHourLater)
+    files = [self.Write(f'{i}.py', str(i)) for i in range(20)]
+    for filename in files:
+      cache.Digest(filename, self.Compute)
+    cache.Close()
+
+    reopened = digest_cache.DigestCache(self.table, 'md5', clock=AnHourLater)
+    for i, filename in enumerate(files):
+      self.assertEqual(reopened.Digest(filename, self.Compute),
+                       self.Expected(str(i)))
+    self.assertEqual(self.computed, files)
+
+  def test_OtherAlgorithmStartsOver(self):
+    cache = digest_cache.DigestCache(self.table, 'md5', clock=AnHourLater)
+    filename = self.Write('a.py', 'a')
+    cache.Digest(filename, self.Compute)
+    cache.Close()
+
+    other = digest_cache.DigestCache(self.table, 'sha256')
+    self.assertEqual(other.Lookup(digest_cache.Key(os.stat(filename))), None)
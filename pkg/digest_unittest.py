@@ -0,0 +1,36 @@
+import hashlib
+import os
+import tempfile
+
+from impulse.pkg import digest
+from impulse.testing import unittest
+
+
+class DigestTest(unittest.TestCase):
+  def setup(self):
+    self.file = tempfile.NamedTemporaryFile(delete=False)
+
+  def cleanup(self):
+    os.unlink(self.file.name)
+
+  def test_LargeFilesAreReadInPieces(self):
+    content = os.urandom(digest.BUFFER_SIZE * 2 + 12345)
+    self.file.write(content)
+    self.file.close()
+    self.assertEqual(digest.Compute(self.file.name, digest.BLAKE2B),
+                     hashlib.blake2b(content, digest_size=32).digest())
+    self.assertEqual(digest.Compute(self.file.name, digest.MD5),
+                     hashlib.md5(content).digest())
+
+  def test_ConfiguredFromEnvironment(self):
+    self.file.close()
+    old = os.environ.pop(digest.ENVIRONMENT_VARIABLE, None)
+    try:
+      self.assertEqual(digest.Configured(), digest.DEFAULT)
+      os.environ[digest.ENVIRONMENT_VARIABLE] = 'crc'
+      with unittest.ExpectException(self, ValueError):
+        digest.Configured()
+    finally:
+      os.environ.pop(digest.ENVIRONMENT_VARIABLE, None)
+      if old is not None:
+        os.environ[digest.ENVIRONMENT_VARIABLE] = old
@@ -0,0 +1,150 @@
+"""Hashes files on a thread pool, and only once each.
+
+Checking whether a target is up to date, and recording what it was built
+from, both hash every one of its input files. hashlib lets go of the GIL
+while it hashes, so those can be spread over threads, and a file several
+targets use only has to be hashed by the first of them.
+
+Digests are remembered along with the file's stat key, so a file which
+changes is hashed again, even in a build server which lives across builds.
+"""
+
+import concurrent.futures
+import os
+import threading
+import typing
+
+from impulse.pkg import digest
+from impulse.pkg import digest_cache
+
+
+# Digests are forgotten past this many, they are in the digest cache anyway.
+MAX_REMEMBERED = 1 << 16
+
+# What the digest of a file which doesn't exist is.
+MISSING = '----'
+
+
+def Digest(filename:str, algorithm:str) -> str:
+  """The hex digest of |filename|, read through the digest cache."""
+  def compute(filename):
+    return digest.Compute(filename, algorithm)
+  try:
+    cache = digest_cache.ForOutputDirectory(algorithm)
+    if cache is None:
+      return compute(filename).hex()
+    return cache.Digest(filename, compute).hex()
+  except FileNotFoundError:
+    return MISSING
+
+
+def Uncached(filename:str, algorithm:str) -> str:
+  """The hex digest of |filename|, read without the digest cache."""
+  try:
+    return digest.Compute(filename, algorithm).hex()
+  except FileNotFoundError:
+    return MISSING
+
+
+def Digester(algorithm:str=None) -> typing.Callable[[str], str]:
+  """Digest for a single algorithm, the configured one by default."""
+  algorithm = algorithm or digest.Configured()
+  return lambda filename: Digest(filename, algorithm)
+
+
+class HashingPool(object):
+  def __init__(self, workers:int=None):
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=workers, thread_name_prefix='Hasher')
+    self._lock = threading.Lock()
+    self._digests:typing.Dict[tuple, concurrent.futures.Future] = {}
+
+  def Submit(self, filename:str, algorithm:str) -> concurrent.futures.Future:
+    # Relative paths are resolved now, other threads may change directory.
+    filename = os.path.abspath(filename)
+    try:
+      key = (algorithm, filename, digest_cache.Key(os.stat(filename)))
+    except FileNotFoundError:
+      key = (algorithm, filename, None)
+    with self._lock:
+      future = self._digests.get(key, None)
+      if future is None:
+        if len(self._digests) >= MAX_REMEMBERED:
+          self._digests = {k: f for k, f in self._digests.items()
+                           if not f.done()}
+        future = self._executor.submit(Digest, filename, algorithm)
+        self._digests[key] = future
+      return future
+
+  def SubmitUncached(self, filename:str,
+                     algorithm:str) -> concurrent.futures.Future:
+    """Hashes |filename| without the digest cache, and without remembering it.
+
+    For files whose stat doesn't tell them apart from others, like those in a
+    FUSE sandbox, where inodes and devices are reused by the next mount.
+    """
+    return self._executor.submit(Uncached, os.path.abspath(filename), algorithm)
+
+  def Digests(self, filenames:typing.Iterable[str],
+              algorithm:str) -> typing.List[str]:
+    """The digests of all of |filenames|, in order."""
+    futures = [self.Submit(f, algorithm) for f in filenames]
+    return [future.result() for future in futures]
+
+  def FirstChanged(self, expected:typing.Iterable[typing.Tuple[str, str]],
+                   algorithm:str) -> str|None:
+    """The first filename in |expected| which doesn't have its digest.
+
+    Once one is found, the rest are left to finish hashing in the background,
+    since a target which needs building is going to want them anyway.
+    """
+    expected = list(expected)
+    futures = [self.Submit(f, algorithm) for f, _ in expected]
+    for (filename, wanted), future in zip(expected, futures):
+      if future.result() != wanted:
+        return filename
+    return None
+
+  def Settle(self) -> None:
+    """Cancels hashing which hasn't started, and waits for what has.
+
+    A process about to fork calls this, so that no hasher is holding a lock
+    the child would inherit.
+    """
+    with self._lock:
+      pending = [(k, f) for k, f in self._digests.items() if not f.done()]
+      for key, future in pending:
+        if future.cancel():
+          del self._digests[key]
+    concurrent.futures.wait([f for _, f in pending if not f.cancelled()])
+
+
+_POOL:HashingPool|None = None
+_POOL_LOCK = threading.Lock()
+
+
+def Shared() -> HashingPool:
+  """The pool for this process; a forked worker doesn't get its parent's."""
+  global _POOL
+  with _POOL_LOCK:
+    if _POOL is None:
+      _POOL = HashingPool()
+    return _POOL
+
+
+def Settle() -> None:
+  """Settles this process's pool, if it has one."""
+  with _POOL_LOCK:
+    pool = _POOL
+  if pool is not None:
+    pool.Settle()
+
+
+def _AfterFork() -> None:
+  # The parent's hashers weren't copied, and its lock may have been held.
+  global _POOL, _POOL_LOCK
+  _POOL = None
+  _POOL_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_AfterFork)
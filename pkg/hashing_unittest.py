@@ -0,0 +1,115 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from impulse.pkg import digest
+from impulse.pkg import digest_cache
+from impulse.pkg import hashing
+from impulse.testing import unittest
+
+
+class HashingPoolTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.old_root = os.environ.get('impulse_root', None)
+    os.environ['impulse_root'] = self.directory
+    self.pool = hashing.HashingPool(4)
+
+  def cleanup(self):
+    if self.old_root is None:
+      os.environ.pop('impulse_root', None)
+    else:
+      os.environ['impulse_root'] = self.old_root
+    shutil.rmtree(self.directory)
+
+  def Write(self, name, content):
+    filename = os.path.join(self.directory, name)
+    with open(filename, 'w') as f:
+      f.write(content)
+    return filename
+
+  def Expected(self, content):
+    return hashlib.blake2b(content.encode(), digest_size=32).hexdigest()
+
+  def test_SameFileIsOnlyHashedOnce(self):
+    filename = self.Write('a.py', 'a')
+    first = self.pool.Submit(filename, digest.BLAKE2B)
+    self.assertEqual(first.result(), self.Expected('a'))
+    self.assertTrue(self.pool.Submit(filename, digest.BLAKE2B) is first)
+
+    self.Write('a.py', 'changed')
+    second = self.pool.Submit(filename, digest.BLAKE2B)
+    self.assertEqual(second.result(), self.Expected('changed'))
+
+  def test_Digests(self):
+    files = [self.Write(f'{i}.py', str(i)) for i in range(10)]
+    self.assertEqual(self.pool.Digests(files + [files[0]], digest.BLAKE2B),
+                     [self.Expected(str(i)) for i in range(10)] +
+                     [self.Expected('0')])
+    self.assertEqual(
+      self.pool.Digests([os.path.join(self.directory, 'nope')],
+                        digest.BLAKE2B),
+      [hashing.MISSING])
+
+  def test_FirstChanged(self):
+    files = [self.Write(f'{i}.py', str(i)) for i in range(10)]
+    expected = [(f, self.Expected(str(i))) for i, f in enumerate(files)]
+    self.assertEqual(self.pool.FirstChanged(expected, digest.BLAKE2B), None)
+    expected[3] = (files[3], 'old')
+    expected[7] = (files[7], 'old')
+    self.assertEqual(self.pool.FirstChanged(expected, digest.BLAKE2B),
+                     files[3])
+
+  def test_SubmitUncached(self):
+    filename = self.Write('a.py', 'a')
+    os.utime(filename, ns=(0, 0))
+    future = self.pool.SubmitUncached(filename, digest.BLAKE2B)
+    self.assertEqual(future.result(), self.Expected('a'))
+    cache = digest_cache.ForOutputDirectory(digest.BLAKE2B)
+    self.assertEqual(cache.Lookup(digest_cache.Key(os.stat(filename))), None)
+    self.assertEqual(
+      self.pool.SubmitUncached(filename + '.nope', digest.BLAKE2B).result(),
+      hashing.MISSING)
+
+  def test_SettleCancelsWhatHasntStarted(self):
+    files = [self.Write(f'{i}.py', str(i)) for i in range(10)]
+    started, release = threading.Event(), threading.Event()
+    pool = hashing.HashingPool(1)
+    # Keeps the only hasher busy, so that none of these start.
+    pool._executor.submit(lambda: started.set() or release.wait())
+    started.wait()
+    futures = [pool.Submit(f, digest.BLAKE2B) for f in files]
+    pool.Settle()
+    self.assertTrue(all(f.cancelled() for f in futures))
+    release.set()
+    # Nothing cancelled is handed out again.
+    self.assertEqual(pool.Digests(files, digest.BLAKE2B),
+                     [self.Expected(str(i)) for i in range(10)])
+
+  def test_ForkedChildDoesntInheritLocks(self):
+    filename = self.Write('a.py', 'a')
+    os.utime(filename, ns=(0, 0))
+    cache = digest_cache.ForOutputDirectory(digest.BLAKE2B)
+    # As if a hasher thread were storing a digest at the time of the fork.
+    with cache._lock, hashing._POOL_LOCK:
+      pid = os.fork()
+      if not pid:
+        status = 1
+        try:
+          digests = hashing.Shared().Digests([filename], digest.BLAKE2B)
+          status = 0 if digests == [self.Expected('a')] else 2
+        finally:
+          os._exit(status)
+    deadline = time.time() + 10
+    waited, status = os.waitpid(pid, os.WNOHANG)
+    while not waited and time.time() < deadline:
+      time.sleep(0.01)
+      waited, status = os.waitpid(pid, os.WNOHANG)
+    if not waited:
+      os.kill(pid, 9)
+      os.waitpid(pid, 0)
+    self.assertTrue(waited)
+    self.assertEqual(status, 0)
@@ -0,0 +1,206 @@
+"""What every sandbox does, and a sandbox which is a kernel overlay mount.
+
+A sandbox is a context manager which, while entered, shows a job its inputs
+in a directory. Some can only be seen from a process of their own, so a job
+does everything which needs the sandbox through Run.
+
+Mounting an overlay normally takes root. In a new user namespace though, the
+process which made it has every capability over a new mount namespace too,
+and linux (5.11 onwards) lets that mount an overlay. Nothing mounted there is
+visible outside of it, and it all goes away with the last process in it.
+"""
+
+import ctypes
+import io
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import typing
+
+from impulse.core import exceptions
+from impulse.pkg import hashing
+
+
+# The kernel stacks at most 500 layers, and the options have to fit in a page.
+MAX_LAYERS = 300
+
+# Whether overlays can be mounted in a user namespace here, once checked.
+_AVAILABLE:bool|None = None
+
+T = typing.TypeVar('T')
+
+
+class Sandbox(object):
+  """The interface to a sandbox."""
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def Run(self, job:typing.Callable[[], T]) -> T:
+    """Runs |job| where it can see the sandbox, and returns what it returns."""
+    return job()
+
+
+def _Unshare() -> None:
+  """Moves this process into new user and mount namespaces."""
+  uid, gid = os.getuid(), os.getgid()
+  os.unshare(os.CLONE_NEWUSER | os.CLONE_NEWNS)
+  # Everybody keeps their own ids, so that files are owned as they would be
+  # outside, and tools which behave differently for root don't.
+  with open('/proc/self/setgroups', 'w') as f:
+    f.write('deny')
+  with open('/proc/self/uid_map', 'w') as f:
+    f.write(f'{uid} {uid} 1')
+  with open('/proc/self/gid_map', 'w') as f:
+    f.write(f'{gid} {gid} 1')
+
+
+def _MountOverlay(directory:str, lowerdirs:typing.List[str]) -> None:
+  """Mounts an overlay on |directory| with its upper and work in the cwd."""
+  options = f'lowerdir={":".join(lowerdirs)},upperdir=upper,workdir=work'
+  libc = ctypes.CDLL(None, use_errno=True)
+  if libc.mount(b'overlay', directory.encode(), b'overlay', 0,
+                options.encode()):
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error), directory)
+
+
+def _Exception(cls:type, args:tuple, state:dict) -> BaseException:
+  error = cls.__new__(cls, *args)
+  error.args = args
+  error.__dict__.update(state)
+  return error
+
+
+class _Pickler(pickle.Pickler):
+  """Pickles exceptions without needing to call their __init__ again.
+
+  Most take the parts of their message, while their args are the message.
+  """
+  def reducer_override(self, obj):
+    if isinstance(obj, BaseException):
+      return _Exception, (type(obj), obj.args, obj.__dict__)
+    return NotImplemented
+
+
+def _Pickled(obj:typing.Any) -> bytes:
+  data = io.BytesIO()
+  _Pickler(data).dump(obj)
+  return data.getvalue()
+
+
+def _Forked(child:typing.Callable[[], bytes]) -> typing.Tuple[bytes, int]:
+  """Runs |child| in a fork, returning what it returned and its exit status."""
+  hashing.Settle()
+  read, write = os.pipe()
+  pid = os.fork()
+  if not pid:
+    status = 1
+    try:
+      os.close(read)
+      data = child()
+      with os.fdopen(write, 'wb') as f:
+        f.write(data)
+      status = 0
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      # Never back into the parent's code, or its atexit handlers.
+      os._exit(status)
+  os.close(write)
+  with os.fdopen(read, 'rb') as f:
+    data = f.read()
+  _, status = os.waitpid(pid, 0)
+  return data, status
+
+
+def Available() -> bool:
+  """Whether this thread can run jobs in a KernelOverlay.
+
+  Forking copies only the forking thread, but also any lock another thread
+  held at the time, so jobs on threads other than the main one don't. The
+  main thread's own hashers are settled before every fork instead.
+  """
+  global _AVAILABLE
+  if threading.current_thread() is not threading.main_thread():
+    return False
+  if _AVAILABLE is None:
+    _AVAILABLE = False
+    if hasattr(os, 'unshare') and os.path.exists('/proc/self/uid_map'):
+      rw = tempfile.mkdtemp()
+      try:
+        with KernelOverlay(os.path.join(rw, 'mount'), rw, []) as overlay:
+          _AVAILABLE = not _Forked(lambda: overlay._Mount() or b'')[1]
+      finally:
+        shutil.rmtree(rw)
+  return _AVAILABLE
+
+
+class KernelOverlay(Sandbox):
+  """An overlay of |lowerdirs| on |directory|, the first on top.
+
+  It is mounted for each Run, in a new process with namespaces of its own.
+  Writes go to |rw|, along with links to the |lowerdirs| which keep the
+  mount options short.
+  """
+  def __init__(self, directory:str, rw:str, lowerdirs:typing.List[str]):
+    self._directory = os.path.abspath(directory)
+    self._rw = rw
+    # There has to be at least one.
+    self._lowerdirs = lowerdirs or [os.path.join(rw, 'empty')]
+
+  def __enter__(self):
+    os.makedirs(self._directory, exist_ok=True)
+    for name in ('lower', 'upper', 'work', 'empty'):
+      os.makedirs(os.path.join(self._rw, name), exist_ok=True)
+    for index, lowerdir in enumerate(self._lowerdirs):
+      os.symlink(os.path.abspath(lowerdir),
+                 os.path.join(self._rw, 'lower', str(index)))
+    return self
+
+  def __exit__(self, *args):
+    # The kernel leaves a directory in work which nobody can read, which would
+    # stop anyone but root from removing it.
+    work = os.path.join(self._rw, 'work', 'work')
+    if os.path.isdir(work):
+      os.chmod(work, 0o700)
+
+  def _Mount(self) -> None:
+    """Mounts the overlay, in new namespaces for this process."""
+    os.chdir(self._rw)
+    _Unshare()
+    lowerdirs = [f'lower/{index}' for index in range(len(self._lowerdirs))]
+    _MountOverlay(self._directory, lowerdirs)
+
+  def Run(self, job:typing.Callable[[], T]) -> T:
+    """Runs |job| in a process which can see the overlay.
+
+    What it returns or raises is pickled back to this process, so it is only
+    a copy of what the job ended up with.
+    """
+    def child() -> bytes:
+      try:
+        self._Mount()
+        result = (True, job())
+      except BaseException as e:
+        result = (False, e)
+      try:
+        return _Pickled(result)
+      except Exception as e:
+        # Like anything defined by a rule, which isn't importable here.
+        message = str(result[1]) if not result[0] else (
+          f'What the job returned can\'t be sent back: {e}')
+        return _Pickled((False, exceptions.ImpulseBaseException(message)))
+    data, status = _Forked(child)
+    if not data:
+      raise exceptions.ImpulseBaseException(
+        f'The sandbox on {self._directory} exited with status {status}')
+    returned, result = pickle.loads(data)
+    if not returned:
+      raise result
+    return result
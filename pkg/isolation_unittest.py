@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+
+from impulse.core import exceptions
+from impulse.pkg import isolation
+from impulse.testing import unittest
+
+
+class KernelOverlayTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    self.lower = [os.path.join(self.directory, name) for name in ('a', 'b')]
+    for lower in self.lower:
+      os.makedirs(os.path.join(lower, 'include'))
+      with open(os.path.join(lower, 'include', 'shared.h'), 'w') as f:
+        f.write(lower)
+    with open(os.path.join(self.lower[1], 'include', 'b.h'), 'w') as f:
+      f.write('b')
+    self.mount = os.path.join(self.directory, 'mount')
+    self.rw = os.path.join(self.directory, 'rw')
+
+  def cleanup(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def test_RunsInTheOverlay(self):
+    if not isolation.Available():
+      return
+    def job():
+      os.chdir(self.mount)
+      with open('include/b.h', 'a') as f:
+        f.write(' changed')
+      with open('output', 'w') as f:
+        f.write('output')
+      return sorted(os.listdir('include')), open('include/shared.h').read()
+    with isolation.KernelOverlay(self.mount, self.rw, self.lower) as overlay:
+      self.assertEqual(overlay.Run(job),
+                       (['b.h', 'shared.h'], self.lower[0]))
+    self.assertEqual(os.listdir(self.mount), [])
+    self.assertEqual(open(os.path.join(self.lower[1], 'include', 'b.h')).read(),
+                     'b')
+    self.assertEqual(open(os.path.join(self.rw, 'upper', 'output')).read(),
+                     'output')
+
+  def test_RaisesWhatTheJobRaises(self):
+    if not isolation.Available():
+      return
+    class Local(Exception):
+      pass
+    def job():
+      raise exceptions.InvalidPathException('path', 'reason')
+    def unpicklable():
+      raise Local('local')
+    with isolation.KernelOverlay(self.mount, self.rw, self.lower) as overlay:
+      with unittest.ExpectException(self, exceptions.InvalidPathException):
+        overlay.Run(job)
+      with unittest.ExpectException(self, exceptions.ImpulseBaseException):
+        overlay.Run(unpicklable)
@@ -7,23 +7,71 @@ import os
 import shutil
 import signal
 import subprocess
+import threading
 import typing
 
 from impulse.fuse import fuse
 from impulse.core import exceptions
+from impulse.pkg import archive
+from impulse.pkg import isolation
 
 def ACCESS_ERR():
   raise fuse.FuseOSError(errno.EACCES)
 
 
+# Files which are read out of a package archive rather than opened on disk get
+# handles from here, well out of the way of any real file descriptor.
+FIRST_ARCHIVE_HANDLE = 1 << 32
+
+# Where copies of read-only files are made in the rw directory, before they
+# take the place of the original.
+COPY_UP_DIRECTORY = '.copy-up'
+
+# How many seconds the kernel may keep what it looked up, found or not, and
+# file attributes, before asking again. Only the mount itself writes to its rw
+# directory and the kernel sees all of that, so these can be long.
+ENTRY_TIMEOUT = 60.0
+NEGATIVE_TIMEOUT = 60.0
+ATTR_TIMEOUT = 60.0
+
+
+class Archived(typing.NamedTuple):
+  """A read-only node which is an entry in a package archive."""
+  layer: archive.Archive
+  path: str
+
+
 class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
-  """Backend file operations for the overlay filesystem."""
+  """Backend file operations for the overlay filesystem.
+
+  Read-only layers are either directories, or package archives which are
+  read in place. Nodes in a directory are their paths, and nodes in an
+  archive are Archived entries.
+
+  Operations can be called from several threads at once. Reads and writes
+  of open files don't wait on each other, but everything which changes what
+  the overlay looks like (copying up, hiding nodes, and the tables of open
+  handles) happens under one lock.
+  """
   def __init__(self, queue, rw_dir: str, ro_dirs:typing.List[str], shadow_files:dict):
     self.ready_queue = queue
 
     self._rw_directory = rw_dir
-    self._ro_directories = ro_dirs
-    self._ro_files = shadow_files
+    self._ro_directories = [d for d in ro_dirs if not os.path.isfile(d)]
+    self._ro_archives = [archive.Archive(d) for d in ro_dirs
+                         if os.path.isfile(d)]
+    self._ro_files:typing.Dict[str, str] = {}
+
+    # An index of the directories |_ro_files| are in, so that nothing has to
+    # look through all of them. Each directory counts the files under each of
+    # its children, and the real directories which those files are in at the
+    # same depth, which is what a lookup of the directory finds.
+    self._ro_file_children:typing.DefaultDict[str, collections.Counter] = (
+      collections.defaultdict(collections.Counter))
+    self._ro_file_sources:typing.DefaultDict[str, collections.Counter] = (
+      collections.defaultdict(collections.Counter))
+    for name, source in shadow_files.items():
+      self._add_ro_file(name.lstrip('/'), source)
 
      # Set of strings representing files that shouldn't be shown as
      # they have been moved away.
@@ -34,6 +82,18 @@ class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
     # mapping from {filename -> {handle -> (handle, open-flags)}}
     self._open_files:typing.DefaultDict[str, dict] = collections.defaultdict(dict)
 
+    # Handles of files being read out of archives.
+    self._archive_handles:typing.Dict[int, Archived] = {}
+    self._next_archive_handle = FIRST_ARCHIVE_HANDLE
+
+    # Reentrant, since copy-on-write operations find nodes and open files.
+    self._lock = threading.RLock()
+
+    # The nodes of the read-only layers at each path looked up so far, or
+    # that there are none. Those layers never change, so neither do these,
+    # and whatever has been hidden since is left out on each lookup.
+    self._ro_lookups:typing.Dict[str, typing.List[str|Archived]] = {}
+
   def _find_shadow_nodes(
         self, path:str, files:bool = False
         ) -> typing.Tuple[str, typing.List[str]]:
@@ -45,85 +105,115 @@ class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
     if os.path.exists(rw_copy) and path != '':
       return (rw_copy, [])
 
-    result = set()
-    for directory in self._ro_directories:
-      full_path = os.path.join(directory, path)
-      if os.path.exists(full_path) and full_path not in self._moved_files:
-        result.add(full_path)
-
-    if files:
-      for f in self._live_ro_files():
-        named_dir, maybe_for_read = self._chop_ro_file_to_fit(f, path)
-        if named_dir and maybe_for_read:
-          result.add(maybe_for_read)
-
-    return (rw_copy, list(result))
-
-  def _live_ro_files(self) -> typing.Iterator[str]:
-    for f in self._ro_files.keys():
-      if f not in self._moved_files:
-        yield f
-
-  def _get_next_element_of(self, f:str, direct:str) -> typing.Tuple[str, str]:
-    ffq = self._ro_files.get(f, None)
-    if not ffq:
-      return '', ''
-    while len(f) >= len(direct):
-      b = os.path.basename(f)
-      f = os.path.dirname(f)
-      ffq = os.path.dirname(ffq)
-      if f == direct:
-        return b, os.path.join(ffq, b)
-    return '', ''
-
-  def _chop_ro_file_to_fit(self, f:str, search:str) -> typing.Tuple[str, str]:
-    ffq = self._ro_files.get(f, None)
-    if not ffq:
-      return '', ''
-    while len(f) >= len(search):
-      b = os.path.basename(f)
-      if f == search:
-        return b, ffq
-      if f == '/':
-        return '', ''
-      f = os.path.dirname(f)
-      ffq = os.path.dirname(ffq)
-    return '', ''
-
-  def _chop_ro_file_to_fit_original(self, f:str, directory:str
-                                   ) -> typing.Tuple[str, str]:
-    ffq = self._ro_files.get(f, None)
-    if not ffq:
-      return '', ''
-    while len(f) >= len(directory):
-      b = os.path.basename(f)
-      f = os.path.dirname(f)
-      ffq = os.path.dirname(ffq)
-      if f == directory:
-        return b, os.path.join(ffq, b)
-    return '', ''
-
-  def _fallback_on_read(self, path:str, operation):
+    result = []
+    if files and path:
+      with self._lock:
+        if path in self._ro_files:
+          result.append(self._ro_files[path])
+        if path in self._ro_file_sources:
+          result.extend(self._ro_file_sources[path])
+    result.extend(node for node in self._lookup_ro_nodes(path)
+                  if node not in self._moved_files)
+
+    return (rw_copy, list(dict.fromkeys(result)))
+
+  def _lookup_ro_nodes(self, path:str) -> typing.List[str|Archived]:
+    nodes = self._ro_lookups.get(path, None)
+    if nodes is None:
+      nodes = [os.path.join(directory, path)
+               for directory in self._ro_directories
+               if os.path.exists(os.path.join(directory, path))]
+      nodes += [Archived(layer, path.rstrip('/'))
+                for layer in self._ro_archives
+                if layer.Exists(path.rstrip('/'))]
+      self._ro_lookups[path] = nodes
+    return nodes
+
+  def _add_ro_file(self, name:str, source:str, count:int=1) -> None:
+    """Indexes |name|, or with a |count| of -1, forgets it."""
+    if count > 0:
+      self._ro_files[name] = source
+    else:
+      del self._ro_files[name]
+    while name:
+      parent, child = os.path.dirname(name), os.path.basename(name)
+      source = os.path.dirname(source)
+      self._ro_file_children[parent][child] += count
+      if not self._ro_file_children[parent][child]:
+        del self._ro_file_children[parent][child]
+        if not self._ro_file_children[parent]:
+          del self._ro_file_children[parent]
+      # The root is always the rw directory.
+      if parent:
+        self._ro_file_sources[parent][source] += count
+        if not self._ro_file_sources[parent][source]:
+          del self._ro_file_sources[parent][source]
+          if not self._ro_file_sources[parent]:
+            del self._ro_file_sources[parent]
+      name = parent
+
+  def _ro_files_under(self, path:str) -> typing.Iterator[str]:
+    """Every one of |_ro_files| which is |path|, or in it."""
+    if path in self._ro_files:
+      yield path
+    for child in list(self._ro_file_children.get(path, ())):
+      yield from self._ro_files_under(os.path.join(path, child))
+
+  def _move_ro_files(self, old:str, new:str|None) -> bool:
+    """Moves the |_ro_files| at or under |old| to |new|, or forgets them.
+
+    Returns whether there were any.
+    """
+    moved = list(self._ro_files_under(old))
+    for name in moved:
+      source = self._ro_files[name]
+      self._add_ro_file(name, source, -1)
+      if new is not None:
+        self._add_ro_file(new + name[len(old):], source)
+    return bool(moved)
+
+  def _fallback_on_read(self, path:str, operation, archived=None):
     path, ro_nodes = self._find_shadow_nodes(path, True)
     if ro_nodes: # RW version doesn't exist
+      if isinstance(ro_nodes[0], Archived):
+        return archived(ro_nodes[0])
       return operation(ro_nodes[0])
     return operation(path)
 
+  def _copy_up(self, ro_node:str|Archived, rw_path:str) -> None:
+    # Copied aside and then renamed into place, so that operations which
+    # don't take the lock never see half a copy.
+    staging = os.path.join(self._rw_directory, COPY_UP_DIRECTORY)
+    partial = os.path.join(staging, 'partial')
+    os.makedirs(staging, exist_ok=True)
+    if os.path.lexists(partial):
+      os.unlink(partial)
+    os.makedirs(os.path.dirname(rw_path), exist_ok=True)
+    if isinstance(ro_node, Archived):
+      ro_node.layer.CopyTo(ro_node.path, partial)
+    else:
+      shutil.copyfile(ro_node, partial)
+    os.rename(partial, rw_path)
+
   def _unmap_handle(self, path:str, handle:str) -> str:
-    mapped_handle, flags = self._open_files[path].get(handle, (handle, 0))
+    with self._lock:
+      mapped_handle, flags = self._open_files.get(path, {}).get(
+        handle, (handle, 0))
     # If the file was remapped to something else, we need to open that instead.
     return handle if mapped_handle == -1 else mapped_handle
 
   def _hide_RO_nodes(self, ro_nodes:typing.List[str]) -> None:
-    self._moved_files.update(ro_nodes)
+    with self._lock:
+      self._moved_files.update(ro_nodes)
 
   def _change_file(self, path: str, operation, failure=ACCESS_ERR):
-    writable_node, ro_nodes = self._find_shadow_nodes(path)
-    if ro_nodes: # no RW version of the file could be found - 
-                 # we need to copy it. The operation will be called
-                 # in the next block.
-      shutil.copyfile(ro_nodes[0], writable_node)
-    return operation(writable_node)
+    with self._lock:
+      writable_node, ro_nodes = self._find_shadow_nodes(path)
+      if ro_nodes: # no RW version of the file could be found - 
+                   # we need to copy it. The operation will be called
+                   # in the next block.
+        self._copy_up(ro_nodes[0], writable_node)
+      return operation(writable_node)
 
 
   # Copy on write methods - these change properties of the file which
@@ -154,27 +244,31 @@ class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
 
   def mkdir(self, path, mode):
     path, _ = self._find_shadow_nodes(path)
-    if not os.path.exists(path):
-      return os.makedirs(path, mode)
+    return os.makedirs(path, mode, exist_ok=True)
 
   def truncate(self, path, length, fh=None):
-    rw, ros = self._find_shadow_nodes(path)
-    if ros:
-      shutil.copyfile(ros[0], rw)
-    with open(rw, 'r+') as f:
-      f.truncate(length)
+    with self._lock:
+      rw, ros = self._find_shadow_nodes(path)
+      if ros:
+        self._copy_up(ros[0], rw)
+    os.truncate(rw, length)
 
   
   # Delete methods - important to mark these files as deleted!
   def rmdir(self, path):
-    path, RO_nodes = self._find_shadow_nodes(path)
-    self._hide_RO_nodes(RO_nodes)
-    return os.rmdir(path)
+    with self._lock:
+      path, RO_nodes = self._find_shadow_nodes(path)
+      self._hide_RO_nodes(RO_nodes)
+      return os.rmdir(path)
 
   def unlink(self, path):
-    path, RO_nodes = self._find_shadow_nodes(path)
-    self._hide_RO_nodes(RO_nodes)
-    return os.unlink(path)
+    with self._lock:
+      rw_path, RO_nodes = self._find_shadow_nodes(path)
+      self._hide_RO_nodes(RO_nodes)
+      mapped = self._move_ro_files(path.lstrip('/'), None)
+      if (RO_nodes or mapped) and not os.path.lexists(rw_path):
+        return
+      return os.unlink(rw_path)
 
 
   # Read-only methods - easy, they never modify anything.
@@ -186,7 +280,8 @@ class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
       return dict((k, getattr(st, k)) for k in attrs)
     if path == '/':
       return stat(self._rw_directory)
-    return self._fallback_on_read(path, stat)
+    return self._fallback_on_read(
+      path, stat, lambda node: node.layer.Stat(node.path))
 
   def statfs(self, path):
     def statvfs(path):
@@ -194,24 +289,40 @@ class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
       return dict((k, getattr(stv, k)) for k in (
         'f_bavail', 'f_bfree', 'f_blocks', 'f_bsize', 'f_favail', 'f_ffree',
         'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
-    return self._fallback_on_read(path, statvfs)
+    return self._fallback_on_read(
+      path, statvfs, lambda node: statvfs(node.layer.filename))
 
   def access(self, path, mode):
     def osaccess(path):
       if not os.access(path, mode):
         ACCESS_ERR()
-    return self._fallback_on_read(path, osaccess)
+    def archive_access(node):
+      if not node.layer.Access(node.path, mode):
+        ACCESS_ERR()
+    return self._fallback_on_read(path, osaccess, archive_access)
 
   def readlink(self, path):
     def _readlink(path):
       return os.readlink(path)
-    return self._fallback_on_read(path, _readlink)
+    return self._fallback_on_read(
+      path, _readlink, lambda node: node.layer.ReadLink(node.path))
 
 
   # IO methods
+  def _open_archived(self, node:Archived) -> int:
+    if node.layer.IsDirectory(node.path):
+      raise fuse.FuseOSError(errno.EISDIR)
+    with self._lock:
+      handle = self._next_archive_handle
+      self._next_archive_handle += 1
+      self._archive_handles[handle] = node
+    return handle
+
   def open(self, original_path, flags, mode=None):
     if flags & (os.O_RDONLY|os.O_WRONLY|os.O_RDWR) == os.O_RDONLY:
-      return self._fallback_on_read(original_path, lambda p: os.open(p, flags))
+      # Nothing is copied or recorded, so this doesn't need the lock.
+      return self._fallback_on_read(
+        original_path, lambda p: os.open(p, flags), self._open_archived)
     def copy_on_write_open(path):
       file_desc = None
       if mode is None:
@@ -224,14 +335,25 @@ class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
         # is used to re-open the file after a write causing a copy.
         self._open_files[original_path][file_desc] = (-1, flags)
       return file_desc
-    return self._fallback_on_read(original_path, copy_on_write_open)
+    def archived_open(node):
+      # There's nothing to write to in an archive, so it's copied right away.
+      rw_file, _ = self._find_shadow_nodes(original_path)
+      self._copy_up(node, rw_file)
+      return copy_on_write_open(rw_file)
+    with self._lock:
+      return self._fallback_on_read(
+        original_path, copy_on_write_open, archived_open)
 
   def read(self, path, length, offset, handle):
-    handle = self._unmap_handle(path, handle)
-    os.lseek(handle, offset, os.SEEK_SET)
-    return os.read(handle, length)
+    node = self._archive_handles.get(handle, None)
+    if node is not None:
+      return node.layer.Read(node.path, length, offset)
+    # Threads share handles, so there is no file position to rely on.
+    return os.pread(self._unmap_handle(path, handle), length, offset)
 
   def flush(self, path, handle):
+    if handle in self._archive_handles:
+      return 0
     handle = self._unmap_handle(path, handle)
     return os.fsync(handle)
 
@@ -240,83 +362,126 @@ class OverlayFilesystemOperations(fuse.Operations):  # type: ignore
     return self.flush(path, handle)
 
   def release(self, path, handle):
-    closehandle = handle
-    if handle in self._open_files[path]:
-      closehandle = self._open_files[path].pop(handle)[0]
-    os.close(closehandle)
+    with self._lock:
+      if handle in self._archive_handles:
+        node = self._archive_handles.pop(handle)
+        if node not in self._archive_handles.values():
+          node.layer.Release(node.path)
+        return
+      closehandles = [handle]
+      if handle in self._open_files.get(path, {}):
+        # Both the original, and the copy it was remapped to.
+        mapped_handle = self._open_files[path].pop(handle)[0]
+        if mapped_handle != -1:
+          closehandles.append(mapped_handle)
+        if not self._open_files[path]:
+          del self._open_files[path]
+    for closehandle in closehandles:
+      os.close(closehandle)
 
   def write(self, path, buf, offset, handle):
-    mapped_handle, flags = self._open_files[path].get(handle, (handle, 0))
-    if mapped_handle == -1: # This is a COW file, and needs to be copied!
-      rw_file, ro_files = self._find_shadow_nodes(path)
-      if ro_files:
-        shutil.copyfile(ro_files[0], rw_file)
-      self._open_files[path][handle] = (os.open(rw_file, flags), flags)
-    handle = self._unmap_handle(path, handle)
-    os.lseek(handle, offset, os.SEEK_SET)
-    return os.write(handle, buf)
+    with self._lock:
+      mapped_handle, flags = self._open_files.get(path, {}).get(
+        handle, (handle, 0))
+      if mapped_handle == -1: # This is a COW file, and needs to be copied!
+        rw_file, ro_files = self._find_shadow_nodes(path)
+        if ro_files:
+          self._copy_up(ro_files[0], rw_file)
+        self._open_files[path][handle] = (os.open(rw_file, flags), flags)
+    return os.pwrite(self._unmap_handle(path, handle), buf, offset)
 
   def create(self, path, mode, fi=None):
     rw_file, ro_files = self._find_shadow_nodes(path)
     if ro_files:
       raise "Can't create a file that already exists (i think?)"
-    if not os.path.exists(os.path.dirname(rw_file)):
-      os.makedirs(os.path.dirname(rw_file))
+    os.makedirs(os.path.dirname(rw_file), exist_ok=True)
     return self.open(path, os.O_RDWR | os.O_CREAT, mode)
 
   def readdir(self, path, fh):
     rw_dir, ro_dirs = self._find_shadow_nodes(path)
     dirents = set(['.', '..'])
     for rwo_dir in ro_dirs + [rw_dir]:
-      if os.path.isdir(rwo_dir):
+      if isinstance(rwo_dir, Archived):
+        if rwo_dir.layer.IsDirectory(rwo_dir.path):
+          dirents.update(rwo_dir.layer.Children(rwo_dir.path))
+      elif os.path.isdir(rwo_dir):
         dirents.update(os.listdir(rwo_dir))
       elif os.path.exists(rwo_dir):
         dirents.update([rwo_dir])
 
-    for f in self._live_ro_files():
-      named_dir, _ = self._get_next_element_of(f, path[1:])
-      if named_dir:
-        dirents.update([named_dir])
+    with self._lock:
+      dirents.update(self._ro_file_children.get(path[1:], ()))
+    if path == '/':
+      dirents.discard(COPY_UP_DIRECTORY)
     return list(dirents)
 
   def rename(self, old, new):
-    rw_old, ro_old = self._find_shadow_nodes(old)
-    rw_new, ro_new = self._find_shadow_nodes(new)
-    self._moved_files.update(ro_new) # any files which could be backing
-                                     # the new location need to be marked hidden
-
-    if ro_old: # The source file was read-only in the old location
-      shutil.copyfile(ro_old[0], rw_new)
-      self._moved_files.update(ro_old) # Hide all source files
-    elif os.path.exists(rw_old): # File is in RW, so just move it.
-      shutil.move(rw_old, rw_new)
+    with self._lock:
+      rw_old, ro_old = self._find_shadow_nodes(old)
+      rw_new, ro_new = self._find_shadow_nodes(new)
+      self._moved_files.update(ro_new) # any files which could be backing
+                                       # the new location need to be marked
+                                       # hidden
+
+      # Files mapped into the mount have nothing to copy, they just take on
+      # the new name.
+      mapped = old.lstrip('/') in self._ro_files
+      self._move_ro_files(new.lstrip('/'), None)
+      self._move_ro_files(old.lstrip('/'), new.lstrip('/'))
+
+      if mapped:
+        self._moved_files.update(ro_old)
+        if os.path.isfile(rw_new):
+          os.unlink(rw_new)
+      elif ro_old: # The source file was read-only in the old location
+        self._copy_up(ro_old[0], rw_new)
+        self._moved_files.update(ro_old) # Hide all source files
+      elif os.path.exists(rw_old): # File is in RW, so just move it.
+        shutil.move(rw_old, rw_new)
 
   def init(self, path_ready):
     self.ready_queue.put('ready')
 
 
-def run_fuse_thread(q, mount, rw_file, shadow_dirs, shadow_files):
+def run_fuse_thread(q, mount, rw_file, shadow_dirs, shadow_files, threads,
+                    timeouts):
   fuse.FUSE(OverlayFilesystemOperations(q, rw_file, shadow_dirs, shadow_files),
-    mount, nothreads=True, foreground=True)
+    mount, nothreads=not threads, foreground=True, **timeouts)
+
 
+class FuseCTX(isolation.Sandbox):
+  """Mounts an overlay of |shadows|, which are directories or package archives.
 
-class FuseCTX(object):
-  def __init__(self, mountpoint, rw, files=None, *shadows):
+  Writes go to |rw|, and |files| maps paths in the mount to single files.
+  With |threads|, it is served by libfuse's multithreaded loop, which isn't
+  the default until `overlayfs_benchmark mount` shows it is faster.
+  The timeouts are how long the kernel caches lookups, see above.
+  """
+  def __init__(self, mountpoint, rw, files=None, *shadows, threads=False,
+               attr_timeout=ATTR_TIMEOUT, entry_timeout=ENTRY_TIMEOUT,
+               negative_timeout=NEGATIVE_TIMEOUT):
     self._mount = mountpoint
     self._rw = rw
-    self._shadow_dirs = []
+    self._shadow_dirs = list(shadows)
     self._files = files or {}
-    for shadow in shadows:
-      if not os.path.isfile(shadow):
-        self._shadow_dirs.append(shadow)
+    self._threads = threads
+    self._timeouts = {'attr_timeout': attr_timeout,
+                      'entry_timeout': entry_timeout,
+                      'negative_timeout': negative_timeout}
 
   def __enter__(self):
-    self._oldsignal = signal.signal(signal.SIGINT, self._quit)
+    # Signal handlers can only be installed from the main thread, which jobs
+    # on the thread executor aren't.
+    self._oldsignal = None
+    if threading.current_thread() is threading.main_thread():
+      self._oldsignal = signal.signal(signal.SIGINT, self._quit)
     readyq = multiprocessing.Queue()
     self._thread = multiprocessing.Process(target=run_fuse_thread,
-      args=(readyq, self._mount, self._rw, self._shadow_dirs, self._files))
+      args=(readyq, self._mount, self._rw, self._shadow_dirs, self._files,
+            self._threads, self._timeouts))
     self._thread.start()
     readyq.get()
+    return self
 
   def __exit__(self, *args):
     self._quit()
@@ -331,4 +496,5 @@ class FuseCTX(object):
     if result.returncode:
       raise exceptions.FilesystemSyncException()
     self._thread.join()
-    signal.signal(signal.SIGINT, self._oldsignal)
+    if self._oldsignal is not None:
+      signal.signal(signal.SIGINT, self._oldsignal)
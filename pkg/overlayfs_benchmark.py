@@ -0,0 +1,212 @@
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from impulse.args import args
+from impulse.pkg import overlayfs
+
+
+command = args.ArgumentParser(complete=True)
+
+
+def MakeFiles(root, count, size):
+  filenames = []
+  for index in range(count):
+    filename = f'dir_{index // 100}/file_{index}.h'
+    os.makedirs(os.path.join(root, os.path.dirname(filename)), exist_ok=True)
+    with open(os.path.join(root, filename), 'wb') as f:
+      f.write(os.urandom(size))
+    filenames.append(filename)
+  return filenames
+
+
+def MakeLayers(root, layers, headers):
+  """Dependency layers, each with |headers| headers in its own include path.
+
+  Returns the include directories, and the headers as they're included.
+  """
+  roots, includes, filenames = [], [], []
+  for layer in range(layers):
+    roots.append(os.path.join(root, f'layer_{layer}'))
+    includes.append(f'dep_{layer}/include')
+    for index in range(headers):
+      filename = f'dep_{layer}/header_{index}.h'
+      path = os.path.join(roots[-1], includes[-1], filename)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'w') as f:
+        f.write('#pragma once\n')
+        f.write(f'inline int function_{layer}_{index}() {{ return {index}; }}\n')
+      filenames.append(filename)
+  return roots, includes, filenames
+
+
+def Include(operations, includes, filename):
+  """Finds |filename| the way a compiler would, with every include path."""
+  for include in includes:
+    try:
+      return operations.getattr(f'/{include}/{filename}')
+    except FileNotFoundError:
+      pass
+  raise FileNotFoundError(filename)
+
+
+def Parallel(work, items, threads):
+  """Runs |work| on every item, from |threads| threads, returning the time."""
+  start = time.perf_counter()
+  with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+    list(pool.map(work, items))
+  return time.perf_counter() - start
+
+
+@command
+def ops(files:int=2000, size:int=8192, threads:int=8):
+  """Times reading through the operations from one thread, and from many.
+
+  This needs no FUSE, so it only shows what the locking costs and how much
+  the operations themselves can overlap.
+  """
+  root = tempfile.mkdtemp()
+  try:
+    ro = os.path.join(root, 'ro')
+    rw = os.path.join(root, 'rw')
+    os.makedirs(rw)
+    filenames = MakeFiles(ro, files, size)
+    operations = overlayfs.OverlayFilesystemOperations(None, rw, [ro], {})
+    def read(filename):
+      path = f'/{filename}'
+      operations.getattr(path)
+      handle = operations.open(path, os.O_RDONLY)
+      operations.read(path, size, 0, handle)
+      operations.release(path, handle)
+    print(f'{files} x {size} bytes:')
+    for count in (1, threads):
+      elapsed = Parallel(read, filenames, count)
+      print(f'  {count:2} threads  {elapsed:.3f}s  {files / elapsed:.0f} files/s')
+  finally:
+    shutil.rmtree(root)
+
+
+@command
+def lookups(files:int=5000, lookups:int=2000):
+  """Times looking up and listing files mapped into the overlay."""
+  root = tempfile.mkdtemp()
+  try:
+    ro = os.path.join(root, 'ro')
+    rw = os.path.join(root, 'rw')
+    os.makedirs(rw)
+    filenames = MakeFiles(ro, files, 16)
+    operations = overlayfs.OverlayFilesystemOperations(
+      None, rw, [], {f: os.path.join(ro, f) for f in filenames})
+    paths = [f'/{filenames[index * files // lookups]}'
+             for index in range(lookups)]
+    directories = sorted({os.path.dirname(path) for path in paths})
+    print(f'{files} files:')
+    start = time.perf_counter()
+    for path in paths:
+      operations.getattr(path)
+    elapsed = time.perf_counter() - start
+    print(f'  getattr  {lookups / elapsed:.0f}/s')
+    start = time.perf_counter()
+    for directory in directories:
+      operations.readdir(directory, None)
+    elapsed = time.perf_counter() - start
+    print(f'  readdir  {len(directories) / elapsed:.0f}/s')
+  finally:
+    shutil.rmtree(root)
+
+
+@command
+def includes(layers:int=20, headers:int=50, sources:int=20):
+  """Times finding headers across the include paths of many layers.
+
+  Nearly every lookup is for a path which doesn't exist, and each source
+  looks up the same ones again.
+  """
+  root = tempfile.mkdtemp()
+  try:
+    rw = os.path.join(root, 'rw')
+    os.makedirs(rw)
+    roots, paths, filenames = MakeLayers(root, layers, headers)
+    operations = overlayfs.OverlayFilesystemOperations(None, rw, roots, {})
+    print(f'{sources} sources, each including {len(filenames)} headers from '
+          f'{layers} layers:')
+    start = time.perf_counter()
+    for _ in range(sources):
+      for filename in filenames:
+        Include(operations, paths, filename)
+    elapsed = time.perf_counter() - start
+    lookups = sources * len(filenames) * (layers + 1) // 2
+    print(f'  {elapsed:.3f}s  {lookups / elapsed:.0f} lookups/s')
+  finally:
+    shutil.rmtree(root)
+
+
+@command
+def cc_compile(layers:int=20, headers:int=50, sources:int=20,
+               compiler:str='c++'):
+  """Times compiling sources in a mount, with and without kernel caching."""
+  if not os.path.exists('/dev/fuse') or shutil.which('fusermount') is None:
+    print('FUSE is unavailable, there is no /dev/fuse')
+    return
+  if shutil.which(compiler) is None:
+    print(f'{compiler} is not installed')
+    return
+  root = tempfile.mkdtemp()
+  try:
+    roots, paths, filenames = MakeLayers(root, layers, headers)
+    files = {}
+    for index in range(sources):
+      filename = os.path.join(root, f'source_{index}.cc')
+      with open(filename, 'w') as f:
+        f.writelines(f'#include "{header}"\n' for header in filenames)
+      files[f'source_{index}.cc'] = filename
+    flags = [f'-I{path}' for path in paths]
+    print(f'{sources} sources, each including {len(filenames)} headers from '
+          f'{layers} layers:')
+    for cached in (False, True):
+      directory = tempfile.mkdtemp(dir=root)
+      rw = tempfile.mkdtemp(dir=root)
+      timeouts = {} if cached else {
+        'attr_timeout': 0, 'entry_timeout': 0, 'negative_timeout': 0}
+      with overlayfs.FuseCTX(directory, rw, files, *roots, **timeouts):
+        start = time.perf_counter()
+        for source in files:
+          subprocess.run([compiler, '-c', *flags, source, '-o', f'{source}.o'],
+                         cwd=directory, check=True)
+        elapsed = time.perf_counter() - start
+      caching = 'cached' if cached else 'uncached'
+      print(f'  {caching:8}  {elapsed:.3f}s  {sources / elapsed:.1f} compiles/s')
+  finally:
+    shutil.rmtree(root)
+
+
+@command
+def mount(files:int=2000, size:int=8192, readers:int=8):
+  """Times |readers| processes reading a mount, served by one thread or many."""
+  if not os.path.exists('/dev/fuse') or shutil.which('fusermount') is None:
+    print('FUSE is unavailable, there is no /dev/fuse')
+    return
+  root = tempfile.mkdtemp()
+  try:
+    ro = os.path.join(root, 'ro')
+    filenames = MakeFiles(ro, files, size)
+    chunks = [filenames[index::readers] for index in range(readers)]
+    print(f'{files} x {size} bytes, {readers} readers:')
+    for threads in (False, True):
+      directory = tempfile.mkdtemp(dir=root)
+      rw = tempfile.mkdtemp(dir=root)
+      with overlayfs.FuseCTX(directory, rw, {}, ro, threads=threads):
+        elapsed = Parallel(lambda chunk: subprocess.run(
+          ['cat'] + chunk, cwd=directory, stdout=subprocess.DEVNULL,
+          check=True), chunks, readers)
+      served = 'threads' if threads else 'one thread'
+      print(f'  {served:10}  {elapsed:.3f}s  {files / elapsed:.0f} files/s')
+  finally:
+    shutil.rmtree(root)
+
+
+def main():
+  command.eval()
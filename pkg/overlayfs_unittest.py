@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from impulse.pkg import archive
+from impulse.pkg import overlayfs
+from impulse.testing import unittest
+
+
+class ArchiveLayerTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    source = os.path.join(self.directory, 'source')
+    os.makedirs(os.path.join(source, 'dep'))
+    os.chdir(source)
+    with open('dep/lib.h', 'w') as f:
+      f.write('int lib();\n')
+    self.package = os.path.join(self.directory, 'dep.zip')
+    archive.Write(self.package, ['dep/lib.h'], {'pkg_contents.json': '{}'})
+    os.chdir(self.cwd)
+    self.rw = os.path.join(self.directory, 'rw')
+    os.makedirs(self.rw)
+    self.ops = overlayfs.OverlayFilesystemOperations(
+      None, self.rw, [self.package], {})
+
+  def cleanup(self):
+    shutil.rmtree(self.directory)
+
+  def test_ReadsFromTheArchive(self):
+    self.assertEqual(set(self.ops.readdir('/', None)),
+                     {'.', '..', 'dep', 'pkg_contents.json'})
+    self.assertEqual(self.ops.getattr('/dep/lib.h')['st_size'], 11)
+    handle = self.ops.open('/dep/lib.h', os.O_RDONLY)
+    self.assertEqual(self.ops.read('/dep/lib.h', 3, 4, handle), b'lib')
+    self.ops.release('/dep/lib.h', handle)
+    self.assertFalse(os.path.exists(os.path.join(self.rw, 'dep')))
+
+  def test_WritingCopiesUp(self):
+    handle = self.ops.open('/dep/lib.h', os.O_WRONLY)
+    self.ops.write('/dep/lib.h', b'long', 0, handle)
+    self.ops.release('/dep/lib.h', handle)
+    with open(os.path.join(self.rw, 'dep/lib.h')) as f:
+      self.assertEqual(f.read(), 'longlib();\n')
+    handle = self.ops.open('/dep/lib.h', os.O_RDONLY)
+    self.assertEqual(self.ops.read('/dep/lib.h', 4, 0, handle), b'long')
+    self.ops.release('/dep/lib.h', handle)
+
+  def test_LookupsSeeChanges(self):
+    with unittest.ExpectException(self, FileNotFoundError):
+      self.ops.getattr('/dep/new.h')
+    self.assertEqual(self.ops.getattr('/dep/lib.h')['st_size'], 11)
+    self.ops.release('/dep/new.h', self.ops.create('/dep/new.h', 0o644))
+    self.assertEqual(self.ops.getattr('/dep/new.h')['st_size'], 0)
+    self.ops.unlink('/dep/lib.h')
+    with unittest.ExpectException(self, FileNotFoundError):
+      self.ops.getattr('/dep/lib.h')
+    self.assertEqual(set(self.ops.readdir('/dep', None)), {'.', '..', 'new.h'})
+
+
+class ShadowFilesTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.source = os.path.join(self.directory, 'source')
+    os.makedirs(os.path.join(self.source, 'src', 'lib'))
+    for name in ('src/main.cc', 'src/lib/lib.cc', 'src/lib/lib.h'):
+      with open(os.path.join(self.source, name), 'w') as f:
+        f.write(name)
+    self.rw = os.path.join(self.directory, 'rw')
+    os.makedirs(self.rw)
+    self.ops = overlayfs.OverlayFilesystemOperations(None, self.rw, [], {
+      'src/main.cc': os.path.join(self.source, 'src/main.cc'),
+      'src/lib/lib.cc': os.path.join(self.source, 'src/lib/lib.cc'),
+      'src/lib/lib.h': os.path.join(self.source, 'src/lib/lib.h'),
+    })
+
+  def cleanup(self):
+    shutil.rmtree(self.directory)
+
+  def _Read(self, path):
+    handle = self.ops.open(path, os.O_RDONLY)
+    try:
+      return self.ops.read(path, 100, 0, handle)
+    finally:
+      self.ops.release(path, handle)
+
+  def test_ShowsTheirDirectories(self):
+    self.assertEqual(set(self.ops.readdir('/', None)), {'.', '..', 'src'})
+    self.assertEqual(set(self.ops.readdir('/src', None)),
+                     {'.', '..', 'main.cc', 'lib'})
+    self.assertEqual(set(self.ops.readdir('/src/lib', None)),
+                     {'.', '..', 'lib.cc', 'lib.h'})
+    self.assertEqual(self.ops.getattr('/src/lib/lib.h')['st_size'], 13)
+    self.assertEqual(self._Read('/src/main.cc'), b'src/main.cc')
+
+  def test_UnlinkingHidesThem(self):
+    self.ops.unlink('/src/lib/lib.cc')
+    self.assertEqual(set(self.ops.readdir('/src/lib', None)),
+                     {'.', '..', 'lib.h'})
+    self.ops.unlink('/src/lib/lib.h')
+    self.assertEqual(set(self.ops.readdir('/src', None)),
+                     {'.', '..', 'main.cc'})
+    self.assertTrue(os.path.exists(os.path.join(self.source, 'src/lib/lib.h')))
+
+  def test_RenamingMovesThem(self):
+    self.ops.rename('/src/main.cc', '/src/lib/lib.cc')
+    self.assertEqual(set(self.ops.readdir('/src', None)), {'.', '..', 'lib'})
+    self.assertEqual(self._Read('/src/lib/lib.cc'), b'src/main.cc')
+    self.assertEqual(os.listdir(self.rw), [])
+
+
+# Each thread writes its own byte of every shared file.
+THREADS = 8
+FILES = 4
+ROUNDS = 25
+# Large enough that copying one up takes a while.
+SIZE = 1 << 20
+
+
+class ThreadSafetyTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.ro = os.path.join(self.directory, 'ro')
+    os.makedirs(os.path.join(self.ro, 'src'))
+    for index in range(FILES):
+      with open(os.path.join(self.ro, 'src', f'{index}.c'), 'wb') as f:
+        f.write(b'.' * SIZE)
+    self.rw = os.path.join(self.directory, 'rw')
+    os.makedirs(os.path.join(self.rw, 'out'))
+    self.ops = overlayfs.OverlayFilesystemOperations(
+      None, self.rw, [self.ro], {})
+
+  def cleanup(self):
+    shutil.rmtree(self.directory)
+
+  def _Work(self, thread:int) -> None:
+    mark = bytes([ord('a') + thread])
+    for round in range(ROUNDS):
+      # Every thread copies up and writes its own byte of the shared files.
+      shared = f'/src/{round % FILES}.c'
+      handle = self.ops.open(shared, os.O_WRONLY)
+      self.ops.write(shared, mark, thread, handle)
+      self.ops.release(shared, handle)
+      handle = self.ops.open(shared, os.O_RDONLY)
+      contents = self.ops.read(shared, SIZE, 0, handle)
+      self.ops.release(shared, handle)
+      if len(contents) != SIZE or contents[thread:thread + 1] != mark:
+        raise AssertionError(f'{shared} has {contents[:THREADS]}')
+      # And makes, renames and reads back files of its own.
+      made = f'/out/{thread}_{round}'
+      handle = self.ops.create(made, 0o644)
+      self.ops.write(made, mark * 10, 0, handle)
+      self.ops.release(made, handle)
+      self.ops.rename(made, f'{made}.done')
+      handle = self.ops.open(f'{made}.done', os.O_RDONLY)
+      if self.ops.read(f'{made}.done', 100, 0, handle) != mark * 10:
+        raise AssertionError(f'{made}.done is wrong')
+      self.ops.release(f'{made}.done', handle)
+
+  def test_ConcurrentOperations(self):
+    errors = []
+    def work(thread):
+      try:
+        self._Work(thread)
+      except Exception as e:
+        errors.append(e)
+    threads = [threading.Thread(target=work, args=(thread,))
+               for thread in range(THREADS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(errors, [])
+    expected = bytes(ord('a') + t for t in range(THREADS))
+    for index in range(FILES):
+      with open(os.path.join(self.rw, 'src', f'{index}.c'), 'rb') as f:
+        self.assertEqual(f.read(THREADS), expected)
+      with open(os.path.join(self.ro, 'src', f'{index}.c'), 'rb') as f:
+        self.assertEqual(f.read(THREADS), b'.' * THREADS)
+    self.assertEqual(len(self.ops.readdir('/out', None)),
+                     THREADS * ROUNDS + 2)
+    self.assertEqual(self.ops.readdir('/', None).count('.copy-up'), 0)
+    self.assertEqual({k: v for k, v in self.ops._open_files.items() if v}, {})
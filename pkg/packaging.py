@@ -1,16 +1,19 @@
 
 import abc
-import hashlib
 import json
 import os
-import random
 import subprocess
+import tempfile
 import time
 import typing
 import zipfile
 
 from impulse.types import references
 from impulse.core import exceptions
+from impulse.pkg import action_cache
+from impulse.pkg import archive
+from impulse.pkg import digest
+from impulse.pkg import hashing
 from impulse.util import temp_dir
 from impulse.core import debug
 from impulse import impulse_paths
@@ -29,23 +32,19 @@ class Hasher(metaclass=abc.ABCMeta):
   def GetHash(self, filename:str) -> str:
     raise NotImplementedError()
 
-  def MD5(self, filename:str) -> str:
-    hash_md5 = hashlib.md5()
-    try:
-      with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-          hash_md5.update(chunk)
-      return hash_md5.hexdigest()
-    except FileNotFoundError:
-      return '----'
+  def DigestAlgorithm(self) -> str:
+    return digest.Configured()
+
+  def Digest(self, filename:str) -> str:
+    return hashing.Shared().Submit(filename, self.DigestAlgorithm()).result()
 
 
 class HashedFile(object):
   __slots__ = ('file', 'hash')
 
-  def __init__(self, file:str, package:Hasher):
+  def __init__(self, file:str, package:Hasher, digest:str=None):
     self.file = file
-    self.hash = package.GetHash(file)
+    self.hash = package.GetHash(file) if digest is None else digest
 
   def dict(self):
     return {'file': self.file, 'hash': self.hash}
@@ -90,11 +89,7 @@ class ExportedPackage(object):
     return []
 
   def RunCommand(self, command):
-    return subprocess.run(command,
-                          encoding='utf-8',
-                          shell=True,
-                          stderr=subprocess.PIPE,
-                          stdout=subprocess.PIPE)
+    return RunCommand(command)
 
   def Execute(self, *cmds):
     for command in cmds:
@@ -118,6 +113,52 @@ class ExportedPackage(object):
     return getattr(self, name)
 
 
+def RunCommand(command:str) -> subprocess.CompletedProcess:
+  """Runs |command| in the working directory.
+
+  Other jobs may use the working directory while this waits on the command.
+  """
+  with temp_dir.ReleasedWorkingDirectory() as cwd:
+    return subprocess.run(command,
+                          cwd=cwd,
+                          encoding='utf-8',
+                          shell=True,
+                          stderr=subprocess.PIPE,
+                          stdout=subprocess.PIPE)
+
+
+def RunMeasuredCommand(command:str
+                       ) -> typing.Tuple[subprocess.CompletedProcess, int]:
+  """Like RunCommand, but also returns the peak memory used, in bytes.
+
+  The output goes through temporary files rather than pipes so that the child
+  can be reaped with wait4, which reports the resource usage of it and all of
+  its descendants.
+  """
+  with (tempfile.TemporaryFile('w+') as out,
+        tempfile.TemporaryFile('w+') as err,
+        temp_dir.ReleasedWorkingDirectory() as cwd):
+    process = subprocess.Popen(command, cwd=cwd, encoding='utf-8', shell=True,
+                               stdout=out, stderr=err)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    out.seek(0)
+    err.seek(0)
+    result = subprocess.CompletedProcess(
+      command, process.returncode, out.read(), err.read())
+  # ru_maxrss is in KiB on linux.
+  return result, usage.ru_maxrss * 1024
+
+
+def ReadPackageContents(filename:str) -> dict|None:
+  """The pkg_contents.json of a package file, if it has a readable one."""
+  try:
+    with zipfile.ZipFile(filename, 'r') as archive:
+      return json.loads(archive.read('pkg_contents.json'))
+  except Exception:
+    return None
+
+
 class UtilHelper(object):
   def __init__(self, buildqueue_ref):
     self.temp_dir = temp_dir
@@ -132,8 +173,6 @@ class ExportablePackage(Hasher):
                platform:impulse_paths.Platform,
                can_access_internal: bool=False,
                binaries_location: str=''):
-    self._extracted_dir = None
-
     self.included_files:typing.List[str] = []
     self.input_files:typing.Set[HashedFile] = set()
     self.depends_on_targets:typing.List[str] = []
@@ -147,6 +186,10 @@ class ExportablePackage(Hasher):
       '_binary') or str(ruletype).endswith('_test')
     self.package_ruletype = ruletype
     self.execution_count = 0
+    self.digest_algorithm = digest.Configured()
+    self._compression = archive.Configured()
+    # Set on export, see action_cache.
+    self.output_digest = None
 
     self._export_binary = None
     self._can_access_internal = can_access_internal
@@ -157,13 +200,8 @@ class ExportablePackage(Hasher):
     self._exec_env_str = ''
     self._propagated_data = {}
     self._platform = platform
-
-  def __getstate__(self):
-    return self.__dict__.copy()
-
-  def __setstate__(self, state):
-    self.__dict__.update(state)
-    self._extracted_dir = None
+    self._timer = None
+    self._known_digests = {}
 
   def __getattribute__(self, attr):
     if attr in ('Internal', 'SetInternalAccess'):
@@ -221,7 +259,7 @@ class ExportablePackage(Hasher):
   def GetHash(self, filename:str) -> str:
     '''Gets the hash of a file, given its name'''
     try:
-      return self.MD5(filename)
+      return self.Digest(filename)
     except FileNotFoundError as e:
       raise exceptions.ListedSourceNotFound(filename,
         str(self.package_target)) from e
@@ -229,6 +267,18 @@ class ExportablePackage(Hasher):
       raise exceptions.ListedSourceNotFound(
         filename, str(self.package_target))
 
+  def DigestAlgorithm(self) -> str:
+    return self.digest_algorithm
+
+  def SetKnownDigests(self, digests:typing.Dict[str, str]):
+    '''Digests already computed for this build, which needn't be again.'''
+    self._known_digests = digests
+
+  def Digest(self, filename:str) -> str:
+    if filename in self._known_digests:
+      return self._known_digests[filename]
+    return super().Digest(filename)
+
   def PropagateData(self, key, data):
     if key not in self._propagated_data:
       self._propagated_data[key] = []
@@ -237,9 +287,21 @@ class ExportablePackage(Hasher):
   def SetInternalAccess(self, access):
     self._buildqueue_ref = access
 
-  def SetInputFiles(self, files:typing.List[str]):
-    for f in files:
-      self.input_files.add(HashedFile(f, self))
+  def SetInputFiles(self, files:typing.Iterable[str]|typing.Dict[str, str]):
+    '''Records the input files, which are hashed in parallel.
+
+    |files| can also map each input file to where its contents can be read
+    from, such as the source file behind a sandbox's copy of it.
+    '''
+    if not isinstance(files, dict):
+      files = {f: f for f in files}
+    try:
+      digests = hashing.Shared().Digests(files.values(), self.digest_algorithm)
+    except IsADirectoryError as e:
+      raise exceptions.ListedSourceNotFound(
+        e.filename, str(self.package_target))
+    for f, file_digest in zip(files, digests):
+      self.input_files.add(HashedFile(f, self, file_digest))
 
   def SetRuleFile(self, file:str, hashpath:str):
     self.rule_file = HashedFile(hashpath, self)
@@ -285,38 +347,45 @@ class ExportablePackage(Hasher):
 
   def RunCommand(self, command):
     '''Executes a command.'''
-    return subprocess.run(command,
-                          encoding='utf-8',
-                          shell=True,
-                          stderr=subprocess.PIPE,
-                          stdout=subprocess.PIPE)
+    return RunCommand(command)
 
   def Export(self) -> ExportedPackage:
-    r = self.RunCommand('pwd')
-    if r.returncode:
-      raise exceptions.FatalException(f'{r.returncode} => {r.stderr}')
-
-    r = self.RunCommand('touch pkg_contents.json')
-    if r.returncode:
-      raise exceptions.FatalException('Cant create new pkg_contents.json')
-
-    with open('pkg_contents.json', 'w+') as f:
-      f.write(self._GetJson())
-    cmd = 'zip --symlinks {} pkg_contents.json {} 2>&1 > /dev/null'
+    self.output_digest = self._OutputDigest()
     filename = self.GetPackageName()
-    cmd = cmd.format(filename, ' '.join(self.included_files))
     EnsureDirectory(os.path.dirname(filename))
-    os.system(cmd)
-    os.system('rm pkg_contents.json')
+    missing = archive.Write(filename, self.included_files,
+      {'pkg_contents.json': self._GetJson()}, self._compression)
+    if missing:
+      debug.DebugMsg(
+        f'{self.package_target} does not have {", ".join(missing)}')
     return ExportedPackage(filename, self.__dict__, self._export_binary)
 
+  def _OutputDigest(self) -> str:
+    '''A digest of everything this package gives to targets depending on it.
+
+    Unlike the package file itself, this doesn't change with the time it was
+    built at, so an identical rebuild has the same output digest. The files
+    are read through the sandbox, whose stats can't key the digest cache.
+    '''
+    files = sorted(set(self.included_files))
+    futures = [hashing.Shared().SubmitUncached(f, self.digest_algorithm)
+               for f in files]
+    digests = []
+    for future in futures:
+      try:
+        digests.append(future.result())
+      except IsADirectoryError:
+        digests.append(None)
+    return (action_cache.KeyBuilder()
+      .Add('files', list(zip(files, digests)))
+      .Add('propagated', self._propagated_data)
+      .Add('tags', sorted(self.tags))
+      .Add('binary', self.is_binary_target)
+      .Key())
+
   def _GetPreviousBuild(self, package_dir):
-    try:
-      archive = zipfile.ZipFile(
-        os.path.join(package_dir, self.GetPackageName()), 'r')
-      return json.loads(archive.read('pkg_contents.json'))
-    except Exception as e:
-      return None
+    return ReadPackageContents(
+      os.path.join(package_dir, self.GetPackageName()))
 
   def NeedsBuild(self, package_dir, src_dir):
     previous_build = self._GetPreviousBuild(package_dir)
@@ -330,6 +399,11 @@ class ExportablePackage(Hasher):
       if self._platform._values.get(platkey, NOT_THE_SAME) != value:
         return self, True, f'platform value |{platkey}| differs'
 
+    # Packages from before the algorithm was recorded used md5, but rather
+    # than trust that, they're just rebuilt.
+    if previous_build.get('digest_algorithm', None) != self.digest_algorithm:
+      return self, True, 'digest algorithm differs'
+
     self._previous_build_timestamp = previous_build.get('build_timestamp', 0)
 
     prev_dict = {}
@@ -350,10 +424,11 @@ class ExportablePackage(Hasher):
       if curr_dict[k] > prev_dict[k]:
         return self, True, f'{k} (from previous build) has been rebuilt'
 
-    for src in previous_build['input_files']:
-      full_path = os.path.join(src_dir, src['file'])
-      if self.MD5(full_path) != src['hash']:
-        return self, True, f'hash of input file {full_path} has changed'
+    changed = hashing.Shared().FirstChanged(
+      ((os.path.join(src_dir, src['file']), src['hash'])
+       for src in previous_build['input_files']), self.digest_algorithm)
+    if changed:
+      return self, True, f'hash of input file {changed} has changed'
 
     check_files = []
     if previous_build.get('build_file', None):
@@ -362,83 +437,41 @@ class ExportablePackage(Hasher):
       check_files.append(previous_build['rule_file'])
     for fh in check_files:
       full_path = os.path.join(src_dir, fh['file'])
-      if self.MD5(full_path) != fh['hash']:
+      if self.Digest(full_path) != fh['hash']:
         return self, True, f'hash of file {full_path} has changed'
 
     return self, False, None
 
-  def LoadToTempAttempt(self, bin_dir) -> (str, dict, 'ExportedPackage'):
-    with open('pkg_contents.json', 'r+') as f:
-      package_contents = json.loads(f.read())
-      exported_package = ExportedPackage(
-        self.package_target.GetPackage().GetRelativePath(), package_contents)
-      if self.is_binary_target:
-        relative_binary = os.path.join(
-          self.package_target.GetDirectory().Relative().Value()[2:],
-          self.package_target.GetName().Name())
-        full_path_binary = os.path.join(bin_dir, relative_binary)
-        binary_location = os.path.join('bin', self.package_target.GetName().Name())
-        return None, {binary_location: full_path_binary}, exported_package
-      else:
-        return self._extracted_dir, {}, exported_package
-
-  def MakeTempDir(self) -> str:
-    '''Makes a temporary directory. Please clean up after yourself.'''
-    exists = True
-    chrs = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-    dirname = ''
-    while exists:
-      dirname = '__impulse__' + ''.join(random.choice(chrs) for i in range(10))
-      if not os.path.exists(f'/tmp/{dirname}'):
-        exists = False
-    r = self.RunCommand(f'mkdir -p /tmp/{dirname}')
-    if r.returncode:
-      raise exceptions.FatalException(f'MKDIR FAILED -> {r.stdout}')
-    return f'/tmp/{dirname}'
-
-  def UseTempDir(self):
-    '''Context manage for a temporary directory that auto cleans up.'''
-    wrapper = self
-    class DirManager(object):
-      def __init__(self):
-        self._directory = None
-      def __enter__(self):
-        self._directory = wrapper.MakeTempDir()
-        return self._directory
-      def __exit__(self, *args, **kwargs):
-        wrapper.RunCommand(f'rm -rf {self._directory}')
-        self._directory = None
-    return DirManager()
-
-  def LoadToTemp(self, pkg_dir, bin_dir):
-    # Temp directory to write to (deleted on object destruction)
-    if self._extracted_dir:
-      self.UnloadPackageDirectory()
-    self._extracted_dir = self.MakeTempDir()
+  def _Loaded(self, package_contents:dict, bin_dir:str, layer:str|None
+              ) -> (str, dict, 'ExportedPackage'):
+    exported_package = ExportedPackage(
+      self.package_target.GetPackage().GetRelativePath(), package_contents)
+    if self.is_binary_target:
+      relative_binary = os.path.join(
+        self.package_target.GetDirectory().Relative().Value()[2:],
+        self.package_target.GetName().Name())
+      full_path_binary = os.path.join(bin_dir, relative_binary)
+      binary_location = os.path.join('bin', self.package_target.GetName().Name())
+      return None, {binary_location: full_path_binary}, exported_package
+    else:
+      return layer, {}, exported_package
+
+  def Load(self, pkg_dir, bin_dir) -> (str, dict, 'ExportedPackage'):
+    '''The layer, binary and package a target depending on this one loads.
+
+    The layer is the package file itself, which the sandbox reads in place,
+    or extracts once for every job using it.
+    '''
     package_name = os.path.join(pkg_dir,
       self.package_target.GetPackage().GetRelativePath())
+    package_contents = ReadPackageContents(package_name)
+    if package_contents is None:
+      raise exceptions.FilesystemSyncException()
+    return self._Loaded(package_contents, bin_dir, package_name)
 
-    extract = f'unzip {package_name} -d {self._extracted_dir}'
-    r = self.RunCommand(f'test -e {self._extracted_dir}')
-    if r.returncode:
-      raise exceptions.FatalException(f'{self._extracted_dir} does not exist')
-    r = self.RunCommand(extract)
-    if r.returncode:
-      raise exceptions.FatalException(f'{extract} ===> {r.stderr}')
-
-    with temp_dir.ScopedTempDirectory(self._extracted_dir):
-      try:
-        return self.LoadToTempAttempt(bin_dir)
-      except:
-        raise exceptions.FilesystemSyncException()
-
-  def UnloadPackageDirectory(self):
-    if self._extracted_dir and os.path.exists(self._extracted_dir):
-      try:
-        self.RunCommand(f'rm -rf {self._extracted_dir}')
-      except FileNotFoundError:
-        print(f'{self._extracted_dir} COULD NOT BE DELETED!')
-    self._extracted_dir = None
+  def UseTempDir(self):
+    '''Context manage for a temporary directory that auto cleans up.'''
+    return tempfile.TemporaryDirectory(prefix='__impulse__')
 
   def Dependencies(self, **filters):
     '''Generates a list targets that this target depends on.'''
@@ -463,12 +496,23 @@ class ExportablePackage(Hasher):
     '''Adds tags to this target.'''
     self.tags.update(set(tags))
 
+  def SetTimer(self, timer) -> None:
+    self._timer = timer
+
+  def _RunTimedCommand(self, command:str):
+    if self._timer is None:
+      return self.RunCommand(command)
+    with self._timer.MeasureCommand(command):
+      result, peak_memory = RunMeasuredCommand(command)
+    self._timer.RecordMemory(peak_memory)
+    return result
+
   def Execute(self, *cmds):
     '''Executes |cmds| in order.'''
     for command in cmds:
       command = f'{self._exec_env_str} {command}'
       try:
-        r = self.RunCommand(command)
+        r = self._RunTimedCommand(command)
         if r.returncode:
           raise exceptions.FatalException(
             f'command "{command}" failed:\n{r.stdout}\n{r.stderr}')
@@ -518,9 +562,3 @@ class ExportablePackage(Hasher):
           success = not pkg.RunCommand(f'mkdir {self._lockfile}').returncode
     return Sem()
 
-
-  def __del__(self):
-    if self._extracted_dir:
-      if os.path.exists(self._extracted_dir):
-        self.UnloadPackageDirectory()
-
@@ -0,0 +1,286 @@
+"""A remote action cache, so that identical targets are only built once a team.
+
+The protocol is plain HTTP, which cache_server.py implements:
+
+  HEAD|GET|PUT /blobs/<digest>    file contents, named by their digest
+  GET|PUT      /actions/<key>     action results, as json
+
+An uploaded blob names its digest algorithm in an X-Impulse-Digest header, so
+the server can check that the contents match the name.
+
+Builds use it through a TieredCache, which has the same interface as the local
+ActionCache. Everything is still read from and written to the local cache; the
+remote one is only asked for actions the local one doesn't have, and is sent
+every action the local one is given. A remote cache which can't be reached is
+treated as empty, it never fails a build.
+"""
+
+import concurrent.futures
+import http.client
+import json
+import os
+import queue
+import threading
+import typing
+import urllib.parse
+
+from impulse.core import debug
+from impulse.pkg import action_cache
+from impulse.pkg import digest
+from impulse.pkg import hashing
+
+
+# Set by `impulse build --remote_cache`, and inherited by the workers.
+ENVIRONMENT_VARIABLE = 'impulse_remote_cache'
+DIGEST_HEADER = 'X-Impulse-Digest'
+
+# Both the number of idle connections kept open, and of parallel transfers.
+CONNECTIONS = 8
+TIMEOUT = 30
+
+# A kept-alive connection the server has since closed fails like this, before
+# there is any response, so the request can be made again on a new one.
+_STALE = (BrokenPipeError, ConnectionResetError)
+
+# Anything which means the server can't be used right now.
+_UNAVAILABLE = (OSError, http.client.HTTPException, ValueError)
+
+
+class _Rejected(Exception):
+  pass
+
+
+class _HashingWriter(object):
+  def __init__(self, output:typing.BinaryIO, algorithm:str):
+    self._output = output
+    self.hash = digest.New(algorithm)
+
+  def write(self, data:bytes) -> int:
+    self.hash.update(data)
+    return self._output.write(data)
+
+
+class ConnectionPool(object):
+  """Connections to one server, kept open between requests."""
+  def __init__(self, url:str, size:int=CONNECTIONS, timeout:float=TIMEOUT):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+      raise ValueError(f'"{url}" is not an http:// or https:// url')
+    self._connection = (http.client.HTTPSConnection if parts.scheme == 'https'
+                        else http.client.HTTPConnection)
+    self._host = parts.hostname
+    self._port = parts.port
+    self._prefix = parts.path.rstrip('/')
+    self._timeout = timeout
+    self._idle = queue.LifoQueue(size)
+
+  def _Take(self) -> typing.Tuple[http.client.HTTPConnection, bool]:
+    try:
+      return self._idle.get_nowait(), True
+    except queue.Empty:
+      return self._connection(self._host, self._port, timeout=self._timeout,
+                              blocksize=digest.BUFFER_SIZE), False
+
+  def _Give(self, connection:http.client.HTTPConnection):
+    try:
+      self._idle.put_nowait(connection)
+    except queue.Full:
+      connection.close()
+
+  def Request(self, method:str, path:str, body:typing.Any=None,
+              headers:typing.Dict[str, str]=None,
+              output:typing.Any=None) -> typing.Tuple[int, bytes|None]:
+    """Makes a request, returning the status and the response body.
+
+    If there is an |output| and the request succeeds, the body is written to
+    it as it arrives rather than returned.
+    """
+    while True:
+      connection, reused = self._Take()
+      try:
+        connection.request(method, self._prefix + path, body=body,
+                           headers=headers or {})
+        response = connection.getresponse()
+      except _STALE:
+        connection.close()
+        if not reused:
+          raise
+        if hasattr(body, 'seek'):
+          body.seek(0)
+        continue
+      except:
+        connection.close()
+        raise
+      try:
+        if output is not None and response.status == 200:
+          while chunk := response.read(digest.BUFFER_SIZE):
+            output.write(chunk)
+          data = None
+        else:
+          data = response.read()
+      except:
+        connection.close()
+        raise
+      if response.will_close:
+        connection.close()
+      else:
+        self._Give(connection)
+      return response.status, data
+
+
+class RemoteCache(object):
+  """The client half of the protocol above."""
+  def __init__(self, url:str, algorithm:str=None, connections:int=CONNECTIONS):
+    self._url = url
+    self._pool = ConnectionPool(url, connections)
+    self._algorithm = algorithm or digest.Configured()
+
+  def _Unavailable(self, error:Exception):
+    debug.DebugMsg(f'Remote cache {self._url} is unavailable: {error}')
+
+  def HasBlob(self, blob:str) -> bool:
+    try:
+      status, _ = self._pool.Request('HEAD', f'/blobs/{blob}')
+    except _UNAVAILABLE as e:
+      self._Unavailable(e)
+      return False
+    return status == 200
+
+  def GetBlob(self, blob:str, destination:str, mode:int=None) -> bool:
+    """Downloads a blob to |destination|, unless it doesn't have its digest."""
+    try:
+      with action_cache.AtomicWrite(destination) as f:
+        writer = _HashingWriter(f, self._algorithm)
+        status, _ = self._pool.Request('GET', f'/blobs/{blob}', output=writer)
+        if status != 200 or writer.hash.hexdigest() != blob:
+          raise _Rejected()
+    except _Rejected:
+      return False
+    except _UNAVAILABLE as e:
+      self._Unavailable(e)
+      return False
+    if mode is not None:
+      os.chmod(destination, mode)
+    return True
+
+  def Upload(self, blob:str, filename:str) -> bool:
+    """Uploads |filename|, whose digest is |blob|, if the server lacks it."""
+    if self.HasBlob(blob):
+      return True
+    try:
+      with open(filename, 'rb') as f:
+        status, _ = self._pool.Request('PUT', f'/blobs/{blob}', body=f, headers={
+          'Content-Length': str(os.fstat(f.fileno()).st_size),
+          DIGEST_HEADER: self._algorithm,
+        })
+    except _UNAVAILABLE as e:
+      self._Unavailable(e)
+      return False
+    return status in (200, 201, 204)
+
+  def PutBlob(self, filename:str) -> str:
+    blob = digest.Compute(filename, self._algorithm).hex()
+    self.Upload(blob, filename)
+    return blob
+
+  def Matches(self, blob:str, filename:str) -> bool:
+    try:
+      return hashing.Digest(filename, self._algorithm) == blob
+    except IsADirectoryError:
+      return False
+
+  def PutAction(self, key:str, result:action_cache.ActionResult) -> bool:
+    body = json.dumps(result.dict()).encode()
+    try:
+      status, _ = self._pool.Request('PUT', f'/actions/{key}', body=body,
+        headers={'Content-Type': 'application/json'})
+    except _UNAVAILABLE as e:
+      self._Unavailable(e)
+      return False
+    return status in (200, 201, 204)
+
+  def GetAction(self, key:str) -> action_cache.ActionResult|None:
+    try:
+      status, data = self._pool.Request('GET', f'/actions/{key}')
+      if status != 200:
+        return None
+      return action_cache.ActionResult.FromDict(json.loads(data))
+    except (KeyError, TypeError):
+      return None
+    except _UNAVAILABLE as e:
+      self._Unavailable(e)
+      return None
+
+
+class TieredCache(object):
+  """A local ActionCache, which falls back to and fills a RemoteCache."""
+  def __init__(self, local:action_cache.ActionCache, remote:RemoteCache,
+               transfers:int=CONNECTIONS):
+    self._local = local
+    self._remote = remote
+    self._transfers = concurrent.futures.ThreadPoolExecutor(
+      max_workers=transfers, thread_name_prefix='RemoteCache')
+
+  def PutBlob(self, filename:str) -> str:
+    return self._local.PutBlob(filename)
+
+  def HasBlob(self, blob:str) -> bool:
+    return self._local.HasBlob(blob)
+
+  def GetBlob(self, blob:str, destination:str, mode:int=None) -> bool:
+    return self._local.GetBlob(blob, destination, mode)
+
+  def Matches(self, blob:str, filename:str) -> bool:
+    return self._local.Matches(blob, filename)
+
+  def GetAction(self, key:str) -> action_cache.ActionResult|None:
+    result = self._local.GetAction(key)
+    if result is not None:
+      return result
+    result = self._remote.GetAction(key)
+    if result is None:
+      return None
+    missing = [blob for blob in (result.package, result.binary)
+               if blob is not None and not self._local.HasBlob(blob)]
+    fetched = list(self._transfers.map(
+      lambda blob: self._remote.GetBlob(blob, self._local.BlobPath(blob)),
+      missing))
+    for blob, ok in zip(missing, fetched):
+      if ok:
+        self._local.Added(blob)
+    if not all(fetched):
+      return None
+    self._local.PutAction(key, result)
+    return self._local.GetAction(key)
+
+  def PutAction(self, key:str, result:action_cache.ActionResult):
+    self._local.PutAction(key, result)
+    blobs = [blob for blob in (result.package, result.binary)
+             if blob is not None]
+    uploaded = self._transfers.map(
+      lambda blob: self._remote.Upload(blob, self._local.BlobPath(blob)),
+      blobs)
+    # The action only goes up once everything it refers to is there.
+    if all(list(uploaded)):
+      self._remote.PutAction(key, result)
+
+
+_SHARED:typing.Dict[tuple, TieredCache] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def ForOutputDirectory() -> action_cache.ActionCache|TieredCache:
+  """The local cache, backed by the remote one if one is configured.
+
+  Connections are kept for the life of the process, a forked worker gets its
+  own rather than sharing its parent's sockets.
+  """
+  local = action_cache.ForOutputDirectory()
+  url = os.environ.get(ENVIRONMENT_VARIABLE, None)
+  if not url:
+    return local
+  key = (os.getpid(), url, local.algorithm, local.directory)
+  with _SHARED_LOCK:
+    if key not in _SHARED:
+      _SHARED[key] = TieredCache(local, RemoteCache(url, local.algorithm))
+    return _SHARED[key]
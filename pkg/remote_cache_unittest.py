@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from impulse.pkg import action_cache
+from impulse.pkg import cache_server
+from impulse.pkg import digest
+from impulse.pkg import remote_cache
+from impulse.testing import unittest
+
+
+class RemoteCacheTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.server = cache_server.CacheServer(
+      os.path.join(self.directory, 'server'))
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self.remote = remote_cache.RemoteCache(self.server.Url(), digest.BLAKE2B)
+
+  def cleanup(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+    shutil.rmtree(self.directory)
+
+  def Local(self, name):
+    return action_cache.ActionCache(
+      os.path.join(self.directory, name), digest.BLAKE2B)
+
+  def Write(self, name, content):
+    filename = os.path.join(self.directory, name)
+    with open(filename, 'wb') as f:
+      f.write(content)
+    return filename
+
+  def test_BlobsAndActions(self):
+    package = self.Write('package.zip', os.urandom(3 << 20))
+    blob = self.remote.PutBlob(package)
+    self.assertTrue(self.remote.HasBlob(blob))
+    self.assertFalse(self.remote.HasBlob('0' * 64))
+
+    restored = os.path.join(self.directory, 'restored.zip')
+    self.assertTrue(self.remote.GetBlob(blob, restored, 0o700))
+    self.assertTrue(self.remote.Matches(blob, restored))
+    self.assertFalse(self.remote.GetBlob('0' * 64, restored))
+    self.assertTrue(self.remote.Matches(blob, restored))
+
+    result = action_cache.ActionResult(blob, 'output')
+    self.assertTrue(self.remote.PutAction('1234' * 16, result))
+    self.assertEqual(self.remote.GetAction('1234' * 16).dict(), result.dict())
+    self.assertEqual(self.remote.GetAction('5678' * 16), None)
+    self.assertEqual(self.remote.GetAction('../../etc'), None)
+
+  def test_RejectsBlobsNotMatchingTheirDigest(self):
+    package = self.Write('package.zip', b'contents')
+    self.assertFalse(self.remote.Upload('0' * 64, package))
+    self.assertFalse(self.remote.HasBlob('0' * 64))
+
+  def test_TieredCacheSharesBetweenMachines(self):
+    first = remote_cache.TieredCache(self.Local('first'), self.remote)
+    package = self.Write('package.zip', b'package')
+    binary = self.Write('binary', b'binary')
+    result = action_cache.ActionResult(
+      first.PutBlob(package), 'output', first.PutBlob(binary), 0o755)
+    first.PutAction('abcd' * 16, result)
+
+    second = remote_cache.TieredCache(self.Local('second'), self.remote)
+    self.assertEqual(second.GetAction('abcd' * 16).dict(), result.dict())
+    self.assertTrue(second.GetBlob(result.binary, binary + '.2'))
+    self.assertTrue(second.Matches(result.binary, binary + '.2'))
+
+  def test_UnreachableServerIsAMiss(self):
+    unreachable = remote_cache.TieredCache(
+      self.Local('local'),
+      remote_cache.RemoteCache('http://127.0.0.1:9', digest.BLAKE2B))
+    package = self.Write('package.zip', b'package')
+    result = action_cache.ActionResult(unreachable.PutBlob(package), 'output')
+    unreachable.PutAction('abcd' * 16, result)
+    self.assertEqual(unreachable.GetAction('ffff' * 16), None)
+    self.assertTrue(unreachable.GetAction('abcd' * 16))
@@ -0,0 +1,388 @@
+"""Runs build jobs on other machines.
+
+A worker (`impulse worker`) is an HTTP server which takes jobs, each a pickled
+graph node (see GraphNode.detached) along with a manifest of the files it
+reads, by root relative path and digest. It builds each job in a fresh workspace of its own, fetching the
+files from the remote cache, and uploads what the job produced back to it.
+
+  GET  /status    {"jobs": how many jobs the worker runs at once}
+  POST /jobs      a pickled job, answered by a pickled result
+
+Since jobs are pickled, and rules are arbitrary code anyway, a worker must only
+be reachable by machines trusted to run code on it.
+
+RemoteExecutorSet hands a pool's jobs to remote workers and to threads here,
+whichever is free first. Jobs which can't run remotely, or whose worker can't
+be reached, are run here instead.
+"""
+
+import concurrent.futures
+import functools
+import http.client
+import http.server
+import json
+import os
+import pickle
+import queue
+import shutil
+import signal
+import tempfile
+import threading as py_threading
+import typing
+
+from impulse.core import debug
+from impulse.core import environment
+from impulse.core import threading
+from impulse.pkg import action_cache
+from impulse.pkg import digest
+from impulse.pkg import hashing
+from impulse.pkg import remote_cache
+
+
+# Set by `impulse build --remote_workers`, a comma separated list of urls.
+ENVIRONMENT_VARIABLE = 'impulse_remote_workers'
+
+# Jobs can run for a long time, and their requests wait for them.
+JOB_TIMEOUT = 6 * 60 * 60
+STATUS_TIMEOUT = 5
+
+
+class WorkerUnavailable(Exception):
+  """The job couldn't be run by the worker, though it could be run here."""
+
+
+class RemoteJobFailed(Exception):
+  """The job ran on the worker, and failed."""
+
+
+def _Fetch(store:action_cache.ActionCache, remote:remote_cache.RemoteCache,
+           blob:str, destination:str, mode:int) -> bool:
+  # Blobs are kept in the worker's own store, since many jobs share inputs.
+  stored = store.HasBlob(blob)
+  if not stored and remote.GetBlob(blob, store.BlobPath(blob)):
+    store.Added(blob)
+    stored = True
+  if stored and store.GetBlob(blob, destination, mode):
+    store.Touch([blob])
+    return True
+  # Evicted while being fetched, by another job trimming the store.
+  return remote.GetBlob(blob, destination, mode)
+
+
+def _IgnoreInterrupts():
+  # Ctrl+C is for the server, which stops its processes itself.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _Execute(request:bytes, directory:str, cache_url:str) -> bytes:
+  """Runs a job in a new workspace, on one of the worker's processes."""
+  workspace = tempfile.mkdtemp(dir=directory, prefix='job_')
+  try:
+    # Paths within the client's root are unpickled relative to this one.
+    os.environ['impulse_root'] = workspace
+    job = pickle.loads(request)
+    algorithm = job['digest']
+    os.environ[digest.ENVIRONMENT_VARIABLE] = algorithm
+    os.environ[remote_cache.ENVIRONMENT_VARIABLE] = cache_url
+
+    store = action_cache.ActionCache(
+      os.path.join(directory, action_cache.CAS_DIR), algorithm)
+    remote = remote_cache.RemoteCache(cache_url, algorithm)
+    with concurrent.futures.ThreadPoolExecutor(
+        remote_cache.CONNECTIONS) as transfers:
+      fetched = transfers.map(
+        lambda item: _Fetch(store, remote, item[1][0],
+                            os.path.join(workspace, item[0]), item[1][1]),
+        job['inputs'].items())
+      missing = [name for name, ok in zip(job['inputs'], fetched) if not ok]
+    if missing:
+      return pickle.dumps({'error': f'Inputs missing from the remote cache: '
+                                    f'{", ".join(sorted(missing))}'})
+
+    node = job['node']
+    node.rebase(job['root'])
+    try:
+      node()
+    except Exception as e:
+      return pickle.dumps({'error': str(e)})
+
+    outputs = {}
+    for name in job['outputs']:
+      filename = os.path.join(workspace, name)
+      if not os.path.exists(filename):
+        continue
+      blob = digest.Compute(filename, algorithm).hex()
+      if not remote.Upload(blob, filename):
+        return pickle.dumps({'error': f'Could not upload {name}'})
+      outputs[name] = (blob, os.stat(filename).st_mode & 0o7777)
+    return pickle.dumps({'outputs': outputs, 'report': node.report()})
+  finally:
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _Respond(self, status:int, body:bytes=b'', content_type:str=None):
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(body)))
+    if content_type:
+      self.send_header('Content-Type', content_type)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path != '/status':
+      return self._Respond(404)
+    self._Respond(200, json.dumps({'jobs': self.server.jobs}).encode(),
+                  'application/json')
+
+  def do_POST(self):
+    length = self.headers.get('Content-Length', '')
+    if self.path != '/jobs' or not length.isdigit():
+      self.close_connection = True
+      return self._Respond(400)
+    request = self.rfile.read(int(length))
+    try:
+      result = self.server.Run(request)
+    except Exception:
+      # The job itself never raises, the worker's processes are broken.
+      return self._Respond(503)
+    self._Respond(200, result, 'application/octet-stream')
+    self.server.Trim()
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+
+class Worker(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, directory:str, cache_url:str, jobs:int=None,
+               address:str='127.0.0.1', port:int=0, verbose:bool=False):
+    super().__init__((address, port), _Handler)
+    os.makedirs(directory, exist_ok=True)
+    self.jobs = jobs or os.cpu_count()
+    self.verbose = verbose
+    self._directory = directory
+    self._cache_url = cache_url
+    self._store = action_cache.ActionCache(
+      os.path.join(directory, action_cache.CAS_DIR), digest.DEFAULT)
+    self._trimming = py_threading.Lock()
+    self._processes = concurrent.futures.ProcessPoolExecutor(
+      self.jobs, initializer=_IgnoreInterrupts)
+    # Forking once the server has threads is unsafe, so every process is
+    # started now, before it does.
+    list(self._processes.map(abs, range(self.jobs)))
+
+  def Url(self) -> str:
+    host, port = self.server_address[:2]
+    return f'http://{host}:{port}'
+
+  def Run(self, request:bytes) -> bytes:
+    return self._processes.submit(
+      _Execute, request, self._directory, self._cache_url).result()
+
+  def Trim(self):
+    """Keeps the inputs fetched for jobs under the cache's size cap."""
+    if self._trimming.acquire(blocking=False):
+      try:
+        self._store.Trim(action_cache.MaxSize())
+      finally:
+        self._trimming.release()
+
+  def server_close(self):
+    super().server_close()
+    self._processes.shutdown(cancel_futures=True)
+
+
+class WorkerClient(object):
+  """Sends jobs to one worker, with their inputs through the remote cache."""
+  def __init__(self, url:str, cache:remote_cache.RemoteCache,
+               transfers:concurrent.futures.Executor):
+    self.url = url
+    self._pool = remote_cache.ConnectionPool(url, timeout=JOB_TIMEOUT)
+    self._cache = cache
+    self._transfers = transfers
+
+  def Slots(self) -> int:
+    """How many jobs the worker runs at once, none if it can't be reached."""
+    pool = remote_cache.ConnectionPool(self.url, 1, STATUS_TIMEOUT)
+    try:
+      status, data = pool.Request('GET', '/status')
+      return int(json.loads(data)['jobs']) if status == 200 else 0
+    except (OSError, ValueError, KeyError, TypeError,
+            http.client.HTTPException) as e:
+      debug.DebugMsg(f'Remote worker {self.url} is unavailable: {e}')
+      return 0
+
+  def _Upload(self, inputs:typing.Dict[str, str],
+              algorithm:str) -> typing.Dict[str, typing.Tuple[str, int]]:
+    names = sorted(inputs)
+    blobs = hashing.Shared().Digests([inputs[n] for n in names], algorithm)
+    if hashing.MISSING in blobs:
+      raise WorkerUnavailable('An input is missing, it is built here instead')
+    uploaded = self._transfers.map(
+      self._cache.Upload, blobs, [inputs[n] for n in names])
+    if not all(list(uploaded)):
+      raise WorkerUnavailable('Inputs could not be uploaded')
+    return {name: (blob, os.stat(inputs[name]).st_mode & 0o7777)
+            for name, blob in zip(names, blobs)}
+
+  def _Download(self, outputs:typing.Dict[str, typing.Tuple[str, int]]):
+    root = environment.Root()
+    downloaded = self._transfers.map(
+      lambda item: self._cache.GetBlob(
+        item[1][0], os.path.join(root, item[0]), item[1][1]),
+      outputs.items())
+    if not all(list(downloaded)):
+      raise WorkerUnavailable('Outputs could not be downloaded')
+
+  def Run(self, node:threading.GraphNode,
+          files:typing.Tuple[typing.Dict[str, str], typing.List[str]]):
+    """Runs |node| on the worker, returning its report."""
+    inputs, outputs = files
+    algorithm = digest.Configured()
+    request = pickle.dumps({
+      'root': environment.Root(),
+      'digest': algorithm,
+      'node': node.detached(),
+      'inputs': self._Upload(inputs, algorithm),
+      'outputs': outputs,
+    })
+    try:
+      status, data = self._pool.Request('POST', '/jobs', body=request,
+        headers={'Content-Type': 'application/octet-stream'})
+    except (OSError, http.client.HTTPException) as e:
+      raise WorkerUnavailable(str(e))
+    if status != 200:
+      raise WorkerUnavailable(f'{self.url} answered {status}')
+    result = pickle.loads(data)
+    if 'error' in result:
+      raise RemoteJobFailed(result['error'])
+    self._Download(result['outputs'])
+    return result['report']
+
+
+class RemoteExecutorSet(object):
+  """Runs jobs on remote workers, and on |poolcount| threads here.
+
+  This has the same interface as threading.WatchdogSet. Every slot of every
+  worker, and every local thread, takes the next job from one queue, so
+  whichever is free first runs it.
+  """
+  _POISON = object()
+
+  def __init__(self, poolcount:int, workers:typing.List[WorkerClient],
+               slots:typing.List[int], debug:bool=False):
+    self.job_response_queue:queue.Queue[threading.JobResponse] = queue.Queue()
+    self.job_input_queue:queue.Queue[threading.Job] = queue.Queue()
+    self._workers = [None] * poolcount
+    for worker, count in zip(workers, slots):
+      self._workers.extend([worker] * count)
+    self.pool_count = len(self._workers)
+    self._debug = debug
+    self._shared_jobs = []
+    self._threads = []
+
+  def Start(self, count:int=None, shared_jobs:typing.List=None):
+    self._shared_jobs = shared_jobs or []
+    for watchdog_id, worker in enumerate(self._workers):
+      thread = py_threading.Thread(target=self._Watch,
+                                   args=(watchdog_id, worker), daemon=True,
+                                   name=f'Watchdog#{watchdog_id}')
+      thread.start()
+      self._threads.append(thread)
+
+  def SharedJobCount(self) -> int:
+    return len(self._shared_jobs)
+
+  def Grow(self, count:int):
+    pass
+
+  def Stop(self):
+    # Like threads, remote jobs can't be stopped, so they are waited for.
+    for _ in self._threads:
+      self.job_input_queue.put(RemoteExecutorSet._POISON)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+    self._shared_jobs = []
+
+  def Drain(self):
+    self.job_input_queue.join()
+    while True:
+      try:
+        self.job_response_queue.get_nowait()
+      except queue.Empty:
+        return
+
+  def _Watch(self, watchdog_id:int, worker:WorkerClient|None):
+    while True:
+      job = self.job_input_queue.get()
+      try:
+        if job is RemoteExecutorSet._POISON:
+          return
+        node = job.node
+        if node is None:
+          node = self._shared_jobs[job.index]
+        node = node.clone()
+        if job.digests:
+          node.use_file_digests(job.digests)
+        files = worker and node.remote_files()
+        if files is None:
+          threading.RunJob(watchdog_id, job.index, node,
+                           self.job_response_queue, self._debug)
+        else:
+          self._RunRemotely(watchdog_id, job.index, node, worker, files)
+      finally:
+        self.job_input_queue.task_done()
+
+  def _RunRemotely(self, watchdog_id:int, index:int,
+                   node:threading.GraphNode, worker:WorkerClient, files):
+    Response = functools.partial(threading.JobResponse,
+                                 job_id=watchdog_id, job_index=index)
+    self.job_response_queue.put(Response(
+      threading.JobResponse.LEVEL.YELLOW, message=f'{node} @ {worker.url}'))
+    try:
+      report = worker.Run(node, files)
+    except WorkerUnavailable as e:
+      debug.DebugMsg(f'Running {node} here, {worker.url} failed: {e}')
+      try:
+        node()
+        report = node.report()
+      except Exception as e:
+        self.job_response_queue.put(Response(
+          threading.JobResponse.LEVEL.FATAL, message=str(e)))
+        return
+    except Exception as e:
+      self.job_response_queue.put(Response(
+        threading.JobResponse.LEVEL.FATAL, message=str(e)))
+      return
+    self.job_response_queue.put(Response(
+      threading.JobResponse.LEVEL.GREEN, report=report))
+
+
+def Connect(urls:typing.List[str],
+            local:int) -> typing.Tuple[typing.Callable, int]:
+  """An executor for DependentPool, and how many remote slots it has.
+
+  It runs jobs on |local| threads here as well as on the workers, so the pool
+  should be sized for both. Workers which can't be reached when the build
+  starts aren't used.
+  """
+  cache = remote_cache.RemoteCache(
+    os.environ[remote_cache.ENVIRONMENT_VARIABLE])
+  transfers = concurrent.futures.ThreadPoolExecutor(
+    remote_cache.CONNECTIONS, thread_name_prefix='RemoteWorker')
+  workers = [WorkerClient(url, cache, transfers) for url in urls]
+  slots = [worker.Slots() for worker in workers]
+  for worker, count in zip(workers, slots):
+    if not count:
+      debug.DebugMsg(
+        f'Remote worker {worker.url} is unavailable, not using it')
+  def Make(poolcount:int, debug:bool=False) -> RemoteExecutorSet:
+    # The pool's count includes the remote slots, which aren't threads here.
+    return RemoteExecutorSet(local, workers, slots, debug)
+  return Make, sum(slots)
@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+import threading as py_threading
+
+from impulse.core import capacity
+from impulse.core import environment
+from impulse.core import threading
+from impulse.pkg import cache_server
+from impulse.pkg import remote_cache
+from impulse.pkg import remote_worker
+from impulse.testing import unittest
+
+
+class FakeData(object):
+  def __init__(self):
+    self.execution_count = 0
+
+
+class Output(object):
+  """All a detached FileNode keeps of one of its dependencies."""
+  def __init__(self, name):
+    self._name = name
+
+
+class FileNode(threading.GraphNode):
+  """Writes out/<name> from src/<name> and the outputs of its dependencies."""
+  def __init__(self, name, *dependencies, local=False, fail=False):
+    super().__init__(set(dependencies), False)
+    self._name = name
+    self._data = FakeData()
+    self._local = local
+    self._fail = fail
+    self._ran_in = None
+
+  def run_job(self, debug, internal_access=None):
+    if self._fail:
+      raise ValueError(f'{self._name} failed')
+    root = environment.Root()
+    contents = []
+    for name in [f'src/{self._name}'] + sorted(
+        f'out/{d._name}' for d in self.dependencies):
+      with open(os.path.join(root, name)) as f:
+        contents.append(f.read())
+    os.makedirs(os.path.join(root, 'out'), exist_ok=True)
+    with open(os.path.join(root, 'out', self._name), 'w') as f:
+      f.write(' '.join(contents))
+    self._ran_in = root
+
+  def remote_files(self):
+    if self._local:
+      return None
+    root = environment.Root()
+    inputs = [f'src/{self._name}'] + [
+      f'out/{d._name}' for d in self.dependencies]
+    return {i: os.path.join(root, i) for i in inputs}, [f'out/{self._name}']
+
+  def detached(self):
+    detached = self.clone()
+    detached.dependencies = {Output(d._name) for d in self.dependencies}
+    return detached
+
+  def report(self):
+    return self._ran_in
+
+  def __eq__(self, other):
+    return type(other) == FileNode and other._name == self._name
+
+  def __hash__(self):
+    return hash(self._name)
+
+  def __str__(self):
+    return self._name
+
+  def get_name(self):
+    return self._name
+
+  def data(self):
+    return self._data
+
+
+class Reports(threading.PoolObserver):
+  def __init__(self):
+    self.ran_in = {}
+    self.finished = []
+
+  def JobCompleted(self, response):
+    self.ran_in[str(response.job())] = response.report()
+
+  def PoolFinished(self, err=None):
+    self.finished.append(err)
+
+
+class RemoteWorkerTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.root = os.path.join(self.directory, 'root')
+    os.makedirs(os.path.join(self.root, 'src'))
+    self.environ = dict(os.environ)
+    os.environ['impulse_root'] = self.root
+
+    self.cache = cache_server.CacheServer(os.path.join(self.directory, 'cas'))
+    os.environ[remote_cache.ENVIRONMENT_VARIABLE] = self.cache.Url()
+    self.workers = [
+      remote_worker.Worker(os.path.join(self.directory, f'worker{n}'),
+                           self.cache.Url(), jobs=1)
+      for n in range(2)]
+    self.threads = []
+    for server in [self.cache] + self.workers:
+      thread = py_threading.Thread(target=server.serve_forever)
+      thread.start()
+      self.threads.append(thread)
+
+  def cleanup(self):
+    for server in [self.cache] + self.workers:
+      server.shutdown()
+      server.server_close()
+    for thread in self.threads:
+      thread.join()
+    os.environ.clear()
+    os.environ.update(self.environ)
+    shutil.rmtree(self.directory)
+
+  def Build(self, graph, local=0, urls=None):
+    for node in graph:
+      with open(os.path.join(self.root, 'src', node._name), 'w') as f:
+        f.write(node._name)
+    # As impulse.build_and_await sizes the pool.
+    executor, slots = remote_worker.Connect(
+      urls or [worker.Url() for worker in self.workers], local)
+    reports = Reports()
+    pool = threading.DependentPool(
+      local + slots, executor=executor, observers=[reports],
+      capacity=capacity.FixedCapacity(local + slots))
+    pool.Start(set(graph), threaded=False)
+    self.finished = reports.finished
+    return reports.ran_in, slots
+
+  def Output(self, name):
+    with open(os.path.join(self.root, 'out', name)) as f:
+      return f.read()
+
+  def test_RunsTheGraphOnWorkers(self):
+    a = FileNode('a')
+    b = FileNode('b')
+    c = FileNode('c', a, b)
+    ran_in, slots = self.Build([a, b, c])
+    self.assertEqual(slots, 2)
+    self.assertEqual(self.Output('c'), 'c a b')
+    for name in 'abc':
+      self.assertTrue(ran_in[name].startswith(
+        os.path.join(self.directory, 'worker')))
+
+  def test_RunsEverythingRemotelyWithNoLocalThreads(self):
+    nodes = [FileNode(name) for name in 'abcdef']
+    ran_in, slots = self.Build(nodes)
+    self.assertEqual(slots, 2)
+    for name in 'abcdef':
+      self.assertTrue(ran_in[name].startswith(
+        os.path.join(self.directory, 'worker')))
+
+  def test_RunsHereWhatCantRunRemotely(self):
+    a = FileNode('a')
+    b = FileNode('b', a, local=True)
+    ran_in, slots = self.Build(
+      [a, b], local=1, urls=['http://127.0.0.1:9', self.workers[0].Url()])
+    self.assertEqual(slots, 1)
+    self.assertEqual(self.Output('b'), 'b a')
+    self.assertEqual(ran_in['b'], self.root)
+
+  def test_RemoteFailuresFailTheBuild(self):
+    a = FileNode('a')
+    b = FileNode('b', a, fail=True)
+    c = FileNode('c', b)
+    ran_in, _ = self.Build([a, b, c])
+    self.assertEqual(sorted(ran_in), ['a'])
+    self.assertEqual(self.finished, ['b failed'])
@@ -0,0 +1,274 @@
+"""The directory a rule runs in, and how it is made to hold the job's inputs.
+
+Every sandbox is a context manager which, while entered, makes |directory|
+show the job's |files| (a map from paths within it to the files they are)
+and the contents of its |layers| (dependency packages, or directories), and
+keeps whatever the rule writes there for it to export. Everything which
+needs to see it goes through its Run, see isolation.Sandbox.
+
+  overlay the kernel's overlay filesystem, mounted on |directory| in a user
+          namespace of the job's own (see isolation). Writes go to |rw|, so
+          nothing the rule does can change its inputs. Where that can't be
+          mounted, this is fuse instead.
+  fuse    the same, but a FUSE filesystem in python (see overlayfs), which
+          reads packages without extracting them. Every filesystem call the
+          rule makes goes through python.
+  links   |directory| is filled with links to the inputs: reflinks where
+          the filesystem has them, otherwise hardlinks, otherwise copies.
+          After that the rule runs at the speed of the disk. A rule which
+          modifies an input in place, rather than replacing it, changes the
+          original through a hardlink.
+  none    |directory| is filled with symlinks to the inputs. The cheapest to
+          make, but tools see the links, and writing through one writes to
+          the original.
+
+Package layers are extracted for all but fuse, next to the package in
+<package>.unpacked/<digest>. That is kept for the next job which uses the
+same version of the package, and everything is linked or mounted from there.
+A job holds a shared flock on each version it uses while its sandbox is
+entered, and other versions are only removed by whoever can lock them
+exclusively, so never from under another build.
+"""
+
+import contextlib
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import typing
+
+from impulse.pkg import archive
+from impulse.pkg import digest
+from impulse.pkg import hashing
+from impulse.pkg import isolation
+from impulse.pkg import overlayfs
+
+
+class Strategy(object):
+  OVERLAY = 'overlay'
+  FUSE = 'fuse'
+  LINKS = 'links'
+  NONE = 'none'
+  ALL = (OVERLAY, FUSE, LINKS, NONE)
+
+
+# Set by `impulse build --sandbox`, and inherited by the workers.
+ENVIRONMENT_VARIABLE = 'impulse_sandbox'
+
+# From linux/fs.h, clones |source| into |destination| sharing their extents.
+FICLONE = 0x40049409
+
+# Whether reflinks work between a pair of devices, so that a filesystem
+# without them costs one failed ioctl rather than one per file.
+_REFLINKS:typing.Dict[typing.Tuple[int, int], bool] = {}
+
+
+def Configured() -> str:
+  """The strategy this build uses."""
+  strategy = os.environ.get(ENVIRONMENT_VARIABLE, Strategy.OVERLAY)
+  if strategy not in Strategy.ALL:
+    raise ValueError(f'Sandbox "{strategy}" is not one of '
+                     f'{", ".join(Strategy.ALL)}')
+  return strategy
+
+
+def _Reflink(source:str, destination:str) -> bool:
+  key = (os.lstat(source).st_dev,
+         os.stat(os.path.dirname(destination)).st_dev)
+  if not _REFLINKS.get(key, True):
+    return False
+  with open(source, 'rb') as src, open(destination, 'wb') as dst:
+    try:
+      fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError as e:
+      if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                         errno.ENOTTY, errno.EPERM):
+        raise
+      _REFLINKS[key] = False
+      os.unlink(destination)
+      return False
+  _REFLINKS[key] = True
+  shutil.copystat(source, destination)
+  return True
+
+
+def Link(source:str, destination:str) -> None:
+  """Puts |source| at |destination|, as a reflink, hardlink or copy."""
+  if os.path.islink(source):
+    os.symlink(os.readlink(source), destination)
+  elif not _Reflink(source, destination):
+    try:
+      os.link(source, destination)
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+        raise
+      shutil.copy2(source, destination)
+
+
+def Symlink(source:str, destination:str) -> None:
+  os.symlink(os.path.abspath(source), destination)
+
+
+def _Extract(package:str, parent:str, unpacked:str) -> None:
+  os.makedirs(parent, exist_ok=True)
+  temporary = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+  try:
+    archive.Extract(package, temporary)
+    os.rename(temporary, unpacked)
+  except OSError as e:
+    shutil.rmtree(temporary, ignore_errors=True)
+    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+      raise
+
+
+def _RemoveUnused(parent:str, keep:str) -> None:
+  """Removes the versions in |parent| other than |keep| which nobody holds."""
+  for entry in os.scandir(parent):
+    if entry.name == keep or entry.name.startswith('.tmp'):
+      continue
+    try:
+      fd = os.open(entry.path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+      continue
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      os.close(fd)
+      continue
+    try:
+      shutil.rmtree(entry.path, ignore_errors=True)
+    finally:
+      os.close(fd)
+
+
+def Unpacked(package:str, held:contextlib.ExitStack) -> str:
+  """The directory the contents of |package| are extracted to.
+
+  Each version of a package is extracted once and kept, so rebuilding
+  dependents doesn't extract it again. It is locked until |held| is closed,
+  and versions which nobody has locked are removed. Jobs racing to extract
+  the same version each extract it, and one of them wins.
+  """
+  blob = hashing.Digest(package, digest.Configured())
+  parent = f'{package}.unpacked'
+  unpacked = os.path.join(parent, blob)
+  while True:
+    if not os.path.isdir(unpacked):
+      _Extract(package, parent, unpacked)
+    try:
+      fd = os.open(unpacked, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+      continue
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    # It could have been removed, and even extracted again, while this waited.
+    try:
+      if os.stat(unpacked).st_ino == os.fstat(fd).st_ino:
+        break
+    except FileNotFoundError:
+      pass
+    os.close(fd)
+  held.callback(os.close, fd)
+  _RemoveUnused(parent, blob)
+  return unpacked
+
+
+class LinkedSandbox(isolation.Sandbox):
+  """Fills |directory| with links to every input, made by |link|.
+
+  Directories are always made rather than linked, since several layers can
+  each have some of the files in one.
+  """
+  def __init__(self, directory:str, files:typing.Dict[str, str],
+               layers:typing.List[str],
+               link:typing.Callable[[str, str], None]=Link):
+    self._directory = directory
+    self._files = files
+    self._layers = layers
+    self._link = link
+    self._made:typing.Set[str] = {directory}
+    self._held = contextlib.ExitStack()
+
+  def _Place(self, source:str, destination:str, is_directory:bool) -> None:
+    if is_directory:
+      if destination not in self._made:
+        if os.path.lexists(destination) and not os.path.isdir(destination):
+          return
+        os.makedirs(destination, exist_ok=True)
+        self._made.add(destination)
+      for entry in os.scandir(source):
+        self._Place(entry.path, os.path.join(destination, entry.name),
+                    entry.is_dir(follow_symlinks=False))
+      return
+    parent = os.path.dirname(destination)
+    if parent not in self._made:
+      os.makedirs(parent, exist_ok=True)
+      self._made.add(parent)
+    # The first of the target's files and its layers to have a file wins.
+    if not os.path.lexists(destination):
+      self._link(source, destination)
+
+  def __enter__(self):
+    # A target's own files come first, so that they shadow its layers'.
+    for name, source in self._files.items():
+      self._Place(source, os.path.join(self._directory, name),
+                  os.path.isdir(source) and not os.path.islink(source))
+    try:
+      for layer in self._layers:
+        if os.path.isfile(layer):
+          layer = Unpacked(layer, self._held)
+        self._Place(layer, self._directory, True)
+    except:
+      self._held.close()
+      raise
+    return self
+
+  def __exit__(self, *args):
+    self._held.close()
+
+
+class OverlaySandbox(isolation.KernelOverlay):
+  """A KernelOverlay of the target's own |files|, on top of its |layers|."""
+  def __init__(self, directory:str, rw:str, files:typing.Dict[str, str],
+               layers:typing.List[str]):
+    super().__init__(directory, rw, [])
+    self._files = files
+    self._layers = layers
+    self._held = contextlib.ExitStack()
+
+  def __enter__(self):
+    inputs = os.path.join(self._rw, 'inputs')
+    os.makedirs(inputs)
+    with LinkedSandbox(inputs, self._files, [], Link):
+      pass
+    try:
+      self._lowerdirs = [inputs] + [
+        Unpacked(layer, self._held) if os.path.isfile(layer) else layer
+        for layer in self._layers]
+      return super().__enter__()
+    except:
+      self._held.close()
+      raise
+
+  def __exit__(self, *args):
+    try:
+      super().__exit__(*args)
+    finally:
+      self._held.close()
+
+
+def Create(strategy:str, directory:str, rw:str, files:typing.Dict[str, str],
+           layers:typing.List[str]) -> isolation.Sandbox:
+  """A sandbox of the given strategy, see above."""
+  if strategy == Strategy.OVERLAY:
+    if isolation.Available() and len(layers) < isolation.MAX_LAYERS:
+      return OverlaySandbox(directory, rw, files, layers)
+    strategy = Strategy.FUSE
+  if strategy == Strategy.FUSE:
+    return overlayfs.FuseCTX(directory, rw, files, *layers)
+  if strategy == Strategy.LINKS:
+    return LinkedSandbox(directory, files, layers, Link)
+  if strategy == Strategy.NONE:
+    return LinkedSandbox(directory, files, layers, Symlink)
+  raise ValueError(f'Sandbox "{strategy}" is not one of '
+                   f'{", ".join(Strategy.ALL)}')
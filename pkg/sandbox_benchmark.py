@@ -0,0 +1,107 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from impulse.args import args
+from impulse.pkg import archive
+from impulse.pkg import isolation
+from impulse.pkg import sandbox
+
+
+command = args.ArgumentParser(complete=True)
+
+
+def MakeHeaders(root, count):
+  """A dependency's headers, each declaring a few functions."""
+  filenames = []
+  for index in range(count):
+    filename = f'include/dir_{index // 100}/header_{index}.h'
+    os.makedirs(os.path.join(root, os.path.dirname(filename)), exist_ok=True)
+    with open(os.path.join(root, filename), 'w') as f:
+      f.write('#pragma once\n')
+      for function in range(8):
+        f.write(f'int function_{index}_{function}(int value);\n')
+    filenames.append(filename)
+  return filenames
+
+
+def MakeSources(root, count, headers, includes):
+  """Sources each including |includes| of the |headers|."""
+  sources = {}
+  os.makedirs(root, exist_ok=True)
+  for index in range(count):
+    filename = os.path.join(root, f'source_{index}.c')
+    with open(filename, 'w') as f:
+      for header in range(includes):
+        header = headers[(index * includes + header) % len(headers)]
+        f.write(f'#include "{header}"\n')
+      f.write(f'int source_{index}(int value) {{ return value + {index}; }}\n')
+    sources[f'src/source_{index}.c'] = filename
+  return sources
+
+
+def FuseAvailable():
+  return os.path.exists('/dev/fuse') and shutil.which('fusermount') is not None
+
+
+def Compile(directory, sources, compiler):
+  for source in sources:
+    subprocess.run([compiler, '-c', '-I.', source, '-o', f'{source}.o'],
+                   cwd=directory, check=True)
+
+
+@command
+def cc_compile(headers:int=2000, sources:int=50, includes:int=50,
+               repeat:int=3, compiler:str='cc'):
+  """Times compiling sources against a dependency package, per sandbox."""
+  if shutil.which(compiler) is None:
+    print(f'{compiler} is not installed')
+    return
+  root = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  try:
+    headers_dir = os.path.join(root, 'headers')
+    filenames = MakeHeaders(headers_dir, headers)
+    os.chdir(headers_dir)
+    package = os.path.join(root, 'headers.zip')
+    archive.Write(package, filenames)
+    os.chdir(cwd)
+    files = MakeSources(os.path.join(root, 'sources'), sources, filenames,
+                        includes)
+    print(f'{sources} sources, each including {includes} of {headers} headers:')
+    for strategy in sandbox.Strategy.ALL:
+      if strategy == sandbox.Strategy.OVERLAY and not isolation.Available():
+        print(f'  {strategy:7} unavailable, this would be fuse')
+        continue
+      if strategy == sandbox.Strategy.FUSE and not FuseAvailable():
+        print(f'  {strategy:7} unavailable, there is no /dev/fuse')
+        continue
+      best_setup, best_compile = None, None
+      for attempt in range(repeat):
+        mount = os.path.join(root, f'{strategy}_{attempt}')
+        rw = os.path.join(root, f'{strategy}_{attempt}_rw')
+        os.makedirs(mount)
+        os.makedirs(rw)
+        start = time.perf_counter()
+        with sandbox.Create(strategy, mount, rw, files, [package]) as mounted:
+          ready = time.perf_counter()
+          mounted.Run(lambda: Compile(mount, list(files), compiler))
+          done = time.perf_counter()
+        # Only the first attempt extracts the package for links and none.
+        if attempt:
+          setup = ready - start
+          best_setup = setup if best_setup is None else min(best_setup, setup)
+        best_compile = (done - ready if best_compile is None
+                        else min(best_compile, done - ready))
+      print(f'  {strategy:7} setup {best_setup or 0:.3f}s  '
+            f'compile {best_compile:.3f}s  '
+            f'{sources / best_compile:.1f} compiles/s')
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(root)
+
+
+def main():
+  command.eval()
@@ -0,0 +1,88 @@
+import contextlib
+import os
+import shutil
+import tempfile
+
+from impulse.pkg import archive
+from impulse.pkg import sandbox
+from impulse.testing import unittest
+
+
+class LinkedSandboxTest(unittest.TestCase):
+  def setup(self):
+    self.directory = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    self.source = os.path.join(self.directory, 'source')
+    os.makedirs(os.path.join(self.source, 'include'))
+    os.chdir(self.source)
+    with open('include/header.h', 'w') as f:
+      f.write('int header;\n')
+    with open('include/shadowed.h', 'w') as f:
+      f.write('int layer;\n')
+    os.symlink('header.h', 'include/link.h')
+    self.package = os.path.join(self.directory, 'package.zip')
+    archive.Write(self.package, ['include/header.h', 'include/shadowed.h',
+                                 'include/link.h'])
+    os.makedirs(os.path.join(self.directory, 'tree', 'include'))
+    self.tree = os.path.join(self.directory, 'tree')
+    with open(os.path.join(self.tree, 'include', 'other.h'), 'w') as f:
+      f.write('int other;\n')
+    self.shadow = os.path.join(self.directory, 'shadowed.h')
+    with open(self.shadow, 'w') as f:
+      f.write('int target;\n')
+    self.mount = os.path.join(self.directory, 'mount')
+
+  def cleanup(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def _Enter(self, strategy:str):
+    with sandbox.Create(strategy, self.mount, None,
+                        {'include/shadowed.h': self.shadow},
+                        [self.package, self.tree]):
+      return {name: open(os.path.join(self.mount, 'include', name)).read()
+              for name in os.listdir(os.path.join(self.mount, 'include'))}
+
+  def test_MergesLayers(self):
+    for strategy in (sandbox.Strategy.LINKS, sandbox.Strategy.NONE):
+      self.assertEqual(self._Enter(strategy), {
+        'header.h': 'int header;\n',
+        'link.h': 'int header;\n',
+        'other.h': 'int other;\n',
+        'shadowed.h': 'int target;\n',
+      })
+      shutil.rmtree(self.mount)
+
+  def test_LinksShareTheirSources(self):
+    self._Enter(sandbox.Strategy.LINKS)
+    self.assertEqual(os.readlink(f'{self.mount}/include/link.h'), 'header.h')
+    self.assertFalse(os.path.islink(f'{self.mount}/include/other.h'))
+
+  def test_UnpacksOnce(self):
+    with contextlib.ExitStack() as held:
+      unpacked = sandbox.Unpacked(self.package, held)
+      marker = os.path.join(unpacked, 'marker')
+      open(marker, 'w').close()
+      self.assertEqual(sandbox.Unpacked(self.package, held), unpacked)
+    self.assertTrue(os.path.exists(marker))
+    archive.Write(self.package, ['include/header.h'])
+    with contextlib.ExitStack() as held:
+      replaced = sandbox.Unpacked(self.package, held)
+    self.assertFalse(replaced == unpacked)
+    self.assertFalse(os.path.exists(unpacked))
+    self.assertEqual(os.listdir(os.path.join(replaced, 'include')),
+                     ['header.h'])
+
+  def test_KeepsVersionsInUse(self):
+    with contextlib.ExitStack() as held:
+      # As if another build's sandbox were still using this version.
+      unpacked = sandbox.Unpacked(self.package, held)
+      archive.Write(self.package, ['include/header.h'])
+      with contextlib.ExitStack() as other:
+        replaced = sandbox.Unpacked(self.package, other)
+      self.assertTrue(os.path.isdir(unpacked))
+    archive.Write(self.package, ['include/shadowed.h'])
+    with contextlib.ExitStack() as held:
+      sandbox.Unpacked(self.package, held)
+    self.assertFalse(os.path.exists(unpacked))
+    self.assertFalse(os.path.exists(replaced))
@@ -1,5 +1,7 @@
 
+import hashlib
 import inspect
+import marshal
 import os
 import sys
 import typing
@@ -14,9 +16,29 @@ from impulse.types import paths
 from impulse.types import typecheck
 
 
+def Fingerprint(path:str) -> tuple|None:
+  """A cheap stat-based fingerprint of a file, or None if it is missing."""
+  try:
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+  except FileNotFoundError:
+    return None
+
+
+def ContentHash(path:str) -> str|None:
+  try:
+    with open(path, 'rb') as f:
+      return hashlib.md5(f.read()).hexdigest()
+  except FileNotFoundError:
+    return None
+
+
 class LazyEnvironmentLoader(builtins.EnvironmentLoader):
   def __init__(self, stub_map:dict[str, list[str]], builtin_methods:dict[str, builtins.BuiltinMethod]):
     self._loaded_files = set()
+    # Maps each loaded file to a (stat fingerprint, content hash) pair so that
+    # long lived loaders can tell which files have changed since loading.
+    self._fingerprints:dict[references.File, tuple] = {}
     self._environment = builtin_methods
     for builtin in self._environment.values():
       builtin.Attach(self)
@@ -43,11 +65,15 @@ class LazyEnvironmentLoader(builtins.EnvironmentLoader):
     self._loaded_files.add(file)
 
     abspath = file.Absolute().Value()
+    # Taken first, so that an edit made while reading looks like a change.
+    fingerprint = Fingerprint(abspath)
     try:
-      with open(abspath) as f:
+      with open(abspath, 'rb') as f:
         buildfile_content = f.read()
     except FileNotFoundError as e:
       raise exceptions.FileImportException(e, file)
+    self._fingerprints[file] = (
+      fingerprint, hashlib.md5(buildfile_content).hexdigest())
 
     try:
       compiled = compile(buildfile_content, abspath, 'exec')
@@ -62,6 +88,25 @@ class LazyEnvironmentLoader(builtins.EnvironmentLoader):
     except Exception as e:
       raise exceptions.FileImportException(e, file)
 
+  def UnloadFile(self, file:references.File) -> None:
+    self._loaded_files.discard(file)
+    self._fingerprints.pop(file, None)
+
+  def ChangedFiles(self) -> set[references.File]:
+    """Loaded files whose contents no longer match what was loaded."""
+    changed = set()
+    for file, (fingerprint, digest) in self._fingerprints.items():
+      abspath = file.Absolute().Value()
+      current = Fingerprint(abspath)
+      if current == fingerprint:
+        continue
+      if ContentHash(abspath) != digest:
+        changed.add(file)
+      else:
+        # Touched but not changed, so there's no need to read it again.
+        self._fingerprints[file] = (current, digest)
+    return changed
+
 
 class StubLoader(object):
   def __init__(self, env:LazyEnvironmentLoader, name:str, filename:str):
@@ -89,7 +134,7 @@ class RecursiveFileParser(parsed_target.TargetArchive):
 
     stubs = {
       '//rules/builtins/builtins.py': [
-        'depends_targets', 'using', 'data', 'toolchain'],
+        'depends_targets', 'using', 'slots', 'data', 'toolchain'],
       '//rules/core/C/build_defs.py': [
         'c_header', 'cpp_header', 'cc_compile', 'cc_combine', 'cc_package_binary', 'cc_object', 'cc_binary'],
       '//rules/core/Golang/build_defs.py': [
@@ -239,6 +284,53 @@ class RecursiveFileParser(parsed_target.TargetArchive):
       result |= c
     return result
 
+  def ReloadChangedFiles(self) -> set[references.File]:
+    """Re-executes any loaded file that has changed on disk.
+
+    Targets defined in a changed BUILD file are dropped and that file is
+    reloaded. Targets hold on to the compiled code of their rule, so every
+    BUILD file with a target that uses a rule from a changed rule file must
+    be reloaded as well.
+    """
+    changed = self._env.ChangedFiles()
+    if not changed:
+      return changed
+    changed_paths = {f.Absolute().Value() for f in changed}
+    stale_build_files = set()
+    for name, target in list(self._targets.items()):
+      rulefile = marshal.loads(target._func).co_filename
+      buildfile = name.GetBuildFile()
+      if buildfile in changed or rulefile in changed_paths:
+        del self._targets[name]
+        stale_build_files.add(buildfile)
+
+    for file in changed | stale_build_files:
+      self._env.UnloadFile(file)
+
+    # Rule files first, so that reloaded BUILD files see the new rules.
+    reload_order = sorted(changed | stale_build_files,
+                          key=lambda f: f.Absolute().Value().endswith('BUILD'))
+    for file in reload_order:
+      if os.path.exists(file.Absolute().Value()):
+        self._env.LoadFile(file)
+
+    if self._platform is not None:
+      self._platform = self._platforms[self._platform._name]
+    return changed
+
+  def ResetStagedTargets(self) -> None:
+    for target in self._targets.values():
+      target._staged = None
+
+  def GenerateGraph(self, build_target:impulse_paths.ParsedTarget) -> set:
+    """Stages |build_target|, reusing anything already parsed and unchanged."""
+    self.ReloadChangedFiles()
+    self.ResetStagedTargets()
+    trn = references.Target.Parse(build_target.GetFullyQualifiedRulePath())
+    self.ParseTarget(trn)
+    self.StageTarget(trn)
+    return self.GetStagedTargets()._targets
+
   def ConvertAllTestTargets(self):
     for target, parsed in self._targets.items():
       if parsed._rule_type.endswith('_test'):
@@ -260,11 +352,4 @@ def generate_graph(build_target:impulse_paths.ParsedTarget,
                    platform=None,
                    **kwargs):
   allow_meta = allow_meta or [build_target]
-  re = RecursiveFileParser(platform, **kwargs)
-
-  btstr = build_target.GetFullyQualifiedRulePath()
-  trn = references.Target.Parse(btstr)
-  re.ParseTarget(trn)
-  re.StageTarget(trn)
-  targets = re.GetStagedTargets()._targets
-  return targets
+  return RecursiveFileParser(platform, **kwargs).GenerateGraph(build_target)
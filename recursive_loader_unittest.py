@@ -0,0 +1,139 @@
+import marshal
+import os
+import shutil
+import tempfile
+
+from impulse import impulse_paths
+from impulse import recursive_loader
+from impulse.core import exceptions
+from impulse.types import paths
+from impulse.types import references
+from impulse.testing import unittest
+
+
+PLATFORM = '''platform (
+  name = "x64-linux-gnu",
+)
+'''
+
+RULES = '''@buildrule
+def {rule}(target, name, **kwargs):
+  return {version!r}
+'''
+
+BUILD = '''load("//rules/{rule}/build_defs.py")
+''' + '''
+{rule} (
+  name = "{name}",
+)
+'''
+
+
+class ReloadTest(unittest.TestCase):
+  def setup(self):
+    self.root = tempfile.mkdtemp()
+    self.environ = dict(os.environ)
+    os.environ['impulse_root'] = self.root
+    self.mtime = 1_000_000_000 * 10**9
+    self.Write('rules/platform/BUILD', PLATFORM)
+    self.Write('rules/copy/build_defs.py', RULES.format(rule='copy', version=1))
+    self.Write('rules/move/build_defs.py', RULES.format(rule='move', version=1))
+    self.Write('proj/BUILD', BUILD.format(rule='copy', name='a'))
+    self.Write('other/BUILD', BUILD.format(rule='move', name='b'))
+    self.parser = recursive_loader.RecursiveFileParser()
+    self.Generate('//proj:a')
+    self.Generate('//other:b')
+
+  def cleanup(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+    shutil.rmtree(self.root)
+
+  def Write(self, name, content):
+    filename = os.path.join(self.root, name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+      f.write(content)
+    # Every write looks like a change, however quickly they're made.
+    self.mtime += 10**9
+    os.utime(filename, ns=(self.mtime, self.mtime))
+
+  def File(self, name):
+    return references.File(
+      paths.AbsolutePath(os.path.join(self.root, name)))
+
+  def Generate(self, target):
+    return {str(node._name) for node in self.parser.GenerateGraph(
+      impulse_paths.convert_to_build_target(target, '//', True))}
+
+  def Has(self, target):
+    try:
+      self.parser.GetBuildTarget(references.Target.Parse(target))
+      return True
+    except KeyError:
+      return False
+
+  def RuleVersion(self, target):
+    code = marshal.loads(
+      self.parser.GetBuildTarget(references.Target.Parse(target))._func)
+    return code.co_consts[-1]
+
+  def test_ReloadsEditedBuildFiles(self):
+    self.Write('proj/BUILD', BUILD.format(rule='copy', name='a') +
+                             '\ncopy (\n  name = "c",\n)\n')
+    self.assertEqual(self.parser.ReloadChangedFiles(),
+                     {self.File('proj/BUILD')})
+    self.assertTrue(self.Has('//proj:c'))
+    self.Write('proj/BUILD', BUILD.format(rule='copy', name='c'))
+    self.assertEqual(self.Generate('//proj:c'), {'//proj:c'})
+    self.assertFalse(self.Has('//proj:a'))
+    self.assertTrue(self.Has('//other:b'))
+
+  def test_IgnoresTouchedFiles(self):
+    self.Write('proj/BUILD', BUILD.format(rule='copy', name='a'))
+    self.assertEqual(self.parser.ReloadChangedFiles(), set())
+    self.assertTrue(self.Has('//proj:a'))
+
+  def test_LoadsAddedBuildFiles(self):
+    self.Write('new/BUILD', BUILD.format(rule='copy', name='d'))
+    self.assertEqual(self.parser.ReloadChangedFiles(), set())
+    self.assertFalse(self.Has('//new:d'))
+    self.assertEqual(self.Generate('//new:d'), {'//new:d'})
+
+  def test_DropsDeletedBuildFiles(self):
+    os.unlink(os.path.join(self.root, 'other', 'BUILD'))
+    self.assertEqual(self.parser.ReloadChangedFiles(),
+                     {self.File('other/BUILD')})
+    self.assertFalse(self.Has('//other:b'))
+    self.assertTrue(self.Has('//proj:a'))
+    with unittest.ExpectException(self, exceptions.FileImportException):
+      self.Generate('//other:b')
+
+  def test_ReloadsBuildFilesUsingChangedRules(self):
+    self.Write('rules/copy/build_defs.py',
+               RULES.format(rule='copy', version=2))
+    self.assertEqual(self.parser.ReloadChangedFiles(),
+                     {self.File('rules/copy/build_defs.py')})
+    self.assertEqual(self.RuleVersion('//proj:a'), 2)
+    self.assertEqual(self.RuleVersion('//other:b'), 1)
+
+  def test_SeesEditsMadeWhileLoading(self):
+    self.Write('proj/BUILD', BUILD.format(rule='copy', name='e'))
+    fingerprint = recursive_loader.Fingerprint
+    stats = []
+    def edited_after_stat(path):
+      result = fingerprint(path)
+      if path.endswith(os.path.join('proj', 'BUILD')):
+        stats.append(path)
+        # Once to see that it changed, and again when loading it.
+        if len(stats) == 2:
+          self.Write('proj/BUILD', BUILD.format(rule='copy', name='f'))
+      return result
+    recursive_loader.Fingerprint = edited_after_stat
+    try:
+      self.parser.ReloadChangedFiles()
+    finally:
+      recursive_loader.Fingerprint = fingerprint
+    self.parser.ReloadChangedFiles()
+    self.assertTrue(self.Has('//proj:f'))
+    self.assertFalse(self.Has('//proj:e'))
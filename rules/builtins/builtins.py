@@ -9,7 +9,7 @@ def increase_stack_arg_decorator(replacement):
       # This is what the decorated function is replaced with
       def newfn(*args, **kwargs):
         kwargs['__stack__'] = kwargs.get('__stack__', 1) + 2
-        replaced(*args, **kwargs)
+        return replaced(*args, **kwargs)
       return newfn
     return _decorator
   return _superdecorator
@@ -54,6 +54,23 @@ def using(fn, *includes):
   return replacement
 
 
+@increase_stack_arg_decorator
+def slots(fn, count):
+  ''' A buildrule decorator which declares that targets generated from this
+      buildrule are heavy (like linking a large binary), and take up |count|
+      of the build's worker slots while they run. It must be applied before
+      the @buildrule decorator. Example:
+
+      @slots(4)
+      @buildrule
+      def cc_package_binary(...):
+        ...
+  '''
+  def replacement(*args, **kwargs):
+    return fn(*args, **kwargs).SetSlots(count)
+  return replacement
+
+
 @buildrule
 def data(target, name, srcs):
   target.SetTags('data')
@@ -136,6 +136,7 @@ def cc_combine(target, name, **kwargs):
     std=None))
 
 
+@slots(4)
 @using(_compile, _get_objects, _get_flags, _get_include_dirs)
 @buildrule
 def cc_package_binary(target, name, **kwargs):
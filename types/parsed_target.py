@@ -1,5 +1,7 @@
 
 import abc
+import contextlib
+import copy
 import marshal
 import os
 import shutil
@@ -10,8 +12,12 @@ import types
 from impulse.core import exceptions
 from impulse.core import environment
 from impulse.core import threading
-from impulse.pkg import overlayfs
+from impulse.core import timings
+from impulse.pkg import action_cache
+from impulse.pkg import hashing
 from impulse.pkg import packaging
+from impulse.pkg import remote_cache
+from impulse.pkg import sandbox as build_sandbox
 from impulse.types import paths
 from impulse.types import references
 from impulse.types import typecheck
@@ -97,7 +103,7 @@ class TargetArchive(metaclass=abc.ABCMeta):
 
 
 class BuildTarget(Target):
-  __slots__ = ('_name', '_func', '_kwargs', '_scope', '_tags', '_deps', '_includes', '_staged')
+  __slots__ = ('_name', '_func', '_kwargs', '_scope', '_tags', '_deps', '_includes', '_staged', '_slots', '_rule_file')
   def __init__(self, name:references.Target,
                function:typing.Callable,
                kwargs:dict,
@@ -111,7 +117,9 @@ class BuildTarget(Target):
     self._scope = scope
     self._tags = tags
     self._staged = None
+    self._slots = 1
     self._rule_name = function.__name__
+    self._rule_file = CheckRuleFile(function.__code__.co_filename)
 
   def GetName(self) -> str:
     return str(self._name)
@@ -143,6 +151,10 @@ class BuildTarget(Target):
       self._includes[func.__name__] = (marshal.dumps(func.__code__))
     return self
 
+  def SetSlots(self, count:int) -> 'BuildTarget':
+    self._slots = count
+    return self
+
   @typecheck.Assert
   def Stage(self, archive:TargetArchive) -> StagedBuildTargetSet:
     if self._staged is RULE_STAGING_RECURSIVE_CANARY:
@@ -177,6 +189,17 @@ class Any(object):
     return False
 
 
+class _DependencyPackage(object):
+  """A dependency of a detached job, which only loads its package."""
+  __slots__ = ('_package',)
+
+  def __init__(self, package:packaging.ExportablePackage):
+    self._package = package
+
+  def Load(self, package_dir:str, binary_dir:str) -> tuple:
+    return self._package.Load(package_dir, binary_dir)
+
+
 class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
   def __init__(self, target:BuildTarget, dependencies:StagedBuildTargetSet, archive:TargetArchive, force:bool, internal:bool):
     threading.GraphNode.__init__(self, dependencies._targets, internal)
@@ -189,6 +212,9 @@ class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
 
     self._force_build = force
     self._buildrule_name = target._rule_name
+    self._slots = target._slots
+    self._rule_file = target._rule_file
+    self._timer = None
     self._package = packaging.ExportablePackage(
       target._name, target._rule_name, archive.GetDefaultPlatformTarget(), internal)
 
@@ -202,12 +228,8 @@ class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
   def __repr__(self) -> str:
     return f'Staged[{self._name}]'
 
-  def LoadToTemp(self, package_dir:str, binary_dir:str) -> None:
-    return self._package.LoadToTemp(package_dir, binary_dir)
-
-  @typecheck.Assert
-  def UnloadPackageDirectory(self) -> None:
-    return self._package.UnloadPackageDirectory()
+  def Load(self, package_dir:str, binary_dir:str) -> None:
+    return self._package.Load(package_dir, binary_dir)
 
   @typecheck.Assert
   def get_name(self) -> None:
@@ -217,9 +239,88 @@ class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
   def data(self) -> packaging.ExportablePackage:
     return self._package
 
+  def slots(self) -> int:
+    return self._slots
+
+  def clone(self) -> 'StagedBuildTargetImpl':
+    # Running a job fills in its package, so the copy needs its own.
+    clone = copy.copy(self)
+    clone._package = copy.deepcopy(self._package)
+    return clone
+
+  def common_files(self) -> list[str]:
+    # The same ones _RunBuildRule hands to SetRuleFile and SetBuildFile.
+    return [self._rule_file, self._name.GetBuildFile().Absolute().Value()]
+
+  def use_file_digests(self, digests:dict[str, str]) -> None:
+    self._package.SetKnownDigests(digests)
+
+  def remote_files(self) -> tuple[dict[str, str], list[str]]|None:
+    # Targets which change the graph need the pool, which is only here.
+    if self._has_internal_access:
+      return None
+    root = environment.Root()
+    build_root = self._name.GetDirectory().Absolute()
+    try:
+      inputs = self._ListedFiles(build_root)
+    except exceptions.ListedSourceNotFound:
+      return None
+    for filename in self.common_files():
+      relative = GetRootRelativePath(filename)
+      if relative is None:
+        return None
+      inputs[relative] = filename
+    for dependency in self.dependencies:
+      for relative in dependency._OutputFiles():
+        filename = os.path.join(root, relative)
+        if os.path.exists(filename):
+          inputs[relative] = filename
+    return inputs, self._OutputFiles()
+
+  def _OutputFiles(self) -> list[str]:
+    """The package, and binary if there is one, relative to the root."""
+    outputs = [os.path.join(
+      PACKAGES_DIR, self._name.GetPackage().GetRelativePath())]
+    if self._package.is_binary_target:
+      outputs.append(os.path.join(
+        BINARIES_DIR, self._name.GetDirectory().Relative().Value()[2:],
+        self._name._target_name.Name()))
+    return outputs
+
+  def detached(self) -> 'StagedBuildTargetImpl':
+    # The rule, its includes and kwargs, and the packages of the direct
+    # dependencies, which are all run_job reads of them.
+    detached = copy.copy(self)
+    detached.dependencies = {
+      _DependencyPackage(dependency._package)
+      for dependency in self.dependencies}
+    detached.remaining_dependencies = set()
+    return detached
+
+  def rebase(self, root:str) -> None:
+    if self._rule_file.startswith(root + os.sep):
+      self._rule_file = os.path.join(
+        environment.Root(), self._rule_file[len(root) + 1:])
+    # Action keys name the rule code's files relative to the current root.
+    self._marshalled_func = action_cache.Relocated(
+      self._marshalled_func, root, environment.Root())
+    self._marshalled_includes = {
+      name: action_cache.Relocated(code, root, environment.Root())
+      for name, code in self._marshalled_includes.items()}
+    self._package.SetKnownDigests({})
+
+  def report(self) -> timings.JobReport:
+    input_hash = None
+    if getattr(self._package, 'input_files', None):
+      input_hash = timings.InputHash(self._package.input_files)
+    return timings.JobReport(self._timer, input_hash)
+
   @typecheck.Assert
   def _GetFilesIncludedInBuildDirectory(self, root:paths.AbsolutePath) -> dict:
     self.check_thread()
+    return self._ListedFiles(root)
+
+  def _ListedFiles(self, root:paths.AbsolutePath) -> dict:
     result = {}
     relative = root.QualifiedPath().Value()[2:]
     for entry in self._marshalled_kwargs.get('srcs', []):
@@ -277,9 +378,11 @@ class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
   @typecheck.Assert
   def _GetExecEnv(self) -> dict:
     self.check_thread()
-    environment = globals()
+    # A copy for each job, since jobs on threads run rules at the same time,
+    # and their includes can have the same names.
+    environment = dict(globals())
     for k, v in self._marshalled_includes.items():
-      environment[k] = types.FunctionType(marshal.loads(v), globals(), k)
+      environment[k] = types.FunctionType(marshal.loads(v), environment, k)
     return environment
 
   def run_job(self, debug:bool, internal_access:None=None) -> None:
@@ -287,6 +390,10 @@ class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
     if internal_access:
       self._package.SetInternalAccess(internal_access)
 
+    # Timings for each phase of this job, sent back with the finished job.
+    self._timer = timings.PhaseTimer()
+    self._package.SetTimer(self._timer)
+
     # The absolute path for the directory where this target is defined.
     build_root = self._name.GetDirectory().Absolute()
 
@@ -294,54 +401,61 @@ class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
     package_directory = os.path.join(environment.Root(), PACKAGES_DIR)
     binaries_directory = os.path.join(environment.Root(), BINARIES_DIR)
 
-    # forced_files are files which have to be included in the overlayfs,
+    # forced_files are files which have to be included in the sandbox,
     # while included_files are the set of files which are checked when
     # calculating build update requirements.
     forced_files = self._GetFilesIncludedInBuildDirectory(build_root)
     included_files = dict(forced_files)
 
-    # loaded_dep_dirs is the set of directories which get added as
-    # overlays when overlayfs is mounted.
+    # loaded_dep_dirs is the set of package files which get added as
+    # layers of the sandbox. The fuse sandbox reads them without extracting.
     loaded_dep_dirs = []
-    for dependency in self.dependencies:
-      directory, files, package = dependency.LoadToTemp(package_directory, binaries_directory)
-      if directory:
-        loaded_dep_dirs.append(directory)
-      self._package.AddDependency(package)
-      forced_files.update(files)
+    with self._timer.Measure(timings.Phase.LOAD_DEPS):
+      for dependency in self.dependencies:
+        directory, files, package = dependency.Load(package_directory, binaries_directory)
+        if directory:
+          loaded_dep_dirs.append(directory)
+        self._package.AddDependency(package)
+        forced_files.update(files)
+
+    package_export_path = os.path.join(package_directory, self._name.GetPackage().GetRelativePath())
+    binary_path = os.path.join(binaries_directory,
+      build_root.QualifiedPath().Value()[2:], self._name._target_name.Name())
 
     ro_directory = environment.Root()
-    if not self._NeedsBuild(package_directory, ro_directory):
-      return
+    cache = remote_cache.ForOutputDirectory()
+    with self._timer.Measure(timings.Phase.NEEDS_BUILD):
+      action_key = self._ActionKey(included_files)
+      if self._RestoreCachedResult(cache, action_key, package_export_path,
+                                   binary_path):
+        return
+      if not self._NeedsBuild(package_directory, ro_directory):
+        # Built before the action was cached, or since evicted from it.
+        self._CacheResult(cache, action_key, package_export_path, binary_path)
+        return
 
     rw_directory = tempfile.mkdtemp()
     working_directory = tempfile.mkdtemp()
 
-    package_export_path = os.path.join(package_directory, self._name.GetPackage().GetRelativePath())
-
     try:
-      export_binary = None
-      with overlayfs.FuseCTX(working_directory, rw_directory, forced_files,
-                             *loaded_dep_dirs):
-        with temp_dir.ScopedTempDirectory(working_directory):
-          # Set these as the hashed input files
-          self._package.SetInputFiles(included_files.keys())
-          export_binary, rulefile, buildfile = self._RunBuildRule()
-          rulefile = CheckRuleFile(rulefile)
-          self._package.SetRuleFile(GetRootRelativePath(rulefile), rulefile)
-          self._package.SetBuildFile(GetRootRelativePath(buildfile), buildfile)
-          if not (internal_access and internal_access.rerun_more_deps):
-            self._package = self._package.Export()
-            packaging.EnsureDirectory(os.path.dirname(package_export_path))
-            shutil.copyfile(self._package.filename, package_export_path)
-            if self._package.is_binary_target:
-              if not export_binary:
-                raise Exception('{} must return a binary exporter!'.format(
-                  self._buildrule_name))
-              bindir = os.path.join(binaries_directory, build_root.QualifiedPath().Value()[2:])
-              packaging.EnsureDirectory(bindir)
-              export_binary(self._package, self._name._target_name.Name(),
-                            package_export_path, bindir)
+      with contextlib.ExitStack() as sandbox:
+        with self._timer.Measure(timings.Phase.MOUNT):
+          mounted = sandbox.enter_context(build_sandbox.Create(
+            build_sandbox.Configured(), working_directory, rw_directory,
+            forced_files, loaded_dep_dirs))
+        # The rule might run in a process of its own, which sends back what it
+        # changed.
+        self._timer, self._package, graph = mounted.Run(
+          lambda: self._RunSandboxed(working_directory, included_files,
+                                     internal_access, package_export_path,
+                                     binaries_directory, build_root))
+      if internal_access and graph is not internal_access:
+        internal_access.InjectMoreGraph(graph.added_graph)
+        internal_access.rerun_more_deps = graph.rerun_more_deps
+      if not (internal_access and internal_access.rerun_more_deps):
+        with self._timer.Measure(timings.Phase.EXPORT):
+          self._CacheResult(cache, action_key, package_export_path,
+                            binary_path)
     except exceptions.FilesystemSyncException:
       raise
     except exceptions.BuildTargetNoBuildNecessary:
@@ -349,8 +463,115 @@ class StagedBuildTargetImpl(threading.GraphNode, StagedBuildTarget):
     finally:
       shutil.rmtree(working_directory)
       shutil.rmtree(rw_directory)
-      for d in self.dependencies:
-        d.UnloadPackageDirectory()
+
+  def _RunSandboxed(self, working_directory:str, included_files:dict,
+                    internal_access:typing.Any, package_export_path:str,
+                    binaries_directory:str,
+                    build_root:paths.AbsolutePath) -> tuple:
+    """Runs the rule and exports its package, from within the sandbox."""
+    with temp_dir.ScopedTempDirectory(working_directory):
+      # Set these as the hashed input files, which are read from their
+      # sources rather than through the sandbox.
+      with self._timer.Measure(timings.Phase.HASH_INPUTS):
+        self._package.SetInputFiles(included_files)
+      with self._timer.Measure(timings.Phase.RULE):
+        export_binary, rulefile, buildfile = self._RunBuildRule()
+      # Not the code's own filename, which is wherever it was parsed.
+      rulefile = self._rule_file
+      self._package.SetRuleFile(GetRootRelativePath(rulefile), rulefile)
+      self._package.SetBuildFile(GetRootRelativePath(buildfile), buildfile)
+      if not (internal_access and internal_access.rerun_more_deps):
+        with self._timer.Measure(timings.Phase.EXPORT):
+          self._Export(package_export_path, export_binary,
+                       binaries_directory, build_root)
+    return self._timer, self._package, internal_access
+
+  def _ActionKey(self, included_files:dict) -> str|None:
+    """Everything the output of this target depends on, see action_cache.
+
+    There is no key for targets which can change the build graph, or which
+    depend on packages from before output digests were recorded.
+    """
+    if self._has_internal_access:
+      return None
+    outputs = []
+    for package in self._package.depends_on_targets:
+      output = getattr(package, 'output_digest', None)
+      if output is None:
+        return None
+      outputs.append((str(package.package_target), output))
+
+    names = sorted(included_files)
+    try:
+      digests = hashing.Shared().Digests(
+        [included_files[name] for name in names],
+        self._package.digest_algorithm)
+    except IsADirectoryError:
+      return None
+
+    key = action_cache.KeyBuilder()
+    key.AddCode('rule', self._marshalled_func)
+    for name in sorted(self._marshalled_includes):
+      key.AddCode(f'include:{name}', self._marshalled_includes[name])
+    key.Add('rule_file', self._package.Digest(self._rule_file))
+    key.Add('kwargs', self._marshalled_kwargs)
+    key.Add('platform', self._package.GetPlatform()._values)
+    key.Add('digest', self._package.digest_algorithm)
+    key.Add('inputs', list(zip(names, digests)))
+    key.Add('dependencies', sorted(outputs))
+    return key.Key()
+
+  def _RestoreCachedResult(self, cache:action_cache.ActionCache,
+                           action_key:str|None, package_export_path:str,
+                           binary_path:str) -> bool:
+    """Whether the outputs for |action_key| are in place, copying if need be."""
+    if action_key is None or self._force_build:
+      return False
+    if self._marshalled_kwargs.get('build_always', False):
+      return False
+    result = cache.GetAction(action_key)
+    if result is None:
+      return False
+    if not cache.Matches(result.package, package_export_path):
+      if not cache.GetBlob(result.package, package_export_path):
+        return False
+    if result.binary and not cache.Matches(result.binary, binary_path):
+      if not cache.GetBlob(result.binary, binary_path, result.binary_mode):
+        return False
+    return True
+
+  def _CacheResult(self, cache:action_cache.ActionCache,
+                   action_key:str|None, package_export_path:str,
+                   binary_path:str) -> None:
+    if action_key is None or not os.path.exists(package_export_path):
+      return
+    output_digest = getattr(self._package, 'output_digest', None)
+    if output_digest is None:
+      # The package wasn't just exported, so read it from the one on disk.
+      previous = packaging.ReadPackageContents(package_export_path) or {}
+      output_digest = previous.get('output_digest', None)
+    if output_digest is None:
+      return
+    binary, binary_mode = None, None
+    if self._package.is_binary_target and os.path.exists(binary_path):
+      binary = cache.PutBlob(binary_path)
+      binary_mode = os.stat(binary_path).st_mode & 0o7777
+    cache.PutAction(action_key, action_cache.ActionResult(
+      cache.PutBlob(package_export_path), output_digest, binary, binary_mode))
+
+  def _Export(self, package_export_path:str, export_binary:typing.Any,
+              binaries_directory:str, build_root:paths.AbsolutePath) -> None:
+    self._package = self._package.Export()
+    packaging.EnsureDirectory(os.path.dirname(package_export_path))
+    shutil.copyfile(self._package.filename, package_export_path)
+    if self._package.is_binary_target:
+      if not export_binary:
+        raise Exception('{} must return a binary exporter!'.format(
+          self._buildrule_name))
+      bindir = os.path.join(binaries_directory, build_root.QualifiedPath().Value()[2:])
+      packaging.EnsureDirectory(bindir)
+      export_binary(self._package, self._name._target_name.Name(),
+                    package_export_path, bindir)
 
 
 def CheckRuleFile(rulefile):
@@ -53,6 +53,17 @@ class AbsolutePath(Path):
         self._value, f'Path is not within impulse root ({root})')
     return QualifiedPath('/' + self._value[len(root):])
 
+  def __reduce__(self):
+    # Paths within the root are pickled relative to it, so that a job sent to
+    # a remote worker refers to the same files under the worker's root.
+    try:
+      root = environment.Root()
+    except LookupError:
+      return AbsolutePath, (self._value,)
+    if self._value.startswith(root + os.sep):
+      return _WithinRoot, (self._value[len(root) + 1:],)
+    return AbsolutePath, (self._value,)
+
   @typecheck.Assert
   def __hash__(self) -> int:
     return hash(self._value)
@@ -64,6 +75,10 @@ class AbsolutePath(Path):
     return self._value == other._value
 
 
+def _WithinRoot(relative:str) -> AbsolutePath:
+  return AbsolutePath(os.path.join(environment.Root(), relative))
+
+
 class QualifiedPath(Path):
   @typecheck.Assert
   def __init__(self, path:str):
@@ -1,5 +1,74 @@
+import contextlib
 import os
 import tempfile
+import threading
+
+
+class _WorkingDirectoryLease(object):
+  """Shares the process wide working directory between threads.
+
+  A thread holds the lease for as long as it is inside a ScopedTempDirectory,
+  so relative paths keep working when jobs run on threads. Waiting on a
+  subprocess doesn't need the working directory though, so the lease can be
+  handed back around those waits (see ReleasedWorkingDirectory). The working
+  directory goes back to where it was when the lease was taken while somebody
+  else holds it, since a job's own directory is deleted when the job is done.
+
+  So jobs on threads take turns at everything they do in python, however
+  many there are. Only the working directory's holder can use relative paths:
+  anything else running meanwhile sees the holder's directory instead.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._owner = None
+    self._depth = 0
+    self._home = None
+
+  def Acquire(self):
+    if self._owner == threading.get_ident():
+      self._depth += 1
+      return
+    self._lock.acquire()
+    self._owner = threading.get_ident()
+    self._depth = 1
+    self._home = os.getcwd()
+
+  def Release(self):
+    self._depth -= 1
+    if not self._depth:
+      self._owner = None
+      self._lock.release()
+
+  @contextlib.contextmanager
+  def Released(self):
+    if self._owner != threading.get_ident():
+      yield os.getcwd()
+      return
+    cwd, depth, home = os.getcwd(), self._depth, self._home
+    os.chdir(home)
+    self._owner, self._depth = None, 0
+    self._lock.release()
+    try:
+      yield cwd
+    finally:
+      self._lock.acquire()
+      self._owner, self._depth, self._home = threading.get_ident(), depth, home
+      os.chdir(cwd)
+
+
+_LEASE = _WorkingDirectoryLease()
+
+
+def ReleasedWorkingDirectory():
+  """Lets other threads use the working directory during a blocking call.
+
+  Yields the current working directory, which the blocking call should use
+  explicitly (ie, subprocess's cwd=) since another thread's job is going to
+  change it in the meantime. Nothing run while it is released may use a
+  relative path.
+  """
+  return _LEASE.Released()
+
 
 class ScopedTempDirectory(object):
   def __init__(self, temp_directory=None, delete_non_empty=False):
@@ -20,6 +89,7 @@ class ScopedTempDirectory(object):
     self._exited = False
     if not self._temp_directory:
       self._temp_directory = tempfile.mkdtemp()
+    _LEASE.Acquire()
     self._old_directory = self._getcwd()
     os.chdir(self._temp_directory)
 
@@ -27,7 +97,10 @@ class ScopedTempDirectory(object):
     if self._exited:
       return
     self._exited = True
-    os.chdir(self._old_directory)
+    try:
+      os.chdir(self._old_directory)
+    finally:
+      _LEASE.Release()
     if self._delete_on_exit:
       if self._delete_non_empty:
         os.system(f'rm -rf {self._temp_directory}')